@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import json
+import queue
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Errors that mean "send less": quota / rate limits and overload, by class name, so that the
+# Google (api_core), OpenAI and fake_google exceptions are recognized without importing them
+OVERLOAD_ERRORS = ('ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'RateLimitError')
+OVERLOAD_CODES = (429, 503)
+# In a message, a status code only counts as a whole number (not part of a name or a number) and
+# together with words saying what it means, so that e.g. "vc_01429.wav" or "got 429 bytes" are not overload errors
+_OVERLOAD_NAME = re.compile(r'\b(?:' + '|'.join(OVERLOAD_ERRORS) + r')\b')
+_OVERLOAD_CODE = re.compile(r'(?<![\w.])(?:' + '|'.join(map(str, OVERLOAD_CODES)) + r')(?!\w|\.\w)')
+_OVERLOAD_WORDS = re.compile(r'too many requests|resource[ _]exhausted|rate[ _-]?limit|quota|unavailable|overloaded',
+                             re.IGNORECASE)
+
+
+def is_overload(error: BaseException) -> bool:
+    """True if error says the API is over quota or overloaded."""
+    if type(error).__name__ in OVERLOAD_ERRORS:
+        return True
+    code = getattr(error, 'code', None) or getattr(error, 'http_status', None)
+    return code in OVERLOAD_CODES
+
+
+def is_overload_message(text: str) -> bool:
+    """
+    True if an error message (e.g. one passed back from a worker process) names an overload error:
+    one of OVERLOAD_ERRORS, or a 429 / 503 status together with its meaning, as in
+    "429 Quota exceeded" (str() of a Google API error) or "503 Service Unavailable".
+    """
+    if _OVERLOAD_NAME.search(text):
+        return True
+    return bool(_OVERLOAD_CODE.search(text)) and bool(_OVERLOAD_WORDS.search(text))
+
+
+class AIMDLimiter:
+    """
+    Limit on concurrent requests to one API, adapted at runtime by additive increase,
+    multiplicative decrease (AIMD, as in TCP congestion control).
+
+    Each completed request is a signal. Until the first congestion signal the limit grows by
+    one per success (slow start, doubling every round trip); after that by 1/limit per
+    success, i.e. about one per round trip. It only grows while it is actually used. An
+    overload error (ResourceExhausted, 429, 503) or a smoothed latency above
+    latency_tolerance times the best smoothed latency seen (after latency_warmup successes)
+    cuts it by decrease, at most once per round trip: requests that started before the last
+    cut do not cut it again.
+
+    Callers take a slot around each API call with slot() (threads) or aslot() (asyncio);
+    the number of workers is the upper bound, max_limit. Every change of the limit is
+    appended to log_path as JSONL {"t", "limit", "in_flight", "latency", "reason"}.
+    """
+
+    def __init__(self, name: str, max_limit: int = 64, initial: int = 1, min_limit: int = 1, decrease: float = 0.5,
+                 latency_tolerance: float = 2.0, latency_alpha: float = 0.2, latency_warmup: int = 8,
+                 log_path: Optional[str] = None, verbose: bool = True):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.window = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.latency_alpha = latency_alpha
+        self.latency_warmup = latency_warmup
+        self.verbose = verbose
+        self.in_flight = 0
+        self.latency: Optional[float] = None  # smoothed latency of successful requests
+        self.best_latency: Optional[float] = None
+        self.slow_start = True
+        self.successes = 0
+        self.overloads = 0
+        self.latency_cuts = 0
+        self.started = time.monotonic()
+        self.history: List[Dict[str, Any]] = []
+        self._last_cut = float('-inf')
+        self._limit_seconds = 0.0  # integral of the limit over time, for the mean
+        self._last_change = self.started
+        self._cond = threading.Condition()
+        self._async_cond: Optional[asyncio.Condition] = None
+        self._log = open(log_path, 'a', encoding='utf-8') if log_path else None
+        self._record('start')
+
+    @property
+    def limit(self) -> int:
+        return int(self.window)
+
+    def _record(self, reason: str) -> None:
+        now = time.monotonic()
+        entry = {'t': round(now - self.started, 3), 'limit': self.limit, 'in_flight': self.in_flight,
+                 'latency': None if self.latency is None else round(self.latency, 4), 'reason': reason}
+        self.history.append(entry)
+        if self._log is not None:
+            self._log.write(json.dumps({'name': self.name, **entry}) + '\n')
+            self._log.flush()
+
+    def _set_window(self, window: float, reason: str) -> None:
+        """Change the window (caller holds the lock); logs when the integer limit changes."""
+        window = min(max(window, float(self.min_limit)), float(self.max_limit))
+        old_limit = self.limit
+        now = time.monotonic()
+        self._limit_seconds += old_limit * (now - self._last_change)
+        self._last_change = now
+        self.window = window
+        if self.limit != old_limit:
+            self._record(reason)
+            if self.verbose and self.limit < old_limit:
+                print(f"[aimd {self.name}] limit {old_limit} -> {self.limit} ({reason})")
+            self._cond.notify_all()
+
+    def _end(self, started: float, ok: bool, overload: bool, reason: str) -> None:
+        """Adjust the limit from one finished request (caller holds the lock)."""
+        used = self.in_flight >= self.limit
+        self.in_flight -= 1
+        latency = time.monotonic() - started
+        if not ok:
+            if overload:
+                self.overloads += 1
+                self._cut(started, reason)
+            return  # other errors (bad input, not found) say nothing about load
+        self.successes += 1
+        self.latency = latency if self.latency is None else self.latency + self.latency_alpha * (latency - self.latency)
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        # A fixed warmup, not one tied to the limit, which grows as fast as the successes in slow start
+        if (self.latency_tolerance and self.successes > self.latency_warmup
+                and self.latency > self.latency_tolerance * self.best_latency):
+            if self._cut(started, f"latency {self.latency:.2f}s > {self.latency_tolerance:g} x {self.best_latency:.2f}s"):
+                self.latency_cuts += 1
+        elif used:
+            self._set_window(self.window + (1.0 if self.slow_start else 1.0 / self.window),
+                             'slow start' if self.slow_start else 'increase')
+
+    def _cut(self, started: float, reason: str) -> bool:
+        """Cut the limit (caller holds the lock); returns False for requests sent before the last cut."""
+        if started < self._last_cut:
+            return False  # sent before the last cut, at the old limit
+        self._last_cut = time.monotonic()
+        self.slow_start = False
+        self._set_window(self.window * self.decrease, reason)
+        # The latency seen at this limit is the new reference, so a slower API is not cut forever
+        self.best_latency = self.latency if self.latency is not None else self.best_latency
+        return True
+
+    def acquire(self, block: bool = True) -> Optional[float]:
+        """Take a slot; returns its start time for release(), or None if not blocking and none is free."""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                if not block:
+                    return None
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started: float, ok: bool = True, overload: bool = False, reason: str = 'overload') -> None:
+        """Give back a slot taken at started, with the outcome of its request."""
+        with self._cond:
+            self._end(started, ok, overload, reason)
+            self._cond.notify_all()
+
+    def release_error(self, started: float, error: BaseException) -> None:
+        self.release(started, ok=False, overload=is_overload(error), reason=type(error).__name__)
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one of the limit's slots around an API call (blocking until one is free)."""
+        started = self.acquire()
+        try:
+            yield
+        except BaseException as e:
+            self.release_error(started, e)
+            raise
+        self.release(started)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        """asyncio version of slot(), for limiters used from a single event loop."""
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        async with self._async_cond:
+            started = self.acquire(block=False)
+            while started is None:
+                await self._async_cond.wait()
+                started = self.acquire(block=False)
+        try:
+            yield
+        except BaseException as e:
+            self.release_error(started, e)
+            raise
+        else:
+            self.release(started)
+        finally:
+            async with self._async_cond:
+                self._async_cond.notify_all()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            limit_seconds = self._limit_seconds + self.limit * (now - self._last_change)
+            limits = [entry['limit'] for entry in self.history]
+            elapsed = now - self.started
+            return {
+                'name': self.name,
+                'limit': self.limit,
+                'min_seen': min(limits),
+                'max_seen': max(limits),
+                'mean_limit': limit_seconds / elapsed if elapsed else float(self.limit),
+                'successes': self.successes,
+                'overloads': self.overloads,
+                'latency_cuts': self.latency_cuts,
+                'changes': len(self.history) - 1,
+            }
+
+    def print_summary(self) -> None:
+        s = self.summary()
+        print(f"AIMD {s['name']}: limit {s['limit']} (range {s['min_seen']}-{s['max_seen']}, mean {s['mean_limit']:.1f}), "
+              f"{s['successes']} ok, {s['overloads']} overload errors, {s['latency_cuts']} latency cuts, {s['changes']} changes")
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def limiter_or_none(adaptive: bool, name: str, max_limit: int, log_path: Optional[str] = None) -> Optional[AIMDLimiter]:
+    """An AIMDLimiter up to max_limit if adaptive, else None (fixed concurrency)."""
+    return AIMDLimiter(name, max_limit=max_limit, log_path=log_path) if adaptive else None
+
+
+def maybe_slot(limiter: Optional[AIMDLimiter]):
+    """limiter.slot(), or a no-op context without a limiter."""
+    return contextlib.nullcontext() if limiter is None else limiter.slot()
+
+
+def maybe_aslot(limiter: Optional[AIMDLimiter]):
+    """limiter.aslot(), or a no-op async context without a limiter."""
+    return contextlib.nullcontext() if limiter is None else limiter.aslot()
+
+
+def imap_limited(pool, fn: Callable, items: Sequence, limiter: AIMDLimiter,
+                 outcome: Callable[[Any], Tuple[bool, bool]],
+                 before_start: Optional[Callable[[], Any]] = None) -> Iterator[Any]:
+    """
+    Like pool.imap_unordered(fn, items) on a multiprocessing pool, with at most limiter.limit
+    tasks running. outcome(result) -> (ok, overload) tells the limiter how each task went,
+    for workers that report errors in their result instead of raising. before_start() is
+    called before a task takes its slot, e.g. to wait for a quota token outside the slot.
+    """
+    results = queue.Queue()
+    next_idx = 0
+    running = 0
+    while next_idx < len(items) or running:
+        # Only this loop takes and gives back slots, so a free slot stays free until acquire()
+        while next_idx < len(items) and (running == 0 or limiter.in_flight < limiter.limit):
+            if before_start is not None:
+                before_start()
+            started = limiter.acquire()
+            pool.apply_async(fn, (items[next_idx],), callback=lambda r, s=started: results.put((s, r, None)),
+                             error_callback=lambda e, s=started: results.put((s, None, e)))
+            next_idx += 1
+            running += 1
+        started, result, error = results.get()
+        running -= 1
+        if error is not None:
+            limiter.release_error(started, error)
+            raise error
+        ok, overload = outcome(result)
+        limiter.release(started, ok=ok, overload=overload)
+        yield result
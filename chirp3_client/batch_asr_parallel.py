@@ -2,12 +2,10 @@ import os
 import json
 import glob
 from typing import Dict, List, Tuple
-import argh
+import profiling
 from multiprocessing import Pool
 import time
 from functools import partial
-import io
-from contextlib import redirect_stdout
 import sys
 
 # Add parent directory to system path
@@ -15,27 +13,34 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(script_dir)
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
-from run_asr_1speaker import run_asr
+from run_cloud_asr_batch_1speaker import recognize_bytes
+from stage_metrics import METRICS, ProgressLine, print_summary, start_export
+from ref_store import ref_id_from_wav
+from sharding import in_shard, parse_shard, print_shard
+from run_db import RunDB
+from aimd import imap_limited, is_overload_message, limiter_or_none
+import quota_governor
 
 
-def process_single_file(wav_file: str, max_retries: int = 3, sample_rate: int = 24000) -> Tuple[str, str]:
+def process_single_file(wav_file: str, max_retries: int = 3, sample_rate: int = 24000,
+                        acquire_quota: bool = True) -> Tuple[str, str, float]:
     """
-    Process a single WAV file with retry logic
+    Process a single WAV file with retry logic (acquire_quota=False if the caller took the quota)
 
     Returns:
-        Tuple of (filename, transcription/error text)
+        Tuple of (filename, transcription/error text, seconds spent including retries)
     """
     filename = os.path.basename(wav_file)
+    start = time.monotonic()
 
     for attempt in range(max_retries):
         try:
-            buffer = io.StringIO()
-            with redirect_stdout(buffer):
-                run_asr(wav_file, sample_rate=sample_rate)
-
-            asr_text = buffer.getvalue().strip()
-            print(f"Success: {filename}")
-            return filename, asr_text
+            with open(wav_file, 'rb') as f:
+                audio_content = f.read()
+            # Retries always take their own quota token
+            asr_text = recognize_bytes(audio_content, name=filename, sample_rate=sample_rate, raise_errors=True,
+                                       acquire_quota=acquire_quota or attempt > 0)
+            return filename, asr_text.strip(), time.monotonic() - start
 
         except Exception as e:
             if attempt < max_retries - 1:
@@ -44,7 +49,7 @@ def process_single_file(wav_file: str, max_retries: int = 3, sample_rate: int =
             else:
                 error_msg = f"ERROR: Failed after {max_retries} attempts: {str(e)}"
                 print(f"Final failure for {filename}: {error_msg}")
-                return filename, error_msg
+                return filename, error_msg, time.monotonic() - start
 
 
 def process_folder(
@@ -52,6 +57,11 @@ def process_folder(
     output_json: str = "asr_results.jsonl",
     num_processes: int = 4,
     sample_rate: int = 24000,
+    metrics_dir: str = None,
+    shard: str = '',
+    run_db: str = None,
+    adaptive: bool = False,
+    aimd_log: str = None,
 ) -> None:
     """
     Process all WAV files in parallel and save results to a JSONL file.
@@ -60,14 +70,38 @@ def process_folder(
     Args:
         input_folder: Path to folder containing WAV files
         output_json: Path to output JSONL file
-        num_processes: Number of parallel processes to use
+        num_processes: Number of parallel processes to use (with adaptive, the most files in flight)
+        metrics_dir: Export metrics to metrics_dir/asr.prom periodically and asr.summary.json at exit
+        shard: Process only shard i of N ("i/N"), by a hash of the item id (the WAV name without
+            .wav and the vc_ prefix, as for TTS). Merge with `sharding.py merge-jsonl`.
+        run_db: Run database (run_db.py). Only the WAVs of input_folder it lists as synthesized
+            and not yet transcribed (or failed) are processed, and every transcript is recorded in it;
+            output_json then holds the results of this run only.
+        adaptive: Adapt the number of files in flight to the API's latency and quota errors (aimd.py);
+            results are then written in completion order instead of file order
+        aimd_log: With adaptive, append every change of the limit to this JSONL file
     """
-    wav_files = glob.glob(os.path.join(input_folder, "*.wav"))
+    shard = parse_shard(shard)
+    if metrics_dir:
+        start_export(metrics_dir, 'asr')
+    db = RunDB(run_db) if run_db else None
+    if db is not None:
+        rows = db.pending_asr(input_folder)
+        wav_files = [row['wav_path'] for row in rows]
+        db_keys = {os.path.basename(row['wav_path']): (row['item_id'], row['voice']) for row in rows}
+        shard_files = [f for f in wav_files if in_shard(db_keys[os.path.basename(f)][0], shard)]
+    else:
+        wav_files = glob.glob(os.path.join(input_folder, "*.wav"))
+        shard_files = [f for f in wav_files if in_shard(ref_id_from_wav(os.path.basename(f)), shard)]
+    print_shard(shard, len(shard_files), len(wav_files), 'WAV files')
+    wav_files = shard_files
     total_files = len(wav_files)
     print(f"Found {total_files} WAV files to process")
+    progress = ProgressLine(METRICS, total=total_files)
 
     success_count = 0
     fail_count = 0
+    limiter = limiter_or_none(adaptive, 'asr', num_processes, aimd_log)
 
     # Create a pool of workers and process files with imap for streaming results
     with Pool(processes=num_processes) as pool:
@@ -75,9 +109,16 @@ def process_folder(
         with open(output_json, 'w', encoding='utf-8') as f:
             # Use imap instead of map to get results as they complete
             # for idx, (filename, text) in enumerate(pool.imap(process_single_file, wav_files), 1):
-            process_file = partial(process_single_file, sample_rate=sample_rate)
-
-            for idx, (filename, text) in enumerate(pool.imap(process_file, wav_files), 1):
+            if limiter is None:
+                results = pool.imap(partial(process_single_file, sample_rate=sample_rate), wav_files)
+            else:
+                # The quota token is taken here before each file's slot (so quota waits are not
+                # counted as API latency), not in the worker
+                results = imap_limited(pool, partial(process_single_file, sample_rate=sample_rate, acquire_quota=False),
+                                       wav_files, limiter,
+                                       lambda r: (not r[1].startswith("ERROR:"), is_overload_message(r[1])),
+                                       before_start=partial(quota_governor.acquire, 'speech'))
+            for idx, (filename, text, seconds) in enumerate(results, 1):
                 # Create result dictionary
                 result = {
                     "filename": filename,
@@ -90,24 +131,29 @@ def process_folder(
                 f.write('\n')
                 f.flush()  # Ensure writing to disk
 
-                # Update counts and progress
-                if text.startswith("ERROR:"):
+                # Update counts and progress (timed in the worker process)
+                failed = text.startswith("ERROR:")
+                METRICS.record('asr', seconds, ok=not failed, api='speech', bytes_in=os.path.getsize(os.path.join(input_folder, filename)))
+                if db is not None:
+                    db.record_asr(*db_keys[filename], None if failed else text, ok=not failed)
+                if failed:
                     fail_count += 1
-                else:
-                    success_count += 1
-
-                # Print progress
-                print(f"\rProgress: {idx}/{total_files} files ({idx/total_files*100:.1f}%)", end='')
-
-                # Print the result summary
-                if text.startswith("ERROR:"):
                     print(f"\nFailed {filename}: {text[:100]}...")
                 else:
-                    print(f"\nProcessed {filename}: {text[:100]}...")
+                    success_count += 1
+                progress.update()
 
-    print(f"\n\nProcessing complete. Results saved to {output_json}")
+    progress.close()
+    print(f"\nProcessing complete. Results saved to {output_json}")
     print(f"Successfully processed: {success_count} files")
     print(f"Failed: {fail_count} files")
+    if limiter is not None:
+        limiter.print_summary()
+        limiter.close()
+    print_summary()
+    if db is not None:
+        db.print_summary()
+        db.close()
 
 """Usage:
 {"filename": "file1.wav", "text": "transcribed text", "timestamp": "2025-04-23 10:30:45"}
@@ -117,4 +163,4 @@ python batch_asr.py path/to/wav/folder --output-json results.jsonl --num-process
 """
 
 if __name__ == "__main__":
-    argh.dispatch_command(process_folder)
+    profiling.dispatch_command(process_folder)
@@ -1,31 +1,30 @@
+import contextlib
 import json
 import os
-from typing import Set, Dict, Any, Tuple
-import argh
-import re
+from typing import Set, Dict, Any, Tuple, List, Sequence
+import profiling
+from text_normalize import normalize, purify_text, INVALID_REFERENCE_RE
+from ref_store import RefStore, ref_id_from_wav
+from stream_sort import ExternalSorter, TopK, Histogram
+from sharding import in_shard, parse_shard
 
 def clean_text(text: str) -> str:
     """Remove punctuation and extra spaces from text."""
-    # Remove all punctuation and replace with space
-    text = re.sub(r'[.,!?;:"\'’\-]', ' ', text)
-    # Replace multiple spaces with single space
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip().lower()
+    return normalize(text).clean
 
 def get_words(text: str) -> Set[str]:
     """Get set of words from text, lowercased, no punctuation."""
-    return set(clean_text(text).split())
+    return normalize(text).word_set
 
 def get_chars(text: str) -> Set[str]:
     """Get set of characters from text, lowercased, no punctuation."""
-    return set(clean_text(text).replace(' ', ''))
+    return set(normalize(text).chars)
 
 def get_chars_bigram(text: str) -> Set[str]:
     """Get set of character bigrams from text, lowercased, no punctuation.
-    Example: "Hello, world!" -> {"he", "el", "ll", "lo", "wo", "or", "rl", "ld"}
+    Example: "Hello, world!" -> {"he", "el", "ll", "lo", "ow", "wo", "or", "rl", "ld"}
     """
-    text = clean_text(text).replace(' ', '')
-    return set(text[i:i+2] for i in range(len(text)-1))
+    return normalize(text).bigrams
 
 def jaccard_similarity(set1: Set, set2: Set) -> float:
     """Calculate Jaccard similarity between two sets."""
@@ -36,6 +35,140 @@ def jaccard_similarity(set1: Set, set2: Set) -> float:
     return intersection / union if union > 0 else 0.0
 
 
+def _banded_edit_table(ref: Sequence, hyp: Sequence, band: int) -> List[List[int]]:
+    """Levenshtein DP restricted to the diagonal band |i - j| <= band.
+
+    Row i holds the costs for columns j in [i - band, i + band], stored at
+    offset j - i + band. Cells outside the band are left at an "infinite" cost.
+    """
+    n, m = len(ref), len(hyp)
+    inf = n + m + 1
+    width = 2 * band + 1
+    rows = []
+    prev = None
+    for i in range(n + 1):
+        row = [inf] * width
+        lo = max(0, i - band)
+        hi = min(m, i + band)
+        for j in range(lo, hi + 1):
+            d = j - i + band
+            if i == 0:
+                row[d] = j
+                continue
+            if j == 0:
+                row[d] = i
+                continue
+            best = prev[d] + (ref[i - 1] != hyp[j - 1])  # match / substitution
+            if d + 1 < width and prev[d + 1] + 1 < best:
+                best = prev[d + 1] + 1  # deletion
+            if d > 0 and row[d - 1] + 1 < best:
+                best = row[d - 1] + 1  # insertion
+            row[d] = best
+        rows.append(row)
+        prev = row
+    return rows
+
+
+def _align_ops(ref: Sequence, hyp: Sequence) -> List[str]:
+    """Return the edit script ('=', 'S', 'D', 'I') turning ref into hyp.
+
+    The band starts narrow and doubles until the distance fits inside it, so
+    near-identical pairs (the common case for ASR checks) cost O(n * k) rather
+    than O(n * m). When backtracking, insertions are preferred so that extra
+    hypothesis tokens are attributed to the end of the alignment.
+    """
+    n, m = len(ref), len(hyp)
+    band = max(abs(n - m), 8)
+    while True:
+        rows = _banded_edit_table(ref, hyp, band)
+        dist = rows[n][m - n + band]
+        if dist <= band or band >= max(n, m):
+            break
+        band *= 2
+
+    ops = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        d = j - i + band
+        cur = rows[i][d]
+        if j > 0 and d > 0 and rows[i][d - 1] + 1 == cur:
+            ops.append('I')
+            j -= 1
+        elif i > 0 and j > 0 and rows[i - 1][d] + (ref[i - 1] != hyp[j - 1]) == cur:
+            ops.append('=' if ref[i - 1] == hyp[j - 1] else 'S')
+            i -= 1
+            j -= 1
+        else:
+            ops.append('D')
+            i -= 1
+    ops.reverse()
+    return ops
+
+
+def edit_distance_stats(ref: Sequence, hyp: Sequence) -> Dict[str, int]:
+    """Count substitutions, deletions and insertions between two token sequences.
+
+    Common prefix and suffix tokens are stripped before running the DP, so only
+    the differing middle part is aligned.
+
+    Returns:
+        Dict with keys sub, del, ins, trailing_ins (insertions after the last
+        reference token, i.e. hallucinated ending) and ref_len.
+    """
+    n, m = len(ref), len(hyp)
+    prefix = 0
+    while prefix < n and prefix < m and ref[prefix] == hyp[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and ref[n - 1 - suffix] == hyp[m - 1 - suffix]:
+        suffix += 1
+
+    ops = _align_ops(ref[prefix:n - suffix], hyp[prefix:m - suffix])
+    trailing_ins = 0
+    if suffix == 0:
+        for op in reversed(ops):
+            if op != 'I':
+                break
+            trailing_ins += 1
+    return {
+        'sub': ops.count('S'),
+        'del': ops.count('D'),
+        'ins': ops.count('I'),
+        'trailing_ins': trailing_ins,
+        'ref_len': n,
+    }
+
+
+def error_rate(stats: Dict[str, int]) -> float:
+    """(S + D + I) / N, with an empty reference scoring 0.0 or 1.0."""
+    errors = stats['sub'] + stats['del'] + stats['ins']
+    if stats['ref_len'] == 0:
+        return 1.0 if errors else 0.0
+    return errors / stats['ref_len']
+
+
+def get_error_rates(asr_text: str, ref_text: str) -> Dict[str, Any]:
+    """Word- and character-level edit-distance metrics of ASR text against the reference.
+
+    Characters are compared on the cleaned text without spaces, same as sim_char.
+    """
+    ref, asr = normalize(ref_text), normalize(asr_text)
+    words = edit_distance_stats(ref.words, asr.words)
+    chars = edit_distance_stats(ref.chars, asr.chars)
+    return {
+        'wer': error_rate(words),
+        'cer': error_rate(chars),
+        'word_sub': words['sub'],
+        'word_del': words['del'],
+        'word_ins': words['ins'],
+        'char_sub': chars['sub'],
+        'char_del': chars['del'],
+        'char_ins': chars['ins'],
+        'trailing_ins_words': words['trailing_ins'],
+        'trailing_ins_chars': chars['trailing_ins'],
+    }
+
+
 # [^?‘’'\\–—.!;:a-zA-Z0-9"{},: _-&]+
 def purify_reference(text: str) -> Tuple[str, bool]:
     """
@@ -45,20 +178,100 @@ def purify_reference(text: str) -> Tuple[str, bool]:
         Tuple of (purified_text, is_valid)
         is_valid is False if text contains invalid characters
     """
-    # Replace smart quotes with regular quotes
-    text = text.replace('“', '"').replace('”', '"')
-    text = text.replace('’', "'").replace('‘', "'")
-    text = text.replace('…', "...")
-    text = text.replace('–', '-').replace('—', '-')
-    text = text.replace('\\n', ' ')
+    # Replace smart quotes, ellipsis and dashes with plain ASCII
+    text = purify_text(text)
 
     # Check for invalid characters
-    invalid_pattern = r'[^?&\'\\–—.!;:a-zA-Z0-9"{},: _-]+'
-    if re.search(invalid_pattern, text):
+    if INVALID_REFERENCE_RE.search(text):
         return text, False
     return text, True
 
 
+# References shorter than this need min_char_sim_for_short_lines to be kept
+SHORT_LINE_CHARS = 16
+
+
+def is_persona_reference(ref_text: str) -> bool:
+    """True for self-introductions ("my name is ..."), which are never kept."""
+    return "my name is" in ref_text
+
+
+def score_pair(
+    asr_text: str,
+    ref_text: str,
+    detect_ending_noise: bool = False,
+    verbose: bool = False,
+    name: str = '',
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Score one ASR transcript against its reference text.
+
+    Returns:
+        Tuple of (scores, trailing_noise). scores holds the purified reference_text,
+        sim_word, sim_char, the edit-distance metrics and is_valid_reference.
+        trailing_noise is True if the ASR text continues past the end of the reference.
+    """
+    # Purify reference text
+    ref_text, is_valid = purify_reference(ref_text)
+    ca = clean_text(asr_text)
+    cr = clean_text(ref_text)
+    trailing_noise = False
+
+    if not is_valid:
+        if verbose:
+            print(f"Warning: Invalid characters in reference text for {name}")
+        sim_word = 0.0
+        sim_char = 0.0
+    elif (ca.startswith(cr) and not cr.startswith(ca)) and detect_ending_noise:
+        print(f"[{name}] Warning: ASR detects MORE at end of reference!", ca[:-len(cr)], ' || ', cr)
+        sim_word = 0.0
+        sim_char = 0.0
+        trailing_noise = True
+    elif is_persona_reference(ref_text):
+        sim_word = 0.0
+        sim_char = 0.0
+        # remove personality
+    else:
+        sim_word = jaccard_similarity(get_words(asr_text), get_words(ref_text))
+        sim_char = jaccard_similarity(get_chars_bigram(asr_text), get_chars_bigram(ref_text))
+
+    scores = {
+        'reference_text': ref_text,
+        'sim_word': sim_word,
+        'sim_char': sim_char,
+        **get_error_rates(asr_text, ref_text),
+        'is_valid_reference': is_valid,
+    }
+    return scores, trailing_noise
+
+
+def is_kept(result: Dict[str, Any], min_char_sim: float = 0.5, min_char_sim_for_short_lines: float = 0.7) -> bool:
+    """Apply the character similarity filter, stricter for short references."""
+    if result['sim_char'] < min_char_sim:
+        return False
+    if result['sim_char'] < min_char_sim_for_short_lines and len(result['reference_text']) < SHORT_LINE_CHARS:
+        return False  # Skip short references with low similarity
+    return True
+
+
+def sidecar_path(output_jsonl: str, tag: str, ext: str = '.jsonl') -> str:
+    """output.jsonl -> output.<tag>.jsonl (or output.<tag><ext>); only a final .jsonl extension is replaced."""
+    root, old_ext = os.path.splitext(output_jsonl)
+    if old_ext != '.jsonl':
+        root = output_jsonl
+    return f"{root}.{tag}{ext}"
+
+
+def _write_jsonl(path: str, records) -> int:
+    count = 0
+    with open(path, 'w', encoding='utf-8') as fout:
+        for record in records:
+            json.dump(record, fout, ensure_ascii=False)
+            fout.write('\n')
+            count += 1
+    return count
+
+
 def process_comparison(
     asr_jsonl: str,
     ref_dir: str,
@@ -69,119 +282,132 @@ def process_comparison(
     verbose: bool = False,
     detect_ending_noise: bool = False,
     neglect_reffile_prefix: str = 'vc_',  # strip this part of the refernce file
+    spill_size: int = 0,
+    top_k_worst: int = 0,
+    histogram_bins: int = 0,
+    shard: str = '',
 ) -> None:
     """
     Compare ASR results with reference texts and output combined metrics.
 
     Args:
         asr_jsonl: Path to input ASR JSONL file
-        ref_dir: Directory containing reference text files
+        ref_dir: Directory containing reference text files, or a packed store built by ref_store.py
         output_jsonl: Path to output JSONL file
-        sort_by_similarity: Whether to sort results by word similarity (ascending)
+        sort_by_similarity: Whether to sort results by char similarity (ascending)
         min_char_sim: Minimum character similarity threshold (default: 0.5)
+        spill_size: When sorting, spill sorted runs of this many records to disk and
+            merge them at the end, so memory stays bounded (0 = sort in memory)
+        top_k_worst: Also write the k records with the lowest sim_char to output.worst.jsonl
+        histogram_bins: Print a sim_char histogram with this many bins and save it to output.hist.json
+        shard: Compare only shard i of N ("i/N"), by a hash of the reference id (as for TTS and ASR).
+            Merge the outputs and sidecars with `sharding.py merge-jsonl`.
     """
+    shard = parse_shard(shard)
 
     print(f"Processing ASR results from {asr_jsonl}")
     print(f"Using reference texts from {ref_dir}")
 
-    # Store results in memory for sorting
-    results: List[Dict[str, Any]] = []
+    # A file instead of a directory is a packed store built by ref_store.py
+    store = RefStore(ref_dir) if os.path.isfile(ref_dir) else None
+
+    log_file_deleted = sidecar_path(output_jsonl, 'deleted')
+    output_dir = os.path.dirname(os.path.abspath(output_jsonl))
+    by_sim_char = lambda x: x['sim_char']
+
+    # Without sorting, records are streamed straight to the output files
+    if sort_by_similarity:
+        results = ExternalSorter(by_sim_char, spill_size=spill_size, tmp_dir=output_dir)
+        deleted_lines = ExternalSorter(by_sim_char, spill_size=spill_size, tmp_dir=output_dir)
+        fout = fdeleted = None
+    else:
+        fout = open(output_jsonl, 'w', encoding='utf-8')
+        fdeleted = open(log_file_deleted, 'w', encoding='utf-8')
+    worst = TopK(top_k_worst, by_sim_char) if top_k_worst > 0 else None
+    histogram = Histogram(histogram_bins) if histogram_bins > 0 else None
 
     # Process all files
-    deleted_lines = []
+    kept_count = 0
+    deleted_count = 0
     found_trailing_invalid = 0
-    with open(asr_jsonl, 'r', encoding='utf-8') as fin:
+    # The store's mmap is closed when the loop ends, also on errors
+    with open(asr_jsonl, 'r', encoding='utf-8') as fin, store if store is not None else contextlib.nullcontext():
         for line in fin:
             asr_result = json.loads(line)
             wav_name = asr_result['filename']
             asr_text = asr_result['text']
 
-            txt_name = wav_name.replace('.wav', '.txt')
-            if neglect_reffile_prefix:
-                txt_name = txt_name.replace(neglect_reffile_prefix, '')
-            txt_path = os.path.join(ref_dir, txt_name)
-            sim_char = 0.0
-
-            try:
-                with open(txt_path, 'r', encoding='utf-8') as fref:
-                    ref_text = fref.read().strip()
-
-                    # Purify reference text
-                    ref_text, is_valid = purify_reference(ref_text)
-                    ca = clean_text(asr_text)
-                    cr = clean_text(ref_text)
-
-                    if not is_valid:
-                        if verbose:
-                            print(f"Warning: Invalid characters in reference text for {wav_name}")
-                        sim_word = 0.0
-                        sim_char = 0.0
-                    elif (ca.startswith(cr) and not cr.startswith(ca)) and detect_ending_noise:
-                        print(f"[{wav_name}] Warning: ASR detects MORE at end of reference!", ca[:-len(cr)], ' || ', cr)
-                        sim_word = 0.0
-                        sim_char = 0.0
-                        found_trailing_invalid += 1
-                    elif "my name is" in ref_text:
-                        sim_word = 0.0
-                        sim_char = 0.0
-                        # remove personality
-                    else:
-                        sim_word = jaccard_similarity(get_words(asr_text), get_words(ref_text))
-                        sim_char = jaccard_similarity(get_chars_bigram(asr_text), get_chars_bigram(ref_text))
-            except FileNotFoundError:
-                print(f"Warning: Reference file not found: {txt_path}")
+            ref_id = ref_id_from_wav(wav_name, neglect_reffile_prefix)
+            if not in_shard(ref_id, shard):
                 continue
+            if store is not None:
+                ref_text = store.get(ref_id)
+                if ref_text is None:
+                    print(f"Warning: Reference not found in store: {ref_id}")
+                    continue
+            else:
+                txt_path = os.path.join(ref_dir, ref_id + '.txt')
+                try:
+                    with open(txt_path, 'r', encoding='utf-8') as fref:
+                        ref_text = fref.read()
+                except FileNotFoundError:
+                    print(f"Warning: Reference file not found: {txt_path}")
+                    continue
+
+            scores, trailing_noise = score_pair(
+                asr_text, ref_text.strip(), detect_ending_noise=detect_ending_noise, verbose=verbose, name=wav_name)
+            found_trailing_invalid += trailing_noise
+            result = {**asr_result, **scores}
+
+            if worst is not None:
+                worst.add(result)
+            if histogram is not None:
+                histogram.add(result['sim_char'])
 
             # Apply character similarity filter
-            result = {
-                **asr_result,
-                'reference_text': ref_text,
-                'sim_word': sim_word,
-                'sim_char': sim_char,
-                'is_valid_reference': is_valid,
-            }
-
-            if sim_char >= min_char_sim:
-                if sim_char < min_char_sim_for_short_lines and len(ref_text) < 16:
-                    deleted_lines.append(result)
-                    continue  # Skip short references with low similarity
-                results.append(result)
+            if is_kept(result, min_char_sim, min_char_sim_for_short_lines):
+                kept_count += 1
+                if fout is None:
+                    results.add(result)
+                else:
+                    json.dump(result, fout, ensure_ascii=False)
+                    fout.write('\n')
                 if verbose:
-                    print(f"Processed {wav_name}: word_sim={sim_word:.3f}, char_sim={sim_char:.3f}")
+                    print(f"Processed {wav_name}: word_sim={result['sim_word']:.3f}, char_sim={result['sim_char']:.3f}, wer={result['wer']:.3f}")
             else:
-                deleted_lines.append(result)
-
-    # Sort results if requested
+                deleted_count += 1
+                if fdeleted is None:
+                    deleted_lines.add(result)
+                else:
+                    json.dump(result, fdeleted, ensure_ascii=False)
+                    fdeleted.write('\n')
+
+    # Write filtered and sorted results
     if sort_by_similarity:
-        results.sort(key=lambda x: x['sim_char'])
-        deleted_lines.sort(key=lambda x: x['sim_char'])
-
-    # Write filtered and optionally sorted results
-    with open(output_jsonl, 'w', encoding='utf-8') as fout:
-        for result in results:
-            json.dump(result, fout, ensure_ascii=False)
-            fout.write('\n')
-            fout.flush()
-
-    # Write filtered and optionally sorted results
-    if '.jsonl' in output_jsonl:
-        log_file_deleted = output_jsonl.replace('.jsonl', '.deleted.jsonl')
+        _write_jsonl(output_jsonl, results)
+        _write_jsonl(log_file_deleted, deleted_lines)
     else:
-        log_file_deleted = output_jsonl + '.deleted.jsonl'
+        fout.close()
+        fdeleted.close()
 
-    with open(log_file_deleted, 'w', encoding='utf-8') as fout:
-        for result in deleted_lines:
-            json.dump(result, fout, ensure_ascii=False)
-            fout.write('\n')
-            fout.flush()
-
-    print(f"\nProcessing complete. Wrote {len(results)} results to {output_jsonl}")
+    print(f"\nProcessing complete. Wrote {kept_count} results to {output_jsonl}")
     print(f"Found {found_trailing_invalid} trailing invalid characters in ASR results.")
-    print(f"Filtered out {len(deleted_lines)} results with char_sim < {min_char_sim}")
-    print(f"Wrote deleted {len(deleted_lines)} results to {log_file_deleted}")
+    print(f"Filtered out {deleted_count} results with char_sim < {min_char_sim}")
+    print(f"Wrote deleted {deleted_count} results to {log_file_deleted}")
+
+    if worst is not None:
+        worst_file = sidecar_path(output_jsonl, 'worst')
+        _write_jsonl(worst_file, worst.sorted())
+        print(f"Wrote {min(top_k_worst, worst.count)} lowest sim_char results to {worst_file}")
+
+    if histogram is not None:
+        hist_file = sidecar_path(output_jsonl, 'hist', '.json')
+        with open(hist_file, 'w', encoding='utf-8') as f:
+            json.dump({'sim_char': histogram.as_dict()}, f, indent=2)
+        histogram.print(f"sim_char histogram (saved to {hist_file}):")
 
 if __name__ == "__main__":
-    argh.dispatch_command(process_comparison)
+    profiling.dispatch_command(process_comparison)
 
 """
 Usage examples:
@@ -194,6 +420,9 @@ python batch_compare_asr_ref.py input.jsonl ref_dir output.jsonl
 # Sort by similarity and custom filter
 python batch_compare_asr_ref.py input.jsonl ref_dir output.jsonl --sort-by-similarity --min-char-sim=0.7
 
+# Large runs: sort with bounded memory, plus the 200 worst pairs and a histogram for review
+python batch_compare_asr_ref.py input.jsonl ref_dir output.jsonl --sort-by-similarity --spill-size=50000 --top-k-worst=200 --histogram-bins=20
+
 # Example with actual paths:
 python batch\batch_compare_asr_ref.py .\OUTPUT-chirp3-all-wavs-aoede-asr.jsonl OUTPUT-chirp3-all-txts-aoede OUTPUT-chirp3-all-wavs-aoede-asrcompare.jsonl --sort-by-similarity
 """
\ No newline at end of file
@@ -0,0 +1,217 @@
+import contextlib
+import datetime
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import profiling
+import fake_google
+from llm_stub_server import StubConfig
+
+# Script name -> (stage, api) in stage_metrics.METRICS whose latency is reported
+SCRIPTS = {
+    'tts': ('tts', 'tts'),  # run_chirp3_tts_batch.batch
+    'asr': ('asr', 'speech'),  # run_cloud_asr_batch_1speaker.batch
+    'diarization': ('asr', 'speech'),  # run_cloud_asr_batch_speaker_diarization.batch
+    'asr_parallel': ('asr', 'speech'),  # batch_asr_parallel.process_folder
+    'pipeline': ('asr', 'speech'),  # pipeline.run_pipeline
+}
+
+
+def write_inputs(work_dir, num_files):
+    """Sentences for TTS, paragraphs for the pipeline and fake TTS wavs for the ASR scripts."""
+    sentences = [f"This is benchmark sentence number {i}, about the weather and the news today." for i in range(num_files)]
+    sentences_file = os.path.join(work_dir, 'sentences.txt')
+    with open(sentences_file, 'w', encoding='utf-8') as f:
+        f.writelines(s + '\n' for s in sentences)
+    paragraphs_file = os.path.join(work_dir, 'paragraphs.txt')
+    with open(paragraphs_file, 'w', encoding='utf-8') as f:
+        for i in range(0, num_files, 4):
+            f.write(f"topic {i}:\t{' '.join(sentences[i:i + 4])}\n")
+    wav_dir = os.path.join(work_dir, 'wavs')
+    os.makedirs(wav_dir, exist_ok=True)
+    for i, sentence in enumerate(sentences):
+        with open(os.path.join(wav_dir, f"chrp{i:04d}.wav"), 'wb') as f:
+            f.write(fake_google.synthesize_wav(sentence))
+    return sentences_file, paragraphs_file, wav_dir
+
+
+def _count_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def run_once(script, run_dir, inputs, workers):
+    """Run one script in-process against the fakes; returns the number of files it produced."""
+    sentences_file, paragraphs_file, wav_dir = inputs
+    if script == 'tts':
+        import run_chirp3_tts_batch
+        run_chirp3_tts_batch.batch(sentences_file, run_dir)
+        return sum(name.endswith('.wav') for name in os.listdir(run_dir))
+    if script == 'asr':
+        import run_cloud_asr_batch_1speaker
+        output_file = os.path.join(run_dir, 'asr.txt')
+        run_cloud_asr_batch_1speaker.batch(wav_dir, output_file)
+        return _count_lines(output_file)
+    if script == 'diarization':
+        import run_cloud_asr_batch_speaker_diarization
+        output_file = os.path.join(run_dir, 'asr.txt')
+        run_cloud_asr_batch_speaker_diarization.batch(wav_dir, output_file)
+        return len({line.split('\t')[0] for line in open(output_file, encoding='utf-8') if line.strip()})
+    if script == 'asr_parallel':
+        import batch_asr_parallel
+        output_json = os.path.join(run_dir, 'asr.jsonl')
+        batch_asr_parallel.process_folder(wav_dir, output_json, num_processes=workers)
+        return sum(not json.loads(line)['text'].startswith('ERROR:') for line in open(output_json, encoding='utf-8'))
+    import pipeline
+    pipeline.run_pipeline(paragraphs_file, run_dir, tts_workers=workers, asr_workers=workers * 2, do_unique=False,
+                          report_every=3600)
+    return _count_lines(os.path.join(run_dir, 'asrcompare.jsonl'))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_previous(history, params):
+    """Results of the last run in the history file with the same parameters, by script."""
+    previous = None
+    if history and os.path.exists(history):
+        with open(history, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['params'] == params:
+                    previous = entry
+    return {r['script']: r for r in previous['results']} if previous else {}
+
+
+def bench(scripts='tts,asr,diarization,asr_parallel,pipeline', num_files=40, rounds=3, workers=4, latency='lognormal',
+          tts_latency_ms=200.0, speech_latency_ms=300.0, gcs_latency_ms=20.0, latency_sigma=0.4, error_rate=0.0,
+          word_error_rate=0.0, seed=0, use_quota=False, history='bench-cloud-history.jsonl', tolerance=0.15,
+          json_out=None, verbose=False):
+    """
+    Benchmark the TTS / ASR batch scripts end to end against fake Google services (fake_google.py).
+
+    No credentials or spend: the fakes are installed in-process, each script runs on
+    num_files synthetic inputs for several rounds, and the median round is reported:
+    files/s (output files per wall second) and p50/p99 latency per file or API call as
+    tracked by stage_metrics. API calls are counted in this process only, so they are 0 for
+    asr_parallel, whose workers are processes. tests/test_bench_cloud.py asserts floors on
+    files/s and p99 for every script.
+
+    Each run is appended to the history file with the git revision. Results are compared
+    with the last run of the same parameters; a script whose files/s dropped, or whose p99
+    rose, by more than tolerance is a regression, and the exit status is 1.
+
+    Args:
+        scripts (str): Comma-separated scripts: tts, asr (1 speaker), diarization, asr_parallel, pipeline.
+        num_files (int): Sentences / wavs per run.
+        rounds (int): Runs per script; the median is reported.
+        workers (int): Processes of asr_parallel; TTS workers of the pipeline (ASR gets twice as many).
+        latency, tts_latency_ms, speech_latency_ms, gcs_latency_ms, latency_sigma, error_rate,
+            word_error_rate, seed: Behaviour of the fakes, see fake_google.py.
+        use_quota (bool): Keep the host-wide quota_governor limits (off: the fakes are not throttled).
+        history (str): JSONL file of past runs ('' = do not record or compare).
+        tolerance (float): Relative change counted as a regression.
+        json_out (str): Also write this run's results to this JSON file.
+        verbose (bool): Show the scripts' own output.
+    """
+    params = dict(num_files=num_files, workers=workers, latency=latency, tts_latency_ms=tts_latency_ms,
+                  speech_latency_ms=speech_latency_ms, gcs_latency_ms=gcs_latency_ms, latency_sigma=latency_sigma,
+                  error_rate=error_rate, word_error_rate=word_error_rate, seed=seed)
+    fake = fake_google.install(
+        tts=StubConfig(latency, tts_latency_ms, latency_sigma, error_rate, 0.0, 0, seed),
+        speech=StubConfig(latency, speech_latency_ms, latency_sigma, error_rate, 0.0, 0, seed + 1),
+        gcs=StubConfig(latency, gcs_latency_ms, latency_sigma, error_rate, 0.0, 0, seed + 2),
+        word_error_rate=word_error_rate)
+    from stage_metrics import METRICS
+    previous = load_previous(history, params)
+    results = []
+    regressions = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        if not use_quota:
+            import quota_governor
+            quota_governor._governor = quota_governor.QuotaGovernor({}, os.path.join(work_dir, 'quota'))
+        inputs = write_inputs(work_dir, num_files)
+        print(f"{'script':<14}{'files':>7}{'files/s':>10}{'p50 s':>9}{'p99 s':>9}{'api calls':>11}{'errors':>8}  vs previous")
+        for script in scripts.split(','):
+            if script not in SCRIPTS:
+                raise ValueError(f"Unknown script {script!r}, expected one of {tuple(SCRIPTS)}")
+            runs = []
+            for round_idx in range(rounds):
+                run_dir = os.path.join(work_dir, f"{script}-{round_idx}")
+                os.makedirs(run_dir)
+                METRICS.reset()
+                fake.reset()
+                log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+                start = time.monotonic()
+                try:
+                    with log:
+                        files = run_once(script, run_dir, inputs, workers)
+                except ImportError as e:
+                    print(f"{script:<14}skipped: {e}")
+                    break
+                elapsed = time.monotonic() - start
+                stats = METRICS.stage(*SCRIPTS[script])
+                api_stats = fake.stats()
+                runs.append({
+                    'script': script,
+                    'files': files,
+                    'elapsed': elapsed,
+                    'files_per_sec': files / elapsed if elapsed else 0.0,
+                    'p50': stats.percentile(50),
+                    'p99': stats.percentile(99),
+                    'api_calls': sum(s['requests'] for s in api_stats.values()),
+                    'api_errors': sum(s['errors'] + s['rate_limited'] for s in api_stats.values()),
+                })
+            if not runs:
+                continue
+            result = dict(sorted(runs, key=lambda r: r['files_per_sec'])[len(runs) // 2])
+            result['rounds_files_per_sec'] = [r['files_per_sec'] for r in runs]
+            result['stdev_files_per_sec'] = statistics.pstdev(result['rounds_files_per_sec'])
+            results.append(result)
+
+            comparison = ''
+            before = previous.get(script)
+            if before:
+                speed = result['files_per_sec'] / before['files_per_sec'] - 1 if before['files_per_sec'] else 0.0
+                tail = result['p99'] / before['p99'] - 1 if before['p99'] else 0.0
+                comparison = f"files/s {speed:+.1%}, p99 {tail:+.1%} (at {before.get('revision') or '?'})"
+                if speed < -tolerance or tail > tolerance:
+                    regressions.append(script)
+                    comparison += '  REGRESSION'
+            print(f"{script:<14}{result['files']:>7}{result['files_per_sec']:>10.2f}{result['p50']:>9.3f}{result['p99']:>9.3f}"
+                  f"{result['api_calls']:>11}{result['api_errors']:>8}  {comparison}")
+
+    revision = git_revision()
+    for result in results:
+        result['revision'] = revision
+    if history:
+        with open(history, 'a', encoding='utf-8') as f:
+            entry = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': revision,
+                     'params': params, 'results': results}
+            f.write(json.dumps(entry) + '\n')
+        print(f"Appended results to {history}")
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote results to {json_out}")
+    if regressions:
+        print(f"Regressions (beyond {tolerance:.0%}): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(bench)
+
+# python bench_cloud.py
+# python bench_cloud.py --scripts tts,pipeline --num-files 200 --error-rate 0.02 --word-error-rate 0.05
@@ -0,0 +1,191 @@
+import contextlib
+import io
+import json
+import math
+import os
+import tempfile
+import time
+
+import profiling
+import openai
+import rewrite_chatting_style
+import rewrite_paragraphs
+from llm_stub_server import StubConfig, start_server
+from rewrite_chatting_style import percentile
+from run_journal import RunJournal
+
+SCRIPTS = ('chatting', 'paragraphs')
+
+
+class CallTimer:
+    """Records the wall time of every ChatCompletion call (successful or not) made while active."""
+
+    def __init__(self):
+        self.latencies = []
+
+    def __enter__(self):
+        self._create = openai.ChatCompletion.create
+        self._acreate = openai.ChatCompletion.acreate
+        create, acreate, latencies = self._create, self._acreate, self.latencies
+
+        def timed_create(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return create(*args, **kwargs)
+            finally:
+                latencies.append(time.monotonic() - start)
+
+        async def timed_acreate(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return await acreate(*args, **kwargs)
+            finally:
+                latencies.append(time.monotonic() - start)
+
+        openai.ChatCompletion.create = timed_create
+        openai.ChatCompletion.acreate = timed_acreate
+        return self
+
+    def __exit__(self, *exc):
+        openai.ChatCompletion.create = self._create
+        openai.ChatCompletion.acreate = self._acreate
+
+
+def write_inputs(work_dir, num_paragraphs, num_topics):
+    """Synthetic inputs for both scripts: topic\tparagraph lines, filename\tparagraph lines and a topics file."""
+    paragraphs = [f"This is paragraph number {i}. It talks about the weather, the news and a few other things "
+                  f"that happened today, in about as many words as a real paragraph would have." for i in range(num_paragraphs)]
+    chatting_input = os.path.join(work_dir, 'chatting-input.txt')
+    with open(chatting_input, 'w', encoding='utf-8') as f:
+        for i, para in enumerate(paragraphs):
+            f.write(f"topic {i}:\t{para}\n")
+    paragraphs_input = os.path.join(work_dir, 'paragraphs-input.txt')
+    with open(paragraphs_input, 'w', encoding='utf-8') as f:
+        for i, para in enumerate(paragraphs):
+            f.write(f"recording-{i % 10}.wav\t{para}\n")
+    topics_file = os.path.join(work_dir, 'topics.txt')
+    with open(topics_file, 'w', encoding='utf-8') as f:
+        for i in range(num_topics):
+            f.write(f"benchmark topic {i}\n")
+    return chatting_input, paragraphs_input, topics_file
+
+
+def run_once(script, concurrency, work_dir, inputs, base_url, key_path, model, pack_size, num_topics, resample_per_topic,
+             rpm, tpm, rate_limit_defaults, verbose):
+    """
+    Run one rewrite script against the stub.
+
+    Returns:
+        (output lines, items done, elapsed seconds, call latencies); items are paragraphs
+        for chatting and topics for paragraphs, as counted by the script's run journal.
+    """
+    chatting_input, paragraphs_input, topics_file = inputs
+    output_file = os.path.join(work_dir, f"{script}-c{concurrency}.txt")
+    common = dict(model=model, key_path=key_path, base_url=base_url, cache_mode='off', concurrency=concurrency, fresh=True,
+                  rpm=rpm, tpm=tpm, rate_limit_defaults=rate_limit_defaults)
+    log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.monotonic()
+    with CallTimer() as timer, log:
+        if script == 'chatting':
+            rewrite_chatting_style.rewrite_paragraphs(chatting_input, output_file, pack_size=pack_size, **common)
+        else:
+            rewrite_paragraphs.rewrite_paragraphs(paragraphs_input, output_file, candidate_topics=topics_file, limit=num_topics,
+                                                  resample_per_topic=resample_per_topic, **common)
+    elapsed = time.monotonic() - start
+    with open(output_file, 'r', encoding='utf-8') as f:
+        lines = sum(1 for line in f if line.strip())
+    journal = RunJournal(output_file + '.journal.jsonl')
+    items = sum(1 for status in journal.status.values() if status == 'done')
+    journal.close()
+    return lines, items, elapsed, timer.latencies
+
+
+def bench(scripts='chatting,paragraphs', concurrency='1,4,16,64', num_paragraphs=200, num_topics=50, resample_per_topic=3,
+          pack_size=1, model='gpt-4.1-mini', rpm=0, tpm=0, rate_limit_defaults=False, latency='lognormal', latency_ms=300.0, latency_sigma=0.5,
+          error_rate=0.0, rate_limit_rate=0.0, stub_rpm=0, seed=0, json_out=None, verbose=False):
+    """
+    Benchmark the rewrite scripts against a local OpenAI-compatible stub (llm_stub_server.py).
+
+    No tokens are spent: both scripts run in-process with --base-url pointing at the stub,
+    the cache off and a fresh journal, once per concurrency level. There is no client-side
+    RPM/TPM limit unless rpm, tpm or rate_limit_defaults is given, so the runs measure
+    concurrency rather than the scheduler.
+
+    Reported per run: items/s (paragraphs rewritten by chatting, topics generated by
+    paragraphs; the units differ, so compare runs of the same script), output lines/s,
+    p50/p99 latency of the API calls as seen by the client, and wasted calls, i.e. calls
+    beyond the minimum the input needs (errors, 429s, retries and packed answers that fell
+    back to single requests).
+
+    Args:
+        scripts (str): Comma-separated scripts to run: chatting (rewrite_chatting_style.py),
+            paragraphs (rewrite_paragraphs.py).
+        concurrency (str): Comma-separated concurrency levels.
+        num_paragraphs (int): Paragraphs in the synthetic input.
+        num_topics (int): Topics generated by rewrite_paragraphs.py.
+        resample_per_topic (int): Completions per topic for rewrite_paragraphs.py.
+        pack_size (int): Paragraphs per request for rewrite_chatting_style.py.
+        model (str): Model name sent to the stub; selects the default RPM/TPM limits of rate_limit_defaults.
+        rpm (int): Client-side requests per minute (0 = no client-side limit).
+        tpm (int): Client-side tokens per minute (0 = no client-side limit).
+        rate_limit_defaults (bool): Benchmark with the model's default RPM/TPM (see rate_limiter.py).
+        latency, latency_ms, latency_sigma, error_rate, rate_limit_rate, seed: Stub behaviour, see llm_stub_server.py.
+        stub_rpm (int): Requests per minute enforced by the stub (0 = unlimited).
+        json_out (str): Also write the results to this JSON file.
+        verbose (bool): Show the scripts' own output.
+    """
+    config = StubConfig(latency, latency_ms, latency_sigma, error_rate, rate_limit_rate, stub_rpm, seed)
+    server = start_server(config=config)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        key_path = os.path.join(work_dir, 'key.txt')
+        with open(key_path, 'w') as f:
+            f.write('stub-key')
+        inputs = write_inputs(work_dir, num_paragraphs, num_topics)
+        print(f"{'script':<12}{'concurrency':>12}{'items':>8}{'items/s':>9}{'lines':>8}{'lines/s':>9}{'p50 s':>9}{'p99 s':>9}"
+              f"{'calls':>8}{'wasted':>8}{'429s':>6}{'500s':>6}")
+        for script in scripts.split(','):
+            if script not in SCRIPTS:
+                raise ValueError(f"Unknown script {script!r}, expected one of {SCRIPTS}")
+            min_calls = math.ceil(num_paragraphs / pack_size) if script == 'chatting' else num_topics * resample_per_topic
+            for level in (int(c) for c in concurrency.split(',')):
+                server.stats.reset()
+                lines, items, elapsed, latencies = run_once(script, level, work_dir, inputs, server.base_url, key_path, model,
+                                                            pack_size, num_topics, resample_per_topic, rpm, tpm,
+                                                            rate_limit_defaults, verbose)
+                stub_stats = server.stats.to_dict()
+                result = {
+                    'script': script,
+                    'concurrency': level,
+                    'items': items,
+                    'lines': lines,
+                    'elapsed': elapsed,
+                    'items_per_sec': items / elapsed if elapsed else 0.0,
+                    'lines_per_sec': lines / elapsed if elapsed else 0.0,
+                    'p50': percentile(latencies, 50),
+                    'p99': percentile(latencies, 99),
+                    'calls': stub_stats['requests'],
+                    'wasted_calls': max(0, stub_stats['requests'] - min_calls),
+                    'rate_limited': stub_stats['rate_limited'],
+                    'errors': stub_stats['errors'],
+                    'prompt_tokens': stub_stats['prompt_tokens'],
+                    'completion_tokens': stub_stats['completion_tokens'],
+                }
+                results.append(result)
+                print(f"{script:<12}{level:>12}{items:>8}{result['items_per_sec']:>9.2f}{lines:>8}{result['lines_per_sec']:>9.2f}"
+                      f"{result['p50']:>9.3f}{result['p99']:>9.3f}{result['calls']:>8}{result['wasted_calls']:>8}{result['rate_limited']:>6}"
+                      f"{result['errors']:>6}")
+    server.shutdown()
+    server.server_close()
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote results to {json_out}")
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(bench)
+
+# python bench_rewrite.py
+# python bench_rewrite.py --scripts chatting --concurrency 8,32 --pack-size 4 --error-rate 0.02 --stub-rpm 1200 --rpm 1000
+# python bench_rewrite.py --scripts chatting --concurrency 1,16,64 --rate-limit-defaults
@@ -1,6 +1,11 @@
 import codecs
-import argh
-import re
+import hashlib
+import os
+import sqlite3
+from multiprocessing import Pool
+import profiling
+from text_normalize import SENTENCE_END_RE, CLAUSE_BREAK_RE
+from near_dedup import NearDuplicateFilter
 
 def split_into_sentences(text):
     """
@@ -16,7 +21,7 @@ def split_into_sentences(text):
     text = text.replace('...', '<ELLIPSIS>')
 
     # Split on sentence endings followed by space or end of string
-    sentences = re.split('([.!?](?:\s|$))', text)
+    sentences = SENTENCE_END_RE.split(text)
 
     # Rejoin sentences with their endings and clean up
     sentences = [''.join(i) for i in zip(sentences[0::2], sentences[1::2] + [''] * (len(sentences[0::2]) - len(sentences[1::2])))]
@@ -26,7 +31,206 @@ def split_into_sentences(text):
 
     return sentences
 
-def chunk_sentences(input_file, output_file, verbose=False, keep_topic=False, do_unique=True):
+# Approximate speaking rate in characters per second, by language code prefix
+CHARS_PER_SECOND = {
+    'en': 15.0, 'de': 14.0, 'fr': 14.5, 'es': 15.5, 'it': 15.0, 'pt': 15.0, 'nl': 14.5,
+    'pl': 13.5, 'ru': 13.5, 'tr': 13.5, 'id': 14.5, 'vi': 11.0, 'hi': 12.0, 'ar': 12.0,
+    'th': 10.0, 'ja': 7.5, 'ko': 6.5, 'zh': 4.5, 'cmn': 4.5,
+}
+DEFAULT_CHARS_PER_SECOND = 15.0
+ELLIPSIS_PAUSE_SECONDS = 0.4
+
+
+def estimate_duration(sentence, language='en'):
+    """Estimated spoken duration in seconds of a sentence."""
+    cps = CHARS_PER_SECOND.get(language.split('-')[0].lower(), DEFAULT_CHARS_PER_SECOND)
+    return len(sentence) / cps + sentence.count('...') * ELLIPSIS_PAUSE_SECONDS
+
+
+def split_long_sentence(sentence, max_duration, language='en'):
+    """
+    Split a sentence that is longer than max_duration at clause boundaries
+    (commas, ellipses, dashes), falling back to word boundaries.
+    """
+    if estimate_duration(sentence, language) <= max_duration:
+        return [sentence]
+
+    pieces = []
+    for clause in CLAUSE_BREAK_RE.split(sentence):
+        if estimate_duration(clause, language) <= max_duration:
+            pieces.append(clause)
+        else:
+            pieces.extend(clause.split())
+
+    # Greedily re-join the pieces up to max_duration
+    parts = []
+    current = ''
+    for piece in pieces:
+        candidate = f"{current} {piece}" if current else piece
+        if current and estimate_duration(candidate, language) > max_duration:
+            parts.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+def pack_sentences(sentences, min_duration, max_duration, language='en'):
+    """
+    Greedily merge consecutive sentences until they reach min_duration, without exceeding
+    max_duration; sentences longer than max_duration are split first.
+
+    Sentences are only joined at their boundaries, so ellipses and punctuation are kept.
+    """
+    units = []
+    current = []
+    for sentence in sentences:
+        for part in split_long_sentence(sentence, max_duration, language):
+            if current and estimate_duration(' '.join(current + [part]), language) > max_duration:
+                units.append(' '.join(current))
+                current = []
+            current.append(part)
+            if estimate_duration(' '.join(current), language) >= min_duration:
+                units.append(' '.join(current))
+                current = []
+    if current:
+        # Leftover shorter than min_duration: attach to the previous unit if it fits
+        tail = ' '.join(current)
+        if units and estimate_duration(f"{units[-1]} {tail}", language) <= max_duration:
+            units[-1] = f"{units[-1]} {tail}"
+        else:
+            units.append(tail)
+    return units
+
+
+class DurationHistogram:
+    """
+    1-second histogram of estimated sentence durations plus totals, for sizing TTS batches.
+
+    Only the bucket counts and running sums are kept, so memory does not grow with the corpus.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.total_chars = 0
+
+    def add(self, duration, num_chars):
+        self.buckets[int(duration)] = self.buckets.get(int(duration), 0) + 1
+        self.count += 1
+        self.total += duration
+        self.total_chars += num_chars
+
+    def print(self):
+        if not self.count:
+            print("No sentences written")
+            return
+        peak = max(self.buckets.values())
+        print("Estimated duration histogram (seconds):")
+        for sec in range(min(self.buckets), max(self.buckets) + 1):
+            count = self.buckets.get(sec, 0)
+            print(f"  {sec:3d}-{sec + 1:<3d} {count:8d}  {'#' * int(50 * count / peak)}")
+        print(f"{self.count} sentences, {self.total_chars} characters, "
+              f"~{self.total / 3600:.2f} hours of audio (mean {self.total / self.count:.1f}s)")
+
+
+def fingerprint(sentence):
+    """Stable signed 64-bit fingerprint of a sentence, used for exact dedup."""
+    digest = hashlib.blake2b(sentence.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class SeenSentences:
+    """
+    Set of sentence fingerprints, kept in memory or in a SQLite file.
+
+    Storing 64-bit fingerprints instead of the sentences keeps memory flat for large
+    corpora; with db_path the set lives on disk and memory does not grow at all.
+    """
+
+    def __init__(self, db_path=None):
+        self._conn = None
+        self._seen = set()
+        if db_path:
+            self._conn = sqlite3.connect(db_path)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS seen (fp INTEGER PRIMARY KEY)')
+            self._conn.execute('DELETE FROM seen')
+
+    def add(self, sentence):
+        """Remember the sentence; return True if it was not seen before."""
+        fp = fingerprint(sentence)
+        if self._conn is not None:
+            return self._conn.execute('INSERT OR IGNORE INTO seen VALUES (?)', (fp,)).rowcount == 1
+        if fp in self._seen:
+            return False
+        self._seen.add(fp)
+        return True
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+
+
+def chunk_line(line, verbose=False, packing=None):
+    """
+    Split one "topic<TAB>paragraph" input line into sentences.
+
+    If packing is given as (min_duration, max_duration, language), the sentences of
+    the paragraph are packed with pack_sentences.
+
+    Returns:
+        (topic, sentences), or None for empty and invalid lines
+    """
+    line = line.strip()
+    if not line:
+        return None
+
+    parts = line.split('\t')
+    if len(parts) != 2:
+        if verbose:
+            print(f"Skipping invalid line: {line}")
+        return None
+
+    topic, content = parts
+    topic = topic.split(':')[0]  # Remove any colons from topic
+    sentences = split_into_sentences(content)
+    if packing:
+        sentences = pack_sentences(sentences, *packing)
+    return topic, sentences
+
+
+def byte_ranges(input_file, shard_bytes):
+    """Split a file into (start, end) byte ranges of about shard_bytes, cut at newlines."""
+    size = os.path.getsize(input_file)
+    ranges = []
+    with open(input_file, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + shard_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _chunk_shard(args):
+    """Worker: chunk all lines of one byte range of the input file."""
+    input_file, start, end, packing, verbose = args
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    chunked_lines = (chunk_line(line, verbose, packing) for line in text.splitlines())
+    return [chunked for chunked in chunked_lines if chunked is not None]
+
+
+def chunk_sentences(input_file, output_file, verbose=False, keep_topic=False, do_unique=True, near_dup_threshold=0.0,
+                    num_workers=0, shard_mb=16, seen_db=None,
+                    min_duration=0.0, max_duration=0.0, language='en', histogram=False):
     """
     Chunks paragraphs into sentences while preserving the topic column.
 
@@ -34,39 +238,71 @@ def chunk_sentences(input_file, output_file, verbose=False, keep_topic=False, do
         input_file (str): Path to the input text file containing topic-paragraph pairs
         output_file (str): Path to the output text file to save chunked sentences
         verbose (bool): If True, print debug information
+        near_dup_threshold (float): If > 0, also drop sentences whose character-bigram
+            Jaccard similarity to an earlier sentence reaches this value (see near_dedup.py)
+        num_workers (int): If > 0, split the input into byte-range shards of shard_mb and
+            chunk them in this many worker processes. Output order is the same as with 0.
+        shard_mb (int): Shard size in MB for num_workers > 0
+        seen_db (str): Keep the dedup fingerprints in this SQLite file instead of memory
+        min_duration (float): With max_duration, merge sentences of a paragraph until their
+            estimated spoken duration reaches this many seconds
+        max_duration (float): If > 0, pack sentences into units of at most this many seconds,
+            splitting longer sentences at clause or word boundaries
+        language (str): Language code for the chars-per-second duration estimate
+        histogram (bool): Print the estimated duration histogram (always printed when packing)
     """
-    with codecs.open(output_file, 'w', encoding='utf-8') as fout:
-        visited = set()
-        for line in codecs.open(input_file, 'r', encoding='utf-8'):
-            line = line.strip()
-            if not line:
-                continue
-
-            parts = line.split('\t')
-            if len(parts) != 2:
-                if verbose:
-                    print(f"Skipping invalid line: {line}")
-                continue
-
-            topic, content = parts
-            topic = topic.split(':')[0]  # Remove any colons from topic
+    packing = (min_duration, max_duration, language) if max_duration > 0 else None
+    durations = DurationHistogram() if packing or histogram else None
+    near_dedup = NearDuplicateFilter(threshold=near_dup_threshold) if near_dup_threshold > 0 else None
+    visited = SeenSentences(seen_db)
 
-            sentences = split_into_sentences(content)
+    if num_workers > 0:
+        ranges = [(input_file, start, end, packing, verbose) for start, end in byte_ranges(input_file, shard_mb * 1024 * 1024)]
+        pool = Pool(processes=num_workers)
+        # imap keeps shard order, so dedup sees sentences in the same order as a single process
+        chunked_lines = (chunked for shard in pool.imap(_chunk_shard, ranges) for chunked in shard)
+    else:
+        pool = None
+        chunked_lines = (chunk_line(line, verbose, packing) for line in codecs.open(input_file, 'r', encoding='utf-8'))
 
-            for sentence in sentences:
-                sent = sentence.strip()
-                # Check for uniqueness
-                if do_unique and sent in visited:
+    try:
+        with codecs.open(output_file, 'w', encoding='utf-8') as fout:
+            for chunked in chunked_lines:
+                if chunked is None:
                     continue
-                if sent:  # Only write non-empty sentences
-                    visited.add(sent)
+                topic, sentences = chunked
+
+                for sentence in sentences:
+                    sent = sentence.strip()
+                    if not sent:  # Only write non-empty sentences
+                        continue
+                    # Check for uniqueness
+                    if do_unique and not visited.add(sent):
+                        continue
+                    if near_dedup is not None and near_dedup.is_duplicate(sent):
+                        continue
                     if keep_topic:
                         print(f"{topic}\t{sent}", file=fout)
                     else:
                         print(sent, file=fout)
+                    if durations is not None:
+                        durations.add(estimate_duration(sent, language), len(sent))
+
+                if verbose:
+                    print(f"Processed topic: {topic} - Split into {len(sentences)} sentences")
+    except BaseException:
+        if pool is not None:
+            pool.terminate()  # stop the workers instead of leaving them chunking the rest of the input
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    visited.close()
 
-            if verbose:
-                print(f"Processed topic: {topic} - Split into {len(sentences)} sentences")
+    if near_dedup is not None:
+        print(f"Dropped {near_dedup.dropped} near-duplicate sentences")
+    if durations is not None:
+        durations.print()
 
 if __name__ == "__main__":
-    argh.dispatch_command(chunk_sentences)
+    profiling.dispatch_command(chunk_sentences)
@@ -0,0 +1,256 @@
+import itertools
+import json
+import mmap
+import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import profiling
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # JSONL manifests still work without pyarrow
+    pa = pq = None
+
+# Chirp 3 HD voices; run_chirp3_tts_batch.py writes each voice to a subdirectory named after it
+CHIRP3_VOICES = ('Aoede', 'Puck', 'Charon', 'Kore', 'Fenrir', 'Leda', 'Orus', 'Zephyr')
+
+# Suffix of the packed audio blob written next to the manifest
+AUDIO_BLOB_SUFFIX = '.audio.bin'
+
+ROW_GROUP_SIZE = 65536
+
+COLUMNS = [
+    ('id', 'string'),
+    ('path', 'string'),  # relative to the manifest directory; empty when the audio is packed
+    ('audio_offset', 'int64'),  # byte offset of the PCM frames in the packed blob (-1 = not packed)
+    ('audio_bytes', 'int64'),
+    ('duration', 'float32'),
+    ('sample_rate', 'int32'),
+    ('channels', 'int16'),
+    ('sample_width', 'int16'),
+    ('text', 'string'),
+    ('sim_char', 'float32'),
+    ('sim_word', 'float32'),
+    ('voice', 'string'),
+]
+
+
+def manifest_format(output_path: str) -> str:
+    """Format implied by the output extension: .parquet, .arrow / .feather, anything else JSONL."""
+    ext = os.path.splitext(output_path)[1].lower()
+    if ext == '.parquet':
+        return 'parquet'
+    if ext in ('.arrow', '.feather'):
+        return 'arrow'
+    return 'jsonl'
+
+
+def voice_from_dir(wav_dir: str) -> str:
+    """Voice name if wav_dir is a per-voice directory of a multi-voice TTS batch, else ''."""
+    name = os.path.basename(os.path.normpath(wav_dir))
+    return name if name in CHIRP3_VOICES else ''
+
+
+def read_wav(path: str, with_frames: bool = False) -> Tuple[Dict[str, Any], Optional[bytes]]:
+    """Header fields of a WAV file (duration, sample rate, ...) and, optionally, its PCM frames."""
+    with wave.open(path, 'rb') as w:
+        info = {
+            'sample_rate': w.getframerate(),
+            'channels': w.getnchannels(),
+            'sample_width': w.getsampwidth(),
+            'duration': w.getnframes() / w.getframerate(),
+        }
+        frames = w.readframes(w.getnframes()) if with_frames else None
+    return info, frames
+
+
+def _read_clip(path: str, with_frames: bool) -> Tuple[Optional[Dict[str, Any]], Optional[bytes], Optional[Exception]]:
+    """read_wav for the export workers: a truncated, empty or corrupt WAV gives (None, None, error) instead of raising."""
+    try:
+        info, frames = read_wav(path, with_frames)
+    except (wave.Error, EOFError, OSError, ZeroDivisionError) as e:  # ZeroDivisionError: a header with rate 0
+        return None, None, e
+    return info, frames, None
+
+
+class ManifestWriter:
+    """Write manifest rows as Parquet (row groups), Arrow IPC or JSONL."""
+
+    def __init__(self, path: str, fmt: str):
+        if fmt != 'jsonl' and pa is None:
+            raise ImportError(f"Writing {fmt} needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.fmt = fmt
+        self._rows: List[Dict[str, Any]] = []
+        self._writer = None
+        self._fout = open(path, 'w', encoding='utf-8') if fmt == 'jsonl' else None
+        if pa is not None:
+            self.schema = pa.schema([(name, getattr(pa, dtype)()) for name, dtype in COLUMNS])
+
+    def add(self, row: Dict[str, Any]) -> None:
+        if self._fout is not None:
+            self._fout.write(json.dumps(row, ensure_ascii=False) + '\n')
+            return
+        self._rows.append(row)
+        if len(self._rows) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._rows:
+            return
+        table = pa.Table.from_pylist(self._rows, schema=self.schema)
+        if self._writer is None:
+            if self.fmt == 'parquet':
+                self._writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, self.schema)
+        self._writer.write_table(table)
+        self._rows = []
+
+    def close(self) -> None:
+        if self._fout is not None:
+            self._fout.close()
+            return
+        self._flush()
+        if self._writer is None:  # no rows: still write an empty, readable manifest
+            table = self.schema.empty_table()
+            if self.fmt == 'parquet':
+                pq.write_table(table, self.path)
+            else:
+                with pa.ipc.new_file(self.path, self.schema) as writer:
+                    writer.write_table(table)
+            return
+        self._writer.close()
+
+
+class PackedAudio:
+    """Read-only, memory-mapped view of a packed audio blob; rows address it by audio_offset/audio_bytes."""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+
+    def get(self, offset: int, nbytes: int) -> memoryview:
+        """PCM frames of one row, without copying."""
+        return memoryview(self._mmap)[offset:offset + nbytes]
+
+    def close(self) -> None:
+        if self._mmap:
+            self._mmap.close()
+        self._file.close()
+
+
+def _selected_rows(jsonl_file: str, wav_dir: str, min_similarity: float) -> Iterator[Tuple[Dict[str, Any], str]]:
+    from run_db import RunDB, is_run_db
+    if is_run_db(jsonl_file):
+        db = RunDB(jsonl_file)
+        yield from db.selected(None if min_similarity < 0 else min_similarity, wav_dir=wav_dir)
+        db.close()
+        return
+    with open(jsonl_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            result = json.loads(line)
+            if result.get('sim_char', 0) < min_similarity:
+                continue
+            wav_path = os.path.join(wav_dir, result['filename'])
+            if not os.path.exists(wav_path):
+                print(f"Warning: WAV file not found: {wav_path}")
+                continue
+            yield result, wav_path
+
+
+def export(
+    jsonl_file: str,
+    wav_dir: str,
+    output_path: str,
+    min_similarity: float = 0.6,
+    voice: str = '',
+    pack_audio: bool = False,
+    num_workers: int = 8,
+) -> None:
+    """
+    Export selected pairs as a training manifest: one row per clip with its id, audio location,
+    duration, sample rate, reference text, sim_char/sim_word and voice.
+
+    WAV headers are read once here, so loaders can filter and bucket by duration from the
+    manifest alone. With pack_audio, the PCM frames of all clips are concatenated into
+    <output_path>.audio.bin (memory-mappable, see PackedAudio) and rows point into it by
+    audio_offset/audio_bytes instead of a path.
+
+    Args:
+        jsonl_file: Comparison results from batch_compare_asr_ref.py (or the filtered output), or a
+            run database (run_db.py, .db/.sqlite) whose rows point at their WAVs
+        wav_dir: Directory containing the WAV files (the source or the organized destination); with a
+            run database, only the rows whose WAV is in this directory ('' = all)
+        output_path: Manifest path; .parquet or .arrow need pyarrow, anything else is written as JSONL
+        min_similarity: Minimum character similarity of an exported clip (same as organize_pairs;
+            negative selects the rows flagged kept in a run database)
+        voice: Voice name of the clips (default: the record's voice, or wav_dir's name if it is a per-voice directory)
+        pack_audio: Pack the audio into a single blob next to the manifest
+        num_workers: Parallel WAV reads
+    """
+    fmt = manifest_format(output_path)
+    if fmt != 'jsonl' and pa is None:
+        output_path = os.path.splitext(output_path)[0] + '.jsonl'
+        print(f"pyarrow is not installed, writing a JSONL manifest to {output_path} instead")
+        fmt = 'jsonl'
+    dir_voice = voice_from_dir(wav_dir)
+    manifest_dir = os.path.dirname(os.path.abspath(output_path))
+    writer = ManifestWriter(output_path, fmt)
+    blob = open(output_path + AUDIO_BLOB_SUFFIX, 'wb') if pack_audio else None
+    offset = 0
+    total_duration = 0.0
+    count = 0
+    unreadable = 0
+
+    selected = _selected_rows(jsonl_file, wav_dir, min_similarity)
+    # Read in windows so that at most a few clips per worker are held in memory when packing
+    window = num_workers * 4
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while True:
+            batch = list(itertools.islice(selected, window))
+            if not batch:
+                break
+            # map() keeps the input order, so the blob offsets follow the manifest rows
+            for (result, wav_path), (info, frames, error) in zip(batch, executor.map(
+                    lambda item: _read_clip(item[1], with_frames=pack_audio), batch)):
+                if error is not None:
+                    print(f"Warning: skipping unreadable WAV file {wav_path}: {error!r}")
+                    unreadable += 1
+                    continue
+                row = {
+                    'id': os.path.splitext(result['filename'])[0],
+                    'path': '' if pack_audio else os.path.relpath(wav_path, manifest_dir),
+                    'audio_offset': -1,
+                    'audio_bytes': 0,
+                    'text': result['reference_text'],
+                    'sim_char': result.get('sim_char'),
+                    'sim_word': result.get('sim_word'),
+                    'voice': voice or result.get('voice') or dir_voice,
+                    **info,
+                }
+                if blob is not None:
+                    blob.write(frames)
+                    row['audio_offset'], row['audio_bytes'] = offset, len(frames)
+                    offset += len(frames)
+                writer.add(row)
+                total_duration += info['duration']
+                count += 1
+    writer.close()
+    if blob is not None:
+        blob.close()
+
+    print(f"Exported {count} clips ({total_duration / 3600:.2f} hours) to {output_path} ({fmt})")
+    if unreadable:
+        print(f"Skipped {unreadable} unreadable WAV files")
+    if pack_audio:
+        print(f"Packed {offset / 1e9:.2f} GB of audio into {output_path + AUDIO_BLOB_SUFFIX}")
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(export)
+
+# python export_manifest.py work_dir/wav_files/asrcompare-0.75.jsonl work_dir/output-filtered-wavs work_dir/manifest.parquet --min-similarity=0.75
+# python export_manifest.py work_dir/wav_files/asrcompare-0.75.jsonl work_dir/wav_files work_dir/manifest.parquet --pack-audio
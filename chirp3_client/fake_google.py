@@ -0,0 +1,423 @@
+import io
+import math
+import os
+import random
+import runpy
+import struct
+import sys
+import threading
+import time
+import types
+import wave
+import zlib
+from collections import deque
+from typing import Dict, List, Optional
+
+import profiling
+from chunk_sentences import estimate_duration
+from llm_stub_server import StubConfig
+
+# Chunk id of the transcript embedded in fake TTS audio (after the data chunk, so WAV readers skip it)
+TRANSCRIPT_CHUNK = b'txt '
+
+# Limits the real APIs enforce, so the fakes fail where production would
+TTS_MAX_INPUT_BYTES = 5000
+INLINE_MAX_SECONDS = 60.0
+INLINE_MAX_BYTES = 10 * 1024 * 1024
+
+# Words of the pseudo-transcript of audio that was not made by the fake TTS
+FILLER_WORDS = ('so', 'um', 'well', 'the', 'weather', 'today', 'is', 'really', 'nice', 'and', 'I', 'think', 'we',
+                'should', 'go', 'out', 'you', 'know', 'like', 'maybe', 'later')
+
+
+class GoogleAPICallError(Exception):
+    """Base of the fake google.api_core.exceptions, with the HTTP code of the real ones."""
+
+    code = 500
+
+    def __init__(self, message: str = ''):
+        super().__init__(f"{self.code} {message}")
+        self.message = message
+
+
+class InvalidArgument(GoogleAPICallError):
+    code = 400
+
+
+class NotFound(GoogleAPICallError):
+    code = 404
+
+
+class ResourceExhausted(GoogleAPICallError):
+    code = 429
+
+
+class ServiceUnavailable(GoogleAPICallError):
+    code = 503
+
+
+class FakeService:
+    """
+    Latency, failures and counters of one fake API (tts, speech or gcs).
+
+    Every call sleeps for a latency drawn from config. A call over config.rpm, or one of
+    the config.rate_limit_rate fraction, raises ResourceExhausted before doing anything;
+    a config.error_rate fraction raise ServiceUnavailable after the latency.
+    """
+
+    def __init__(self, name: str, config: StubConfig):
+        self.name = name
+        self.config = config
+        self._lock = threading.Lock()
+        self._window = deque()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.ok = 0
+            self.errors = 0
+            self.rate_limited = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.latencies: List[float] = []
+
+    def call(self, method: str, bytes_in: int = 0) -> None:
+        """Account one request and play its latency and failure (raises on failure)."""
+        with self._lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            latency = self.config.draw_latency()
+            draw = self.config.rng.random()
+            now = time.monotonic()
+            while self._window and self._window[0] <= now - 60:
+                self._window.popleft()
+            over_rpm = self.config.rpm and len(self._window) >= self.config.rpm
+            if not over_rpm:
+                self._window.append(now)
+            if over_rpm or draw < self.config.rate_limit_rate:
+                self.rate_limited += 1
+                raise ResourceExhausted(f"Quota exceeded for {self.name} {method}")
+        time.sleep(latency)
+        with self._lock:
+            self.latencies.append(latency)
+            if draw < self.config.rate_limit_rate + self.config.error_rate:
+                self.errors += 1
+                raise ServiceUnavailable(f"{self.name} {method} is currently unavailable")
+            self.ok += 1
+
+    def sent(self, bytes_out: int) -> None:
+        with self._lock:
+            self.bytes_out += bytes_out
+
+    def to_dict(self) -> Dict[str, float]:
+        with self._lock:
+            return {'requests': self.requests, 'ok': self.ok, 'errors': self.errors, 'rate_limited': self.rate_limited,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+def synthesize_wav(text: str, sample_rate: int = 24000, language: str = 'en') -> bytes:
+    """
+    Deterministic LINEAR16 mono WAV for text: a quiet tone whose pitch depends on the text,
+    as long as chunk_sentences.estimate_duration says the sentence takes to speak, with the
+    text itself in a trailing 'txt ' chunk for transcript_of().
+    """
+    seconds = max(0.5, estimate_duration(text.strip(), language))
+    frequency = 120 + zlib.crc32(text.encode('utf-8')) % 200
+    num_frames = int(seconds * sample_rate)
+    step = 2 * math.pi * frequency / sample_rate
+    frames = struct.pack(f'<{num_frames}h', *(int(3000 * math.sin(i * step)) for i in range(num_frames)))
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(frames)
+    payload = text.strip().encode('utf-8')
+    chunk = TRANSCRIPT_CHUNK + struct.pack('<I', len(payload)) + payload + b'\0' * (len(payload) % 2)
+    data = bytearray(buf.getvalue() + chunk)
+    struct.pack_into('<I', data, 4, len(data) - 8)  # RIFF size covers the extra chunk
+    return bytes(data)
+
+
+def _riff_chunks(audio: bytes) -> Dict[bytes, bytes]:
+    chunks = {}
+    pos = 12
+    while pos + 8 <= len(audio):
+        chunk_id, size = audio[pos:pos + 4], struct.unpack_from('<I', audio, pos + 4)[0]
+        chunks[chunk_id] = audio[pos + 8:pos + 8 + size]
+        pos += 8 + size + size % 2
+    return chunks
+
+
+def transcript_of(audio: bytes, word_error_rate: float = 0.0) -> str:
+    """
+    Deterministic transcript of fake or real WAV bytes: the embedded text of fake TTS audio,
+    else pseudo-words (about 2.5 per second) drawn from a hash of the audio. With
+    word_error_rate, that fraction of the words is replaced, always the same ones for the same audio.
+    """
+    rng = random.Random(zlib.crc32(audio))
+    chunks = _riff_chunks(audio) if audio[:4] == b'RIFF' else {}
+    if TRANSCRIPT_CHUNK in chunks:
+        words = chunks[TRANSCRIPT_CHUNK].decode('utf-8').split()
+    else:
+        seconds = len(chunks.get(b'data', audio)) / 48000  # 24 kHz LINEAR16
+        words = [rng.choice(FILLER_WORDS) for _ in range(max(1, int(seconds * 2.5)))]
+    return ' '.join(rng.choice(FILLER_WORDS) if rng.random() < word_error_rate else word for word in words)
+
+
+def audio_seconds(audio: bytes) -> float:
+    try:
+        with wave.open(io.BytesIO(audio), 'rb') as w:
+            return w.getnframes() / w.getframerate()
+    except (wave.Error, EOFError):
+        return len(audio) / 48000
+
+
+class _Obj:
+    """Attribute bag standing in for the proto messages of the Google client libraries."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.__dict__})"
+
+
+class FakeGoogle:
+    """
+    In-process stand-ins for Chirp 3 TTS synthesize_speech, Speech recognize /
+    long_running_recognize and GCS blob upload/delete, with one FakeService per API.
+
+    install() puts fake google.* modules into sys.modules; scripts imported afterwards
+    (run_chirp3_tts_batch, run_cloud_asr_batch_*, batch_asr_parallel, pipeline) run
+    unchanged against them. Audio and transcripts are deterministic: the fake ASR returns
+    the text the fake TTS was given (see synthesize_wav), with word_error_rate of the words
+    replaced. GCS blobs live in memory, shared by all clients of the process.
+    """
+
+    def __init__(self, tts: Optional[StubConfig] = None, speech: Optional[StubConfig] = None,
+                 gcs: Optional[StubConfig] = None, word_error_rate: float = 0.0):
+        self.services = {
+            'tts': FakeService('tts', tts or StubConfig('lognormal', 400.0, 0.4)),
+            'speech': FakeService('speech', speech or StubConfig('lognormal', 600.0, 0.4)),
+            'gcs': FakeService('gcs', gcs or StubConfig('lognormal', 50.0, 0.3)),
+        }
+        self.word_error_rate = word_error_rate
+        self.buckets: Dict[str, Dict[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: service.to_dict() for name, service in self.services.items()}
+
+    def reset(self) -> None:
+        for service in self.services.values():
+            service.reset()
+
+    # Text-to-Speech
+
+    def synthesize_speech(self, request=None, **kwargs) -> _Obj:
+        request = request or kwargs
+        text = request['input'].text
+        size = len(text.encode('utf-8'))
+        if size > TTS_MAX_INPUT_BYTES:
+            raise InvalidArgument(f"Input text is {size} bytes, longer than the limit of {TTS_MAX_INPUT_BYTES}")
+        self.services['tts'].call('synthesize_speech', size)
+        audio = synthesize_wav(text)
+        self.services['tts'].sent(len(audio))
+        return _Obj(audio_content=audio)
+
+    # Speech-to-Text
+
+    def _audio(self, audio) -> bytes:
+        content = getattr(audio, 'content', None)
+        if content is not None:
+            return content
+        uri = audio.uri
+        bucket_name, _, blob_name = uri[len('gs://'):].partition('/')
+        with self._lock:
+            data = self.buckets.get(bucket_name, {}).get(blob_name)
+        if data is None:
+            raise NotFound(f"No such object: {bucket_name}/{blob_name}")
+        return data
+
+    def _response(self, config, audio: bytes) -> _Obj:
+        text = transcript_of(audio, self.word_error_rate)
+        diarization = getattr(config, 'diarization_config', None)
+        speakers = getattr(diarization, 'max_speaker_count', 1) if diarization else 1
+        words = [_Obj(word=word, speaker_tag=1 + i * speakers // max(1, len(text.split())))
+                 for i, word in enumerate(text.split())]
+        self.services['speech'].sent(len(text.encode('utf-8')))
+        return _Obj(results=[_Obj(alternatives=[_Obj(transcript=text, confidence=0.9, words=words)])])
+
+    def recognize(self, config=None, audio=None, timeout=None, **kwargs) -> _Obj:
+        data = self._audio(audio)
+        if getattr(audio, 'content', None) is not None and (len(data) > INLINE_MAX_BYTES or audio_seconds(data) > INLINE_MAX_SECONDS):
+            raise InvalidArgument("Sync input too long. For audio longer than 1 min use LongRunningRecognize with a 'uri' parameter.")
+        self.services['speech'].call('recognize', len(data))
+        return self._response(config, data)
+
+    def long_running_recognize(self, config=None, audio=None, **kwargs) -> _Obj:
+        fake = self
+
+        class Operation:
+            def result(self, timeout=None):
+                data = fake._audio(audio)
+                fake.services['speech'].call('long_running_recognize', len(data))
+                return fake._response(config, data)
+
+        return Operation()
+
+    # Cloud Storage
+
+    def blob(self, bucket_name: str, blob_name: str) -> _Obj:
+        fake = self
+
+        def upload(data: bytes) -> None:
+            fake.services['gcs'].call('upload', len(data))
+            with fake._lock:
+                fake.buckets.setdefault(bucket_name, {})[blob_name] = data
+
+        def upload_from_filename(filename, **kwargs):
+            with open(filename, 'rb') as f:
+                upload(f.read())
+
+        def upload_from_string(data, content_type=None, **kwargs):
+            upload(data.encode('utf-8') if isinstance(data, str) else data)
+
+        def delete(**kwargs):
+            fake.services['gcs'].call('delete')
+            with fake._lock:
+                if fake.buckets.get(bucket_name, {}).pop(blob_name, None) is None:
+                    raise NotFound(f"No such object: {bucket_name}/{blob_name}")
+
+        def exists(**kwargs):
+            with fake._lock:
+                return blob_name in fake.buckets.get(bucket_name, {})
+
+        return _Obj(name=blob_name, upload_from_filename=upload_from_filename, upload_from_string=upload_from_string,
+                    delete=delete, exists=exists)
+
+    def install(self) -> None:
+        """Register the fake google.* modules; import the scripts after this."""
+        fake = self
+
+        def module(name: str, **attrs) -> types.ModuleType:
+            mod = sys.modules.get(name) if name == 'google' else None
+            mod = mod or types.ModuleType(name)
+            mod.__dict__.update(attrs)
+            sys.modules[name] = mod
+            parent, _, child = name.rpartition('.')
+            if parent:
+                setattr(sys.modules[parent], child, mod)
+            return mod
+
+        def message(name: str, **constants) -> type:
+            return type(name, (_Obj,), constants)
+
+        class Credentials(_Obj):
+            @classmethod
+            def from_service_account_file(cls, filename, **kwargs):
+                return cls(filename=filename, **kwargs)
+
+        class TextToSpeechClient:
+            def __init__(self, **kwargs):
+                pass
+
+            def synthesize_speech(self, request=None, **kwargs):
+                return fake.synthesize_speech(request, **kwargs)
+
+        class SpeechClient:
+            def __init__(self, **kwargs):
+                pass
+
+            def recognize(self, config=None, audio=None, timeout=None, **kwargs):
+                return fake.recognize(config, audio, timeout)
+
+            def long_running_recognize(self, config=None, audio=None, **kwargs):
+                return fake.long_running_recognize(config, audio)
+
+        class StorageClient:
+            def __init__(self, **kwargs):
+                pass
+
+            def bucket(self, name):
+                return _Obj(name=name, blob=lambda blob_name: fake.blob(name, blob_name))
+
+        module('google')
+        module('google.auth')
+        module('google.auth.credentials', Credentials=Credentials)
+        module('google.oauth2')
+        module('google.oauth2.credentials', Credentials=Credentials)
+        module('google.oauth2.service_account', Credentials=Credentials)
+        module('google.api_core')
+        module('google.api_core.client_options', ClientOptions=message('ClientOptions'))
+        module('google.api_core.exceptions', GoogleAPICallError=GoogleAPICallError, InvalidArgument=InvalidArgument,
+               NotFound=NotFound, ResourceExhausted=ResourceExhausted, ServiceUnavailable=ServiceUnavailable)
+        module('google.cloud')
+        module('google.cloud.texttospeech_v1beta1', TextToSpeechClient=TextToSpeechClient,
+               SynthesisInput=message('SynthesisInput'), VoiceSelectionParams=message('VoiceSelectionParams'),
+               AudioConfig=message('AudioConfig'), AudioEncoding=message('AudioEncoding', LINEAR16=1, MP3=2, OGG_OPUS=3))
+        recognition_config = message('RecognitionConfig', AudioEncoding=message('AudioEncoding', LINEAR16=1))
+        recognition_metadata = message('RecognitionMetadata',
+                                       InteractionType=message('InteractionType', DISCUSSION=1),
+                                       RecordingDeviceType=message('RecordingDeviceType', SMARTPHONE=1))
+        module('google.cloud.speech_v1p1beta1', SpeechClient=SpeechClient, RecognitionAudio=message('RecognitionAudio'),
+               RecognitionConfig=recognition_config, RecognitionMetadata=recognition_metadata,
+               SpeakerDiarizationConfig=message('SpeakerDiarizationConfig'))
+        module('google.cloud.storage', Client=StorageClient)
+
+
+FAKE: Optional[FakeGoogle] = None
+
+
+def install(**kwargs) -> FakeGoogle:
+    """Create the process-wide FakeGoogle (see its arguments) and install its modules."""
+    global FAKE
+    FAKE = FakeGoogle(**kwargs)
+    FAKE.install()
+    return FAKE
+
+
+def run(script, *args, latency='lognormal', tts_latency_ms=400.0, speech_latency_ms=600.0, gcs_latency_ms=50.0,
+        latency_sigma=0.4, error_rate=0.0, rate_limit_rate=0.0, tts_rpm=0, speech_rpm=0, word_error_rate=0.0, seed=0):
+    """
+    Run a script against the fake Google services, e.g. to try a batch without credentials or spend.
+
+    The fakes are installed in this process, then the script runs as __main__ with args.
+    Separate the script's own options with --. Request counts are printed at the end.
+
+    Args:
+        script: Path of the script to run
+        args: Its command line
+        latency: Latency distribution of every fake API: fixed, uniform or lognormal
+        tts_latency_ms: Median synthesize_speech latency
+        speech_latency_ms: Median recognize / long_running_recognize latency
+        gcs_latency_ms: Median GCS upload / delete latency
+        latency_sigma: Lognormal shape (larger = longer tail)
+        error_rate: Fraction of calls of each API failing with ServiceUnavailable
+        rate_limit_rate: Fraction of calls failing with ResourceExhausted
+        tts_rpm: Requests per minute the fake TTS accepts (0 = unlimited)
+        speech_rpm: Requests per minute the fake Speech API accepts (0 = unlimited)
+        word_error_rate: Fraction of transcript words the fake ASR gets wrong
+        seed: Seed of the latency and failure draws
+    """
+    fake = install(
+        tts=StubConfig(latency, tts_latency_ms, latency_sigma, error_rate, rate_limit_rate, tts_rpm, seed),
+        speech=StubConfig(latency, speech_latency_ms, latency_sigma, error_rate, rate_limit_rate, speech_rpm, seed + 1),
+        gcs=StubConfig(latency, gcs_latency_ms, latency_sigma, error_rate, rate_limit_rate, 0, seed + 2),
+        word_error_rate=word_error_rate)
+    sys.argv = [script, *args]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        for name, stats in fake.stats().items():
+            print(f"fake {name}: {stats}")
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(run)
+
+# python fake_google.py run_chirp3_tts_batch.py -- batch test10.txt OUTPUT-fake-wavs --voices=Aoede,Kore
+# python fake_google.py --error-rate 0.05 --word-error-rate 0.1 run_cloud_asr_batch_1speaker.py -- batch OUTPUT-fake-wavs asr.txt
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# USD per 1M tokens as (input, output); models not listed count as free
+MODEL_PRICES = {
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'qwen-turbo': (0.05, 0.20),
+    'qwen-plus': (0.40, 1.20),
+    'qwen-max': (1.60, 6.40),
+}
+
+CACHE_MODES = ('off', 'readwrite', 'replay')
+
+
+def model_price(model: str):
+    """(input, output) USD per 1M tokens, matching the longest known model-name prefix."""
+    matches = [name for name in MODEL_PRICES if model.startswith(name)]
+    if not matches:
+        return 0.0, 0.0
+    return MODEL_PRICES[max(matches, key=len)]
+
+
+def completion_cost(model: str, usage: Optional[Dict[str, int]]) -> float:
+    """Dollar cost of one completion from its usage block."""
+    if not usage:
+        return 0.0
+    price_in, price_out = model_price(model)
+    return (usage.get('prompt_tokens', 0) * price_in + usage.get('completion_tokens', 0) * price_out) / 1e6
+
+
+def to_plain(response) -> Dict[str, Any]:
+    """Convert an OpenAIObject response into plain, JSON-serializable dicts."""
+    if hasattr(response, 'to_dict_recursive'):
+        return response.to_dict_recursive()
+    return response
+
+
+class LLMCache:
+    """
+    Disk cache of chat completions in SQLite.
+
+    Entries are keyed by a hash of (model, base URL, messages, temperature, sample index),
+    so resampling the same prompt with a different sample index is a different entry.
+
+    Modes:
+        off: never read or write.
+        readwrite: return cached responses, call the API and store on a miss.
+        replay: only return cached responses; a miss is reported and not sent to the API,
+            which makes reruns deterministic and free.
+
+    With max_mb > 0, least recently used entries are evicted once the cache is larger.
+    """
+
+    def __init__(self, path: str = 'llm-cache.sqlite', mode: str = 'readwrite', max_mb: float = 0):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, expected one of {CACHE_MODES}")
+        self.mode = mode
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_usd = 0.0
+        self._lock = threading.Lock()
+        self._conn = None
+        if mode != 'off':
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)')
+            self._conn.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+
+    @property
+    def replay(self) -> bool:
+        return self.mode == 'replay'
+
+    @staticmethod
+    def key(model: str, base_url: str, messages: List[Dict[str, str]], temperature: float, sample_index: int = 0) -> str:
+        payload = json.dumps([model, base_url, messages, temperature, sample_index], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached response for key, or None on a miss (or when the cache is off)."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT model, response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+        model, payload = row
+        response = json.loads(payload)
+        usage = response.get('usage') or {}
+        self.hits += 1
+        self.saved_tokens += usage.get('total_tokens', 0)
+        self.saved_usd += completion_cost(model, usage)
+        return response
+
+    def put(self, key: str, model: str, response) -> None:
+        """Store a response (not in replay mode) and evict old entries if over the size limit."""
+        if not self.enabled or self.replay:
+            return
+        payload = json.dumps(to_plain(response), ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, size, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, model, payload, len(payload.encode('utf-8')), time.time()))
+            if self.max_bytes > 0:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries down to 90% of the limit
+        to_free = total - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if freed >= to_free:
+                break
+            keys.append((key,))
+            freed += size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+
+    def print_summary(self) -> None:
+        if not self.enabled:
+            return
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print(f"LLM cache ({self.mode}): {self.hits}/{lookups} hits ({hit_rate:.1%}), "
+              f"saved {self.saved_tokens} tokens, ~${self.saved_usd:.4f}")
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
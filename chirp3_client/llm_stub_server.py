@@ -0,0 +1,259 @@
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import profiling
+from llm_tokens import estimate_text_tokens, estimate_tokens
+
+LATENCY_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+PACKED_PREFIX = "Rewrite the following paragraphs: "
+SINGLE_PREFIX = "Rewrite the following paragraph: "
+
+
+class StubConfig:
+    """
+    Behaviour of the stub endpoint.
+
+    Args:
+        latency (str): Latency distribution: fixed, uniform (0 to 2x latency_ms) or lognormal.
+        latency_ms (float): Median latency of a successful request in milliseconds.
+        latency_sigma (float): Shape of the lognormal distribution (larger = longer tail).
+        error_rate (float): Fraction of requests answered with a 500.
+        rate_limit_rate (float): Fraction of requests answered with a random 429.
+        rpm (int): Requests per minute enforced like a provider would; requests above it get a
+            429 with x-ratelimit-* and Retry-After headers (0 = unlimited).
+        seed (int): Seed of the latency and failure draws.
+    """
+
+    def __init__(self, latency='lognormal', latency_ms=300.0, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0,
+                 rpm=0, seed=0):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {latency!r}, expected one of {LATENCY_DISTRIBUTIONS}")
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm = rpm
+        self.rng = random.Random(seed)
+
+    def draw_latency(self) -> float:
+        """Seconds to wait before answering one request."""
+        if self.latency == 'fixed':
+            ms = self.latency_ms
+        elif self.latency == 'uniform':
+            ms = self.rng.uniform(0, 2 * self.latency_ms)
+        else:
+            ms = self.latency_ms * math.exp(self.rng.gauss(0, self.latency_sigma))
+        return ms / 1000.0
+
+
+class StubStats:
+    """Thread-safe request and token counters of the stub, served at GET /stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.ok = 0
+            self.errors = 0
+            self.rate_limited = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'ok': self.ok,
+                'errors': self.errors,
+                'rate_limited': self.rate_limited,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+            }
+
+
+def fake_completion(messages: List[Dict[str, str]]) -> str:
+    """Plausible answer for the prompts of the rewrite scripts (packed, single or topic)."""
+    content = messages[-1]['content']
+    if content.startswith(PACKED_PREFIX):
+        try:
+            paragraphs = json.loads(content[len(PACKED_PREFIX):])
+        except json.JSONDecodeError:
+            paragraphs = []
+        return json.dumps([f"Um, so... {p}" for p in paragraphs], ensure_ascii=False)
+    if content.startswith(SINGLE_PREFIX):
+        return f"Um, so... {content[len(SINGLE_PREFIX):]}"
+    if content.startswith("Topic:"):
+        topic = content[len("Topic:"):].strip(" '")
+        return f"So, uh, let's talk about {topic}.\nWell... {topic} is, like, really interesting, you know?"
+    return content
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible POST /v1/chat/completions, plus GET /stats and POST /reset."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, error_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send_json(status, {'error': {'message': message, 'type': error_type, 'code': error_type}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.server.stats.to_dict())
+        else:
+            self._send_error(404, f"Unknown path {self.path}", 'not_found')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.rstrip('/') == '/reset':
+            self.server.stats.reset()
+            self._send_json(200, {'reset': True})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_error(404, f"Unknown path {self.path}", 'not_found')
+            return
+        request = json.loads(body)
+        config, stats = self.server.config, self.server.stats
+        stats.add(requests=1)
+
+        rate_limit_headers = self.server.check_rpm()
+        with self.server.rng_lock:
+            latency = config.draw_latency()
+            draw = config.rng.random()
+        if rate_limit_headers is None and draw < config.rate_limit_rate:
+            rate_limit_headers = {'retry-after': '1'}
+        if rate_limit_headers is not None:
+            stats.add(rate_limited=1)
+            self._send_error(429, "Rate limit reached for requests", 'rate_limit_exceeded', rate_limit_headers)
+            return
+        time.sleep(latency)
+        if draw < config.rate_limit_rate + config.error_rate:
+            stats.add(errors=1)
+            self._send_error(500, "The server had an error while processing your request", 'server_error')
+            return
+
+        messages = request['messages']
+        content = fake_completion(messages)
+        prompt_tokens = estimate_tokens(messages)
+        completion_tokens = estimate_text_tokens(content)
+        stats.add(ok=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        self._send_json(200, {
+            'id': f"chatcmpl-stub-{stats.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+
+class StubServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer holding the stub's config, counters and RPM window."""
+
+    daemon_threads = True
+
+    def __init__(self, address, config: StubConfig):
+        super().__init__(address, StubHandler)
+        self.config = config
+        self.stats = StubStats()
+        self.rng_lock = threading.Lock()
+        self._window = deque()
+        self._window_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def check_rpm(self) -> Optional[Dict[str, str]]:
+        """Admit a request within the RPM limit, or return the 429 headers a provider would send."""
+        if not self.config.rpm:
+            return None
+        with self._window_lock:
+            now = time.monotonic()
+            while self._window and self._window[0] <= now - 60:
+                self._window.popleft()
+            if len(self._window) >= self.config.rpm:
+                reset = self._window[0] + 60 - now
+                return {
+                    'x-ratelimit-limit-requests': str(self.config.rpm),
+                    'x-ratelimit-remaining-requests': '0',
+                    'x-ratelimit-reset-requests': f"{reset:.3f}s",
+                    'retry-after': str(max(1, math.ceil(reset))),
+                }
+            self._window.append(now)
+            return None
+
+
+def start_server(host='127.0.0.1', port=0, config: Optional[StubConfig] = None) -> StubServer:
+    """Start the stub in a background thread (port 0 picks a free port); stop it with shutdown()."""
+    server = StubServer((host, port), config or StubConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve(host='127.0.0.1', port=8765, latency='lognormal', latency_ms=300.0, latency_sigma=0.5, error_rate=0.0,
+          rate_limit_rate=0.0, rpm=0, seed=0):
+    """
+    Run an OpenAI-compatible chat completions stub until interrupted.
+
+    Point a rewrite script at it with --base-url http://HOST:PORT/v1 (any API key works).
+    Counters are served at GET /stats and cleared with POST /reset.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on.
+        latency (str): fixed, uniform or lognormal.
+        latency_ms (float): Median latency in milliseconds.
+        latency_sigma (float): Lognormal shape; 0.5 gives a p99 of about 3x the median.
+        error_rate (float): Fraction of requests answered with a 500.
+        rate_limit_rate (float): Fraction of requests answered with a random 429.
+        rpm (int): Enforced requests per minute (0 = unlimited).
+        seed (int): Seed of the latency and failure draws.
+    """
+    config = StubConfig(latency, latency_ms, latency_sigma, error_rate, rate_limit_rate, rpm, seed)
+    server = StubServer((host, port), config)
+    print(f"LLM stub listening on {server.base_url} (latency {latency} {latency_ms}ms, "
+          f"{error_rate:.0%} errors, {rate_limit_rate:.0%} random 429s, rpm={rpm or 'unlimited'})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.to_dict()))
+        server.server_close()
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(serve)
+
+# python llm_stub_server.py --port 8765 --latency-ms 400 --error-rate 0.02 --rpm 600
+# python rewrite_chatting_style.py in.txt out.txt -k any-key.txt --base-url http://127.0.0.1:8765/v1 --cache-mode off
+# curl http://127.0.0.1:8765/stats
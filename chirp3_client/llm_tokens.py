@@ -0,0 +1,16 @@
+from typing import Dict, List
+
+# Rough English average for OpenAI-style BPE tokenizers
+CHARS_PER_TOKEN = 4.0
+# Per-message framing overhead of the chat format (role, separators)
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Approximate token count of a string without loading a tokenizer."""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """Approximate prompt tokens of a chat message list."""
+    return sum(estimate_text_tokens(m['content']) + TOKENS_PER_MESSAGE for m in messages) + 2
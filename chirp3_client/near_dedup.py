@@ -0,0 +1,148 @@
+import codecs
+import hashlib
+import random
+from array import array
+from typing import Dict, List, Optional, Tuple
+import profiling
+from batch_compare_asr_ref import get_chars_bigram
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def choose_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Pick (bands, rows) with bands * rows == num_perm whose LSH threshold
+    (1 / bands) ** (1 / rows) is the highest one not above the Jaccard threshold.
+    """
+    best = (num_perm, 1)
+    best_t = 0.0
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        t = (1.0 / bands) ** (1.0 / rows)
+        if best_t < t <= threshold:
+            best, best_t = (bands, rows), t
+    return best
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate detector using MinHash over character bigrams with LSH banding.
+
+    Each sentence is reduced to num_perm 32-bit MinHash values. Signatures are split into
+    bands; sentences sharing any band bucket become candidates, and a candidate is a
+    duplicate if the fraction of equal MinHash values (the Jaccard estimate) reaches the
+    threshold. The first occurrence is kept. Per-bigram hash columns are cached, since the
+    bigram vocabulary is small compared to the number of sentences.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 0, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        if bands <= 0:
+            bands, _ = choose_bands(threshold, num_perm)
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+        self._columns: Dict[str, Tuple[int, ...]] = {}
+        # band key -> kept sentence index, or a list of them once a bucket is shared
+        self._buckets: List[Dict[int, object]] = [{} for _ in range(bands)]
+        self._signatures = array('I')  # flat, num_perm values per kept sentence
+        self.kept = 0
+        self.dropped = 0
+
+    def _column(self, bigram: str) -> Tuple[int, ...]:
+        column = self._columns.get(bigram)
+        if column is None:
+            base = int.from_bytes(hashlib.blake2b(bigram.encode('utf-8'), digest_size=8).digest(), 'little')
+            column = tuple(((a * base + b) % _MERSENNE_PRIME) & _MAX_HASH for a, b in self._perms)
+            self._columns[bigram] = column
+        return column
+
+    def signature(self, text: str) -> Optional[Tuple[int, ...]]:
+        """MinHash signature of the text's bigram set, or None if it has no bigrams."""
+        bigrams = get_chars_bigram(text)
+        if not bigrams:
+            return None
+        return tuple(map(min, zip(*[self._column(b) for b in bigrams])))
+
+    def _similarity(self, sig: Tuple[int, ...], idx: int) -> float:
+        start = idx * self.num_perm
+        other = self._signatures[start:start + self.num_perm]
+        return sum(1 for x, y in zip(sig, other) if x == y) / self.num_perm
+
+    def is_duplicate(self, text: str) -> bool:
+        """Return True if text is a near duplicate of an earlier sentence; otherwise remember it."""
+        sig = self.signature(text)
+        if sig is None:
+            self.kept += 1
+            return False  # too short to compare, leave it to exact dedup
+
+        keys = [hash(sig[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+        checked = set()
+        for buckets, key in zip(self._buckets, keys):
+            entry = buckets.get(key)
+            if entry is None:
+                continue
+            for idx in (entry if isinstance(entry, list) else (entry,)):
+                if idx in checked:
+                    continue
+                checked.add(idx)
+                if self._similarity(sig, idx) >= self.threshold:
+                    self.dropped += 1
+                    return True
+
+        idx = len(self._signatures) // self.num_perm
+        self._signatures.extend(sig)
+        for buckets, key in zip(self._buckets, keys):
+            entry = buckets.get(key)
+            if entry is None:
+                buckets[key] = idx
+            elif isinstance(entry, list):
+                entry.append(idx)
+            else:
+                buckets[key] = [entry, idx]
+        self.kept += 1
+        return False
+
+
+def filter_file(input_file: str, output_file: str, threshold: float = 0.8, num_perm: int = 64, bands: int = 0, verbose=False):
+    """
+    Drop near-duplicate sentences from a chunked sentence file, keeping the first occurrence.
+
+    Lines may be plain sentences or "topic\\tsentence" (chunk_sentences --keep-topic);
+    only the sentence is compared.
+
+    Usage:
+        python near_dedup.py all-rewritten-chunk-uniq.txt all-rewritten-chunk-neardedup.txt --threshold 0.8
+
+    Args:
+        input_file: Input text file, one sentence per line
+        output_file: Output text file with near duplicates removed
+        threshold: Estimated Jaccard similarity of character bigrams above which a sentence is dropped
+        num_perm: Number of MinHash functions
+        bands: Number of LSH bands (0 = derive from threshold)
+    """
+    dedup = NearDuplicateFilter(threshold=threshold, num_perm=num_perm, bands=bands)
+    print(f"Near-dedup with threshold={threshold}, num_perm={num_perm}, bands={dedup.bands}x{dedup.rows}")
+    with codecs.open(output_file, 'w', encoding='utf-8') as fout:
+        for line in codecs.open(input_file, 'r', encoding='utf-8'):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            sent = line.split('\t')[-1]
+            if dedup.is_duplicate(sent):
+                if verbose:
+                    print(f"Near duplicate: {sent}")
+                continue
+            print(line, file=fout)
+    print(f"Kept {dedup.kept} sentences, dropped {dedup.dropped} near duplicates")
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(filter_file)
@@ -1,78 +1,314 @@
+import errno
 import json
 import os
 import shutil
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
-import argh
+import profiling
+from ref_store import RefStoreWriter
+from run_db import RunDB, is_run_db
+from stage_metrics import METRICS, ProgressLine, start_export
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LINK_MODES = ('auto', 'copy', 'hardlink', 'reflink', 'symlink')
+
+# ioctl number of FICLONE (Linux: share the extents of a file on btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+# Errors meaning "this link method does not work here", as opposed to a problem with the file
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+                       errno.EMLINK, errno.ENOSYS}
+
+
+def reflink(src: str, dst: str) -> None:
+    """Copy-on-write clone of src to dst, sharing its data blocks (raises OSError if unsupported)."""
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink is not supported on this platform")
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            fout.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def is_same_file(src: str, dst: str) -> bool:
+    """True if dst already holds src: a link to it, or a file of the same size and mtime (like rsync)."""
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def _device(path: str) -> int:
+    """st_dev of path, or of its closest existing parent directory."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+class FilePlacer:
+    """
+    Place files at a destination by linking them where possible and copying otherwise.
+
+    Modes:
+        auto: reflink, else copy. Both give an independent file, so rewriting a source in
+            place (e.g. re-running TTS into its output directory) leaves the destination intact.
+        hardlink / reflink / symlink: that method, falling back to copy when it is not
+            supported (e.g. a hardlink across devices). Hardlinks and symlinks share the
+            source's data, so they are only used when asked for.
+        copy: always copy (shutil.copy2).
+
+    A method that fails as unsupported is not tried again. Copies run on a thread pool of
+    num_workers, links inline. A destination that already holds the source file is skipped,
+    so re-running is cheap. With dry_run, nothing is written; the summary reports the method
+    each file would get: copy across devices, and 'reflink or copy' for auto / reflink, since
+    reflink support is only found out by trying. Links and copies are tracked in METRICS
+    as stage 'organize', api <method>.
+    """
+
+    def __init__(self, mode: str = 'auto', num_workers: int = 8, dry_run: bool = False, verbose: bool = False):
+        if mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {mode!r}, expected one of {LINK_MODES}")
+        self.mode = mode
+        self.dry_run = dry_run
+        self.verbose = verbose
+        self.methods = {'auto': ['reflink'], 'copy': []}.get(mode, [mode])
+        self.counts = Counter()
+        self.bytes = Counter()
+        self.errors = []
+        self._pool = ThreadPoolExecutor(max_workers=num_workers)
+        self._copies = []
+
+    def _link(self, method: str, src: str, dst: str) -> None:
+        if method == 'hardlink':
+            os.link(src, dst)
+        elif method == 'reflink':
+            reflink(src, dst)
+        else:
+            os.symlink(os.path.abspath(src), dst)
+
+    def _copy(self, src: str, dst: str, size: int) -> None:
+        with METRICS.track('organize', api='copy', bytes_in=size) as call:
+            shutil.copy2(src, dst)
+            call.bytes_out = size
+        if self.verbose:
+            print(f"copy: {src} -> {dst}")
+
+    def _dry_run_method(self, src: str, dst: str) -> str:
+        """The method place() would try first for src, as far as it is known without writing."""
+        if not self.methods:
+            return 'copy'
+        method = self.methods[0]
+        if method == 'symlink':
+            return method  # works across devices
+        if _device(src) != _device(dst):
+            return 'copy'
+        return 'reflink or copy' if method == 'reflink' else method
+
+    def place(self, src: str, dst: str) -> None:
+        """Link or copy src to dst (copies complete asynchronously; call close() to wait)."""
+        size = os.path.getsize(src)
+        if is_same_file(src, dst):
+            self.counts['skipped'] += 1
+            return
+        if self.dry_run:
+            method = self._dry_run_method(src, dst)
+            self.counts[method] += 1
+            self.bytes[method] += size
+            return
+        if os.path.lexists(dst):
+            os.remove(dst)  # stale or different file
+        for method in list(self.methods):
+            start = time.monotonic()
+            try:
+                self._link(method, src, dst)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                print(f"{method} not supported for {dst} ({e.strerror}), not trying it again")
+                self.methods.remove(method)
+                continue
+            # Only successful links are tracked: a failed probe of an unsupported method is not an error
+            METRICS.record('organize', time.monotonic() - start, api=method, bytes_in=size)
+            self.counts[method] += 1
+            self.bytes[method] += size
+            if self.verbose:
+                print(f"{method}: {src} -> {dst}")
+            return
+        self._copies.append((dst, size, self._pool.submit(self._copy, src, dst, size)))
+
+    def close(self) -> None:
+        """Wait for pending copies and collect their errors."""
+        for dst, size, future in self._copies:
+            try:
+                future.result()
+            except OSError as e:
+                self.errors.append((dst, e))
+                print(f"Error copying to {dst}: {e}")
+                continue
+            self.counts['copy'] += 1
+            self.bytes['copy'] += size
+        self._copies = []
+        self._pool.shutdown()
+
+    def print_summary(self) -> None:
+        verb = "Would place" if self.dry_run else "Placed"
+        for method in sorted(m for m in self.counts if m != 'skipped'):
+            print(f"{verb} {self.counts[method]} files by {method} ({self.bytes[method] / 1e9:.2f} GB)")
+        print(f"{self.counts['skipped']} files already present, left as is")
+        if self.errors:
+            print(f"Failed to copy {len(self.errors)} files")
+
+
+def _has_text(path: str, text: str) -> bool:
+    """True if path already contains exactly text."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read() == text
+    except FileNotFoundError:
+        return False
+
+
+def _jsonl_results(jsonl_file: str, wav_src_dir: str):
+    """(comparison record, source WAV path) of every line of a JSONL file."""
+    with open(jsonl_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            result = json.loads(line)
+            yield result, os.path.join(wav_src_dir, result['filename'])
+
 
 def organize_pairs(
     jsonl_file: str,
     wav_src_dir: str,
     wav_dst_dir: str,
     txt_dst_dir: str,
-    min_similarity: float = 0.6
+    min_similarity: float = 0.6,
+    pack_txts: bool = False,
+    link_mode: str = 'auto',
+    num_workers: int = 8,
+    dry_run: bool = False,
+    metrics_dir: str = None,
+    verbose: bool = False,
 ) -> None:
     """
     Organize wav and txt files into separate folders based on JSONL comparison results.
 
     Args:
-        jsonl_file: Path to input JSONL file with comparison results
-        wav_src_dir: Source directory containing WAV files
+        jsonl_file: Path to input JSONL file with comparison results, or a run database
+            (run_db.py, .db/.sqlite): its selected rows are read with one indexed query,
+            and their WAVs are taken from the paths recorded in it
+        wav_src_dir: Source directory containing WAV files (with a run database: only the rows
+            whose WAV is in this directory, '' = all)
         txt_src_dir: Source directory containing TXT files
         wav_dst_dir: Destination directory for selected WAV files
         txt_dst_dir: Destination directory for selected TXT files
-        min_similarity: Minimum character similarity threshold (default: 0.7)
+        min_similarity: Minimum character similarity threshold (default: 0.7); with a run database,
+            a negative value selects the rows flagged kept by `run_db.py select` instead
+        pack_txts: Write the reference texts into a single packed store at txt_dst_dir
+            (see ref_store.py) instead of one .txt file per WAV
+        link_mode: How WAVs are placed: auto (reflink, else copy), hardlink, reflink, symlink
+            or copy. Link modes fall back to copy where unsupported. Hardlinks and symlinks
+            change with the source WAVs, e.g. when TTS is re-run into wav_src_dir.
+        num_workers: Parallel copies (used when the WAVs cannot be linked, e.g. across devices)
+        dry_run: Only report what would be linked, copied or skipped
+        metrics_dir: Export metrics to metrics_dir/organize.prom periodically and organize.summary.json at exit
+        verbose: Print one line per file
     """
+    if metrics_dir:
+        start_export(metrics_dir, 'organize')
+
     # Create destination directories if they don't exist
-    os.makedirs(wav_dst_dir, exist_ok=True)
-    os.makedirs(txt_dst_dir, exist_ok=True)
+    if not dry_run:
+        os.makedirs(wav_dst_dir, exist_ok=True)
+    txt_store = None
+    if pack_txts and not dry_run:
+        txt_store = RefStoreWriter(txt_dst_dir)
+    elif not dry_run:
+        os.makedirs(txt_dst_dir, exist_ok=True)
 
+    placer = FilePlacer(link_mode, num_workers=num_workers, dry_run=dry_run, verbose=verbose)
     copied_count = 0
     skipped_count = 0
+    missing_count = 0
+    progress = None if verbose else ProgressLine(METRICS)
 
-    # Process JSONL file
-    with open(jsonl_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            result = json.loads(line)
+    if is_run_db(jsonl_file):
+        db = RunDB(jsonl_file)
+        results = db.selected(None if min_similarity < 0 else min_similarity, wav_dir=wav_src_dir)
+    else:
+        db = None
+        results = _jsonl_results(jsonl_file, wav_src_dir)
 
-            # Check similarity threshold
-            if result.get('sim_char', 0) < min_similarity:
-                skipped_count += 1
-                continue
+    for result, wav_src in results:
+        if progress is not None:
+            progress.update()
 
-            wav_name = result['filename']
-            txt_name = wav_name.replace('.wav', '.txt')
+        # Check similarity threshold
+        if result.get('sim_char', 0) < min_similarity:
+            skipped_count += 1
+            continue
 
-            # Source paths
-            wav_src = os.path.join(wav_src_dir, wav_name)
+        wav_name = result['filename']
+        txt_name = wav_name.replace('.wav', '.txt')
 
-            # Destination paths
-            wav_dst = os.path.join(wav_dst_dir, wav_name)
-            txt_dst = os.path.join(txt_dst_dir, txt_name)
+        # Destination paths
+        wav_dst = os.path.join(wav_dst_dir, wav_name)
+        txt_dst = os.path.join(txt_dst_dir, txt_name)
 
-            try:
-                # Copy WAV file
-                if os.path.exists(wav_src):
-                    shutil.copy2(wav_src, wav_dst)
-                else:
-                    print(f"Warning: WAV file not found: {wav_src}")
-                    continue
-
-                # Write reference text to TXT file
+        try:
+            # Link or copy WAV file
+            if os.path.exists(wav_src):
+                placer.place(wav_src, wav_dst)
+            else:
+                print(f"Warning: WAV file not found: {wav_src}")
+                missing_count += 1
+                continue
+
+            # Write reference text to TXT file
+            if txt_store is not None:
+                txt_store.add(os.path.splitext(txt_name)[0], result['reference_text'])
+            elif not dry_run and not _has_text(txt_dst, result['reference_text']):
                 with open(txt_dst, 'w', encoding='utf-8') as txt_out:
                     txt_out.write(result['reference_text'])
 
-                copied_count += 1
-                print(f"Copied pair {copied_count}: {wav_name}")
+            copied_count += 1
+            if verbose:
+                print(f"Selected pair {copied_count}: {wav_name}")
 
-            except Exception as e:
-                print(f"Error processing {wav_name}: {str(e)}")
-                skipped_count += 1
+        except Exception as e:
+            print(f"Error processing {wav_name}: {str(e)}")
+            skipped_count += 1
 
-    print(f"\nProcessing complete:")
-    print(f"Copied {copied_count} file pairs")
-    print(f"Skipped {skipped_count} files")
+    placer.close()
+    if progress is not None:
+        progress.close()
+    if db is not None:
+        db.close()
+    if txt_store is not None:
+        txt_store.close()
+
+    print(f"\nProcessing complete{' (dry run, nothing written)' if dry_run else ''}:")
+    print(f"Selected {copied_count} file pairs")
+    placer.print_summary()
+    print(f"Skipped {skipped_count} files below the threshold or failing")
+    if missing_count:
+        print(f"Missing {missing_count} WAV files")
     print(f"WAV files saved to: {wav_dst_dir}")
     print(f"TXT files saved to: {txt_dst_dir}")
 
+
 if __name__ == "__main__":
-    argh.dispatch_command(organize_pairs)
+    profiling.dispatch_command(organize_pairs)
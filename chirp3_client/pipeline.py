@@ -0,0 +1,341 @@
+import io
+import json
+import os
+import queue
+import threading
+import time
+import wave
+from typing import Any, Callable, Iterator, Optional
+import profiling
+import quota_governor
+from batch_compare_asr_ref import is_kept, score_pair
+from chunk_sentences import SeenSentences, chunk_line
+from ref_store import tts_item_id
+from run_db import RunDB
+from aimd import limiter_or_none, maybe_slot
+from stage_metrics import METRICS, print_summary, start_export
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+
+class Stage:
+    """
+    A pool of worker threads applying fn to items from inbox and putting the results on outbox.
+
+    fn returns the item for the next stage, or None to drop it (e.g. a rejected clip).
+    An exception in fn fails only that item. When all workers have seen the end of the
+    input, the stage sends the end marker on to each worker of the next stage.
+    Bounded queues make a slow stage hold back the ones before it.
+    Every item is tracked in METRICS under the stage name (count, errors, latency, in-flight).
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], num_workers: int, inbox: queue.Queue,
+                 outbox: Optional[queue.Queue] = None):
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.downstream_workers = 1
+        self.stats = METRICS.stage(name)
+        self.dropped = 0
+        self._running = num_workers
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True) for i in range(num_workers)]
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                break
+            try:
+                with METRICS.track(self.name):
+                    result = self.fn(item)
+            except Exception as e:
+                print(f"[{self.name}] Error: {e}")
+                continue
+            if result is None:
+                with self._lock:
+                    self.dropped += 1
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.outbox is not None:
+            for _ in range(self.downstream_workers):
+                self.outbox.put(_DONE)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait up to timeout seconds for all workers to finish; return True if they have."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+
+def read_lines(input_file: str, follow: bool = False, idle_timeout: float = 60.0) -> Iterator[str]:
+    """Lines of input_file; with follow, keep reading as it grows (e.g. while a rewrite script
+    is still writing it) until it has not grown for idle_timeout seconds."""
+    with open(input_file, 'r', encoding='utf-8') as f:
+        idle_since = time.monotonic()
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+                idle_since = time.monotonic()
+            elif line:
+                partial += line  # the writer has not finished this line yet
+            elif not follow or time.monotonic() - idle_since > idle_timeout:
+                break
+            else:
+                time.sleep(0.5)
+        if partial:
+            yield partial
+
+
+def wav_sample_rate(audio_content: bytes, default: int = 24000) -> int:
+    """Sample rate from the header of in-memory WAV bytes."""
+    try:
+        with wave.open(io.BytesIO(audio_content), 'rb') as w:
+            return w.getframerate()
+    except (wave.Error, EOFError):
+        return default
+
+
+def run_pipeline(
+    input_file: str,
+    output_dir: str,
+    voices: str = 'Aoede',
+    filename_prefix: str = 'chrp',
+    num_digits: int = 4,
+    tts_workers: int = 4,
+    asr_workers: int = 8,
+    queue_size: int = 64,
+    min_duration: float = 0.0,
+    max_duration: float = 0.0,
+    language: str = 'en',
+    do_unique: bool = True,
+    min_char_sim: float = 0.5,
+    min_char_sim_for_short_lines: float = 0.7,
+    detect_ending_noise: bool = False,
+    asr_retries: int = 3,
+    follow: bool = False,
+    idle_timeout: float = 60.0,
+    limit: int = 0,
+    report_every: float = 30.0,
+    metrics_dir: str = None,
+    run_db: str = None,
+    adaptive: bool = False,
+    aimd_log: str = None,
+    verbose: bool = False,
+) -> None:
+    """
+    Run chunk -> TTS -> ASR check -> organize as one streaming pipeline.
+
+    Stages are connected by bounded in-memory queues and run concurrently, so the first
+    clips are checked and organized while later paragraphs are still being synthesized.
+    TTS audio goes to ASR as bytes without touching the disk; only kept clips are written.
+
+    Outputs in output_dir:
+        wavs/ (wavs/<Voice>/ with several voices) and txts/: the kept pairs, as organize_pairs writes them
+        asrcompare.jsonl: every scored clip (filename, voice, text, kept, and the scores of batch_compare_asr_ref.py)
+
+    Args:
+        input_file: Rewritten paragraphs, one "topic<TAB>paragraph" per line (as chunk_sentences.py reads)
+        output_dir: Output directory
+        voices: Comma-separated Chirp 3 voices; each sentence is synthesized once per voice
+        filename_prefix: Clip id prefix (ids are prefix + sentence number, like run_chirp3_tts_batch.py)
+        num_digits: Zero-padding of the sentence number (as in run_chirp3_tts_batch.py, so ids match its files)
+        tts_workers: Concurrent TTS requests (with adaptive, the most allowed)
+        asr_workers: Concurrent ASR requests (with adaptive, the most allowed)
+        queue_size: Capacity of each queue between stages
+        min_duration: Pack sentences to at least this estimated duration (see chunk_sentences.py; 0 = no packing)
+        max_duration: Split or pack sentences to at most this estimated duration
+        language: Language code for duration estimates
+        do_unique: Skip sentences already seen
+        min_char_sim: Minimum character similarity of a kept clip
+        min_char_sim_for_short_lines: Minimum character similarity of short kept clips
+        detect_ending_noise: Reject clips where ASR hears more than the reference at the end
+        asr_retries: Attempts per clip before it fails
+        follow: Keep reading input_file while it grows (run next to the rewrite script)
+        idle_timeout: With follow, stop after the input has not grown for this many seconds
+        limit: Stop after this many sentences (0 = all)
+        report_every: Seconds between progress lines
+        metrics_dir: Export metrics to metrics_dir/pipeline.prom periodically and pipeline.summary.json at exit
+        run_db: Also record every scored clip in this run database (run_db.py): text, transcript,
+            scores and kept flag, and the WAV path of kept clips, so it can be re-selected later
+        adaptive: Adapt the TTS and ASR concurrency to the API's latency and quota errors (aimd.py)
+        aimd_log: With adaptive, append every change of the concurrency limits to this JSONL file
+    """
+    # Imported here so the chunk/score helpers above can be used without Google credentials
+    from run_chirp3_tts_batch import get_voice_from_name, synthesize_bytes
+    from run_cloud_asr_batch_1speaker import recognize_bytes
+
+    if metrics_dir:
+        start_export(metrics_dir, 'pipeline')
+
+    voice_names = [v.strip() for v in voices.split(',') if v.strip()]
+    voice_params = {name: get_voice_from_name(name) for name in voice_names}
+    multivoice = len(voice_names) > 1
+    txt_dir = os.path.join(output_dir, 'txts')
+    wav_dirs = {name: os.path.join(output_dir, 'wavs', name) if multivoice else os.path.join(output_dir, 'wavs')
+                for name in voice_names}
+    for d in [txt_dir, *wav_dirs.values()]:
+        os.makedirs(d, exist_ok=True)
+
+    packing = (min_duration, max_duration, language) if max_duration > 0 else None
+    seen = SeenSentences() if do_unique else None
+
+    tts_queue = queue.Queue(maxsize=queue_size)
+    asr_queue = queue.Queue(maxsize=queue_size)
+    score_queue = queue.Queue(maxsize=queue_size)
+    organize_queue = queue.Queue(maxsize=queue_size)
+
+    tts_limiter = limiter_or_none(adaptive, 'tts', tts_workers, aimd_log)
+    asr_limiter = limiter_or_none(adaptive, 'asr', asr_workers, aimd_log)
+
+    # Wait for the host-wide quota before taking a slot, so quota waits do not count as API latency
+    def synthesize(item):
+        quota_governor.acquire('tts')
+        with maybe_slot(tts_limiter):
+            item['audio'] = synthesize_bytes(item['text'], voice=voice_params[item['voice']], acquire_quota=False)
+        return item
+
+    def recognize(item):
+        name = f"{item['id']}-{item['voice']}.wav"
+        for attempt in range(asr_retries):
+            try:
+                quota_governor.acquire('speech')
+                with maybe_slot(asr_limiter):
+                    asr_text = recognize_bytes(item['audio'], name=name, sample_rate=wav_sample_rate(item['audio']),
+                                               raise_errors=True, acquire_quota=False)
+            except Exception as e:
+                print(f"Error processing {name}: {e}")
+                asr_text = None
+            if asr_text is not None:
+                item['asr_text'] = asr_text
+                return item
+            if attempt < asr_retries - 1:
+                time.sleep(2)
+        raise RuntimeError(f"ASR failed after {asr_retries} attempts for {name}")
+
+    fcompare = open(os.path.join(output_dir, 'asrcompare.jsonl'), 'w', encoding='utf-8')
+    db = RunDB(run_db) if run_db else None
+
+    def record_in_db(item, wav_path):
+        db.record_tts(item['id'], item['voice'], item['text'], wav_path)
+        db.record_asr(item['id'], item['voice'], item['asr_text'])
+        db.record_scores(item['id'], item['voice'], item['scores'], kept=wav_path is not None)
+
+    def score(item):
+        scores, _ = score_pair(item['asr_text'], item['text'], detect_ending_noise=detect_ending_noise,
+                               verbose=verbose, name=item['id'])
+        kept = is_kept(scores, min_char_sim, min_char_sim_for_short_lines)
+        record = {'filename': item['id'] + '.wav', 'voice': item['voice'], 'text': item['asr_text'], 'kept': kept, **scores}
+        fcompare.write(json.dumps(record, ensure_ascii=False) + '\n')
+        fcompare.flush()
+        if verbose:
+            print(f"[{item['id']}/{item['voice']}] sim_char={scores['sim_char']:.3f} {'kept' if kept else 'rejected'}")
+        item['scores'] = scores
+        if not kept:
+            if db is not None:
+                record_in_db(item, None)
+            return None
+        item['reference_text'] = scores['reference_text']
+        return item
+
+    def organize(item):
+        wav_path = os.path.join(wav_dirs[item['voice']], item['id'] + '.wav')
+        with open(wav_path, 'wb') as f:
+            f.write(item['audio'])
+        with open(os.path.join(txt_dir, item['id'] + '.txt'), 'w', encoding='utf-8') as f:
+            f.write(item['reference_text'])
+        if db is not None:
+            record_in_db(item, wav_path)
+        return item
+
+    # The scorer appends to a single file, so it runs on one thread; it is cheap next to TTS and ASR
+    stages = [
+        Stage('tts', synthesize, tts_workers, tts_queue, asr_queue),
+        Stage('asr', recognize, asr_workers, asr_queue, score_queue),
+        Stage('score', score, 1, score_queue, organize_queue),
+        Stage('organize', organize, 2, organize_queue),
+    ]
+    for stage, next_stage in zip(stages, stages[1:]):
+        stage.downstream_workers = next_stage.num_workers
+    for stage in stages:
+        stage.start()
+
+    # Chunk on the main thread: it is fast, and blocking on the full TTS queue is the backpressure
+    started = time.monotonic()
+    last_report = started
+    sentence_idx = 0
+    for line in read_lines(input_file, follow=follow, idle_timeout=idle_timeout):
+        chunked = chunk_line(line, verbose=verbose, packing=packing)
+        if chunked is None:
+            continue
+        for sentence in chunked[1]:
+            if seen is not None and not seen.add(sentence):
+                continue
+            item_id = tts_item_id(filename_prefix, sentence_idx, num_digits)
+            sentence_idx += 1
+            for voice_name in voice_names:
+                tts_queue.put({'id': item_id, 'voice': voice_name, 'text': sentence})
+            if time.monotonic() - last_report >= report_every:
+                last_report = time.monotonic()
+                print_progress(stages, sentence_idx, last_report - started)
+            if limit and sentence_idx >= limit:
+                break
+        if limit and sentence_idx >= limit:
+            break
+    for _ in range(stages[0].num_workers):
+        tts_queue.put(_DONE)
+
+    # Keep reporting while the queues drain
+    for stage in stages:
+        while not stage.join(timeout=report_every):
+            print_progress(stages, sentence_idx, time.monotonic() - started)
+    fcompare.close()
+    if seen is not None:
+        seen.close()
+    if db is not None:
+        db.print_summary()
+        db.close()
+
+    elapsed = time.monotonic() - started
+    print_progress(stages, sentence_idx, elapsed)
+    for stage in stages:
+        utilization = stage.stats.latency_sum / (elapsed * stage.num_workers) if elapsed else 0.0
+        print(f"{stage.name}: {stage.num_workers} workers, {utilization:.0%} busy, {stage.dropped} dropped")
+    for limiter in (tts_limiter, asr_limiter):
+        if limiter is not None:
+            limiter.print_summary()
+            limiter.close()
+    print_summary()
+    kept = stages[-1].stats.count - stages[-1].stats.errors
+    print(f"\nPipeline complete in {elapsed:.1f}s: {sentence_idx} sentences x {len(voice_names)} voices, "
+          f"{kept} clips kept in {output_dir}")
+
+
+def print_progress(stages, sentences, elapsed):
+    """One line with items done / failed / in flight and queue depth per stage."""
+    parts = [f"{s.name}: {s.stats.count - s.stats.errors} done, {s.stats.errors} failed, "
+             f"{s.stats.in_flight} in flight, queue {s.inbox.qsize()}" for s in stages]
+    print(f"[{elapsed:.0f}s] {sentences} sentences | " + ' | '.join(parts))
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(run_pipeline)
+
+# python pipeline.py all-rewritten-v1-4o-mini.txt OUTPUT-pipeline --voices Aoede,Kore --tts-workers 8 --asr-workers 16
+# python rewrite_chatting_style.py rewritten-v1-nano-300.txt rewritten-chatting.txt -k openai-key.txt --concurrency 16 &
+# python pipeline.py rewritten-chatting.txt OUTPUT-pipeline --follow --max-duration 12
+# python pipeline.py all-rewritten-v1-4o-mini.txt OUTPUT-pipeline --tts-workers 32 --asr-workers 32 --adaptive --aimd-log aimd.jsonl
@@ -0,0 +1,132 @@
+import json
+from collections import Counter
+from typing import Optional, Tuple
+import profiling
+from batch_compare_asr_ref import SHORT_LINE_CHARS, is_persona_reference, purify_reference
+from chunk_sentences import estimate_duration
+
+# List prices in USD: Chirp 3 HD voices per 1M input characters, Speech-to-Text per audio minute
+TTS_USD_PER_MILLION_CHARS = 30.0
+ASR_USD_PER_MINUTE = 0.024
+
+# Outcome of check_line for a line that is synthesized
+KEPT_REASONS = ('ok', 'fixed', 'short')
+
+
+def check_line(line: str, drop_short_lines: bool = False) -> Tuple[Optional[str], str]:
+    """
+    Apply the reference rules of batch_compare_asr_ref.py to a TTS input line before synthesis.
+
+    Smart quotes, ellipsis characters and dashes are replaced by plain ASCII (the reference
+    is purified the same way after ASR, so the spoken and compared texts stay equal). Lines
+    that would be scored 0 later are dropped: empty lines, invalid characters and
+    self-introductions. Lines shorter than SHORT_LINE_CHARS are only kept after ASR with a
+    high similarity; drop_short_lines drops them too.
+
+    Returns:
+        Tuple of (text to synthesize or None if dropped, reason): ok, fixed, short,
+        or empty, invalid_charset, my_name_is, short_dropped for dropped lines.
+    """
+    stripped = line.strip()
+    text, is_valid = purify_reference(stripped)
+    text = text.strip()
+    if not text:
+        return None, 'empty'
+    if not is_valid:
+        return None, 'invalid_charset'
+    if is_persona_reference(text):
+        return None, 'my_name_is'
+    if len(text) < SHORT_LINE_CHARS:
+        return (None, 'short_dropped') if drop_short_lines else (text, 'short')
+    return text, 'fixed' if text != stripped else 'ok'
+
+
+class Preflight:
+    """Checks TTS input lines and tallies what was dropped and the TTS and ASR spend avoided."""
+
+    def __init__(self, drop_short_lines: bool = False, num_voices: int = 1, language: str = 'en',
+                 tts_usd_per_million_chars: float = TTS_USD_PER_MILLION_CHARS, asr_usd_per_minute: float = ASR_USD_PER_MINUTE):
+        self.drop_short_lines = drop_short_lines
+        self.num_voices = num_voices
+        self.language = language
+        self.tts_usd_per_million_chars = tts_usd_per_million_chars
+        self.asr_usd_per_minute = asr_usd_per_minute
+        self.reasons = Counter()
+        self.saved_chars = 0
+        self.saved_seconds = 0.0
+
+    def check(self, line: str) -> Tuple[Optional[str], str]:
+        """check_line, counting the outcome and, for a dropped line, the synthesis and ASR it saves."""
+        text, reason = check_line(line, self.drop_short_lines)
+        self.reasons[reason] += 1
+        if text is None:
+            stripped = line.strip()
+            self.saved_chars += len(stripped) * self.num_voices
+            self.saved_seconds += estimate_duration(stripped, self.language) * self.num_voices
+        return text, reason
+
+    @property
+    def saved_usd(self) -> Tuple[float, float]:
+        """Projected (TTS, ASR) USD not spent on dropped lines."""
+        return (self.saved_chars * self.tts_usd_per_million_chars / 1e6,
+                self.saved_seconds / 60 * self.asr_usd_per_minute)
+
+    def print_summary(self) -> None:
+        total = sum(self.reasons.values())
+        dropped = sum(n for reason, n in self.reasons.items() if reason not in KEPT_REASONS)
+        details = ', '.join(f"{reason} {n}" for reason, n in sorted(self.reasons.items()))
+        tts_usd, asr_usd = self.saved_usd
+        print(f"Preflight: {total} lines, {dropped} dropped ({details})")
+        if self.reasons['short']:
+            print(f"  {self.reasons['short']} short lines (< {SHORT_LINE_CHARS} chars) kept; they need a high "
+                  f"similarity after ASR (--drop-short-lines to skip them)")
+        print(f"  Saved {self.saved_chars} TTS characters and ~{self.saved_seconds / 60:.1f} min of ASR "
+              f"over {self.num_voices} voice(s): ~${tts_usd:.4f} TTS + ~${asr_usd:.4f} ASR")
+
+
+def preflight(
+    input_file: str,
+    output_file: str,
+    rejected_file: str = None,
+    drop_short_lines: bool = False,
+    voices: str = 'Aoede',
+    language: str = 'en',
+    tts_usd_per_million_chars: float = TTS_USD_PER_MILLION_CHARS,
+    asr_usd_per_minute: float = ASR_USD_PER_MINUTE,
+) -> None:
+    """
+    Clean a TTS input file before synthesis: fix what can be fixed, drop lines that would be discarded.
+
+    Output lines keep their input order, so item ids (chrp0000, ...) are those of the
+    cleaned file. To keep the ids of the original file, use `run_chirp3_tts_batch.py batch
+    --preflight` instead, which skips dropped lines in place.
+
+    Args:
+        input_file: TTS input, one sentence per line
+        output_file: Lines to synthesize
+        rejected_file: Also write the dropped lines as JSONL ({"line", "text", "reason"})
+        drop_short_lines: Drop lines shorter than SHORT_LINE_CHARS as well
+        voices: Comma-separated voices the lines will be synthesized with (multiplies the savings)
+        language: Language code for the ASR duration estimate
+        tts_usd_per_million_chars: TTS price used for the projected savings
+        asr_usd_per_minute: ASR price used for the projected savings
+    """
+    checker = Preflight(drop_short_lines, len([v for v in voices.split(',') if v.strip()]), language,
+                        tts_usd_per_million_chars, asr_usd_per_minute)
+    frejected = open(rejected_file, 'w', encoding='utf-8') if rejected_file else None
+    with open(input_file, 'r', encoding='utf-8') as fin, open(output_file, 'w', encoding='utf-8') as fout:
+        for idx, line in enumerate(fin):
+            text, reason = checker.check(line)
+            if text is not None:
+                fout.write(text + '\n')
+            elif frejected is not None:
+                frejected.write(json.dumps({'line': idx, 'text': line.rstrip('\n'), 'reason': reason}, ensure_ascii=False) + '\n')
+    if frejected is not None:
+        frejected.close()
+    checker.print_summary()
+
+
+if __name__ == "__main__":
+    profiling.dispatch_command(preflight)
+
+# python preflight.py all-rewritten-chunk-uniq.txt all-rewritten-chunk-preflight.txt --rejected-file rejected.jsonl --voices Aoede,Kore
@@ -0,0 +1,305 @@
+import argparse
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+import argh
+from argh.assembling import add_commands, set_default_command
+from argh.constants import PARSER_FORMATTER
+try:
+    from argh.assembling import NameMappingPolicy
+    # argh >= 0.30 asks how to map arguments with defaults; this is the mapping of older versions
+    NAME_MAPPING = {'name_mapping_policy': NameMappingPolicy.BY_NAME_IF_HAS_DEFAULT}
+except ImportError:  # argh < 0.30 always maps them this way
+    NAME_MAPPING = {}
+from stage_metrics import METRICS, Metrics
+
+PROFILE_TOOLS = ('sample', 'cprofile', 'tracemalloc')
+
+
+class StackSampler(threading.Thread):
+    """
+    Wall-clock stack sampler: every interval, the current stack of every other thread is
+    counted, rooted at the outermost stage the thread is in (or its thread name).
+
+    Only sys._current_frames() is read, so the sampled code is not slowed down; the cost is
+    the sampler thread itself, about a frame walk per thread per interval.
+    """
+
+    def __init__(self, metrics: Metrics, interval: float = 0.01, on_flush: Optional[Callable[[], None]] = None,
+                 flush_every: float = 60.0):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self.on_flush = on_flush
+        self.flush_every = flush_every
+        self.stacks: Counter = Counter()  # (root, frame, ...) -> samples
+        self.samples = 0
+        self._labels: Dict[object, str] = {}
+        self._stop_event = threading.Event()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            label = f"{module}.{getattr(code, 'co_qualname', code.co_name)}".replace(';', ':').replace(' ', '_')
+            self._labels[code] = label
+        return label
+
+    def sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for tid, frame in sys._current_frames().items():
+            if tid == self.ident:
+                continue
+            stages = self.metrics.thread_stages.get(tid)
+            root = stages[0] if stages else names.get(tid, 'thread')
+            frames = []
+            while frame is not None:
+                frames.append(self._label(frame.f_code))
+                frame = frame.f_back
+            frames.append(root)
+            self.stacks[tuple(reversed(frames))] += 1
+        self.samples += 1
+
+    def run(self) -> None:
+        last_flush = time.monotonic()
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+            if self.on_flush is not None and time.monotonic() - last_flush >= self.flush_every:
+                last_flush = time.monotonic()
+                self.on_flush()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler:
+    """
+    Profile one job into out_dir, by stage (the stages of stage_metrics.METRICS).
+
+    Tools:
+        sample: wall-clock stack sampling (StackSampler), cheap enough to leave on. Written to
+            <job>.collapsed, one "root;frame;...;frame count" line per stack, the input of
+            flamegraph.pl, inferno or speedscope; rewritten every flush_every seconds during the run.
+        cprofile: deterministic profile of each stage (the work inside METRICS.track) and of the
+            main thread outside any stage, written to <job>.<stage>.pstats (snakeviz, pstats).
+            Slows down Python-heavy code; on Python 3.12+ only one thread is profiled at a time.
+        tracemalloc: the lines that allocated the most memory still held at the end, and the peak.
+
+    <job>.profile.txt summarizes all of them: samples and top functions per stage.
+    """
+
+    def __init__(self, out_dir: str, job: str, tools: Tuple[str, ...] = ('sample',), interval: float = 0.01,
+                 flush_every: float = 60.0, metrics: Metrics = METRICS):
+        unknown = set(tools) - set(PROFILE_TOOLS)
+        if unknown:
+            raise ValueError(f"Unknown profile tools {sorted(unknown)}, expected some of {PROFILE_TOOLS}")
+        self.out_dir = out_dir
+        self.job = job
+        self.tools = tools
+        self.metrics = metrics
+        self.started = 0.0
+        self.sampler = StackSampler(metrics, interval, self.write_collapsed, flush_every) if 'sample' in tools else None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stage_profiles: Dict[str, List[cProfile.Profile]] = {}
+        self._skipped = 0  # stage calls not profiled because another profiler was active (Python 3.12+)
+
+    def _path(self, suffix: str) -> str:
+        return os.path.join(self.out_dir, f"{self.job}{suffix}")
+
+    def start(self) -> None:
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.started = time.monotonic()
+        if 'tracemalloc' in self.tools:
+            tracemalloc.start()
+        if 'cprofile' in self.tools:
+            self.metrics.listeners.append(self)
+            self._local.active = self._enable(self._profile_for('main'))
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def _profile_for(self, stage: str) -> cProfile.Profile:
+        """This thread's profile of stage, accumulated over all its calls."""
+        profiles = self._local.__dict__.setdefault('profiles', {})
+        if stage not in profiles:
+            profiles[stage] = cProfile.Profile()
+            with self._lock:
+                self._stage_profiles.setdefault(stage, []).append(profiles[stage])
+        return profiles[stage]
+
+    def _enable(self, profile: cProfile.Profile) -> Optional[cProfile.Profile]:
+        try:
+            profile.enable()
+        except ValueError:  # another thread's profile is active (sys.monitoring allows one)
+            self._skipped += 1
+            return None
+        return profile
+
+    def stage_enter(self, stage: str) -> None:
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        if depth:
+            return  # nested stage (e.g. an API call inside a pipeline stage): counted in the outer one
+        outer = getattr(self._local, 'active', None)
+        if outer is not None:
+            outer.disable()
+        self._local.outer = outer
+        self._local.active = self._enable(self._profile_for(stage))
+
+    def stage_exit(self, stage: str) -> None:
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        if self._local.active is not None:
+            self._local.active.disable()
+        self._local.active = self._local.outer
+        if self._local.active is not None:
+            self._local.active.enable()
+
+    def write_collapsed(self) -> None:
+        """Write the stacks sampled so far (atomically, so a viewer never sees a partial file)."""
+        path = self._path('.collapsed')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.sampler.stacks.copy().items()):
+                f.write(f"{';'.join(stack)} {count}\n")
+        os.replace(path + '.tmp', path)
+
+    def _sample_report(self, out) -> None:
+        stacks = self.sampler.stacks.copy()
+        by_root: Dict[str, Counter] = {}
+        for stack, count in stacks.items():
+            by_root.setdefault(stack[0], Counter())[stack[-1]] += count
+        total = sum(stacks.values())
+        print(f"Wall-clock samples: {self.sampler.samples} every {self.sampler.interval * 1000:.0f} ms, "
+              f"{total} thread samples", file=out)
+        for root, leaves in sorted(by_root.items(), key=lambda item: -sum(item[1].values())):
+            samples = sum(leaves.values())
+            print(f"\n{root}: {samples} samples ({samples / total:.1%}), top functions by self time:", file=out)
+            for leaf, count in leaves.most_common(10):
+                print(f"  {count / samples:6.1%}  {leaf}", file=out)
+
+    def _cprofile_report(self, out) -> None:
+        with self._lock:
+            stage_profiles = dict(self._stage_profiles)
+        for stage, profiles in sorted(stage_profiles.items()):
+            stats = None
+            for profile in profiles:
+                profile.create_stats()
+                if not profile.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profile, stream=out)
+                else:
+                    stats.add(profile)
+            if stats is None:
+                continue
+            stats.dump_stats(self._path(f".{stage}.pstats"))
+            print(f"\ncProfile of {stage} ({self._path(f'.{stage}.pstats')}):", file=out)
+            stats.sort_stats('cumulative').print_stats(15)
+        if self._skipped:
+            print(f"\n{self._skipped} stage calls were not profiled while another thread's profile was active", file=out)
+
+    def _tracemalloc_report(self, out) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        print(f"\ntracemalloc: {current / 1e6:.1f} MB held at exit, peak {peak / 1e6:.1f} MB; top allocating lines:",
+              file=out)
+        for stat in snapshot.statistics('lineno')[:15]:
+            print(f"  {stat}", file=out)
+
+    def stop(self) -> None:
+        """Stop all tools and write the outputs."""
+        if self.sampler is not None:
+            self.sampler.stop()
+        if 'cprofile' in self.tools:
+            self.metrics.listeners.remove(self)
+            if getattr(self._local, 'active', None) is not None:
+                self._local.active.disable()
+        out = io.StringIO()
+        print(f"Profile of {self.job}: {time.monotonic() - self.started:.1f}s wall, tools {','.join(self.tools)}", file=out)
+        if self.sampler is not None:
+            self.write_collapsed()
+            self._sample_report(out)
+        if 'cprofile' in self.tools:
+            self._cprofile_report(out)
+        if 'tracemalloc' in self.tools:
+            self._tracemalloc_report(out)
+        with open(self._path('.profile.txt'), 'w', encoding='utf-8') as f:
+            f.write(out.getvalue())
+        outputs = ['.profile.txt'] + (['.collapsed'] if self.sampler is not None else [])
+        print(f"Profile written to {', '.join(self._path(suffix) for suffix in outputs)}")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _profile_options() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    group = parser.add_argument_group('profiling')
+    group.add_argument('--profile', action='store_true',
+                       help="profile the run: wall-clock stack samples per stage as <job>.collapsed "
+                            "(flamegraph-ready) and a <job>.profile.txt summary, in --profile-dir")
+    group.add_argument('--profile-dir', default=None, metavar='DIR',
+                       help="directory of the profile outputs (default: ./profile, relative to the working "
+                            "directory, not to the job's outputs); implies --profile if given")
+    group.add_argument('--profile-tools', default='sample',
+                       help=f"comma-separated tools among {', '.join(PROFILE_TOOLS)}; cprofile and tracemalloc add overhead")
+    group.add_argument('--profile-interval', type=float, default=0.01, help="seconds between stack samples")
+    return parser
+
+
+def split_profile_args(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
+    """
+    Take the profiling options out of argv (they may come anywhere); returns them and the rest.
+
+    --profile takes no value, so it never swallows the positional argument after it.
+    """
+    options, rest = _profile_options().parse_known_args(argv)
+    options.profile = options.profile or options.profile_dir is not None
+    options.profile_dir = options.profile_dir or 'profile'
+    return options, rest
+
+
+def _dispatch(parser: argparse.ArgumentParser, job: Callable[[List[str]], str], argv: Optional[List[str]]) -> None:
+    """Dispatch argv without the profiling options with argh, profiled as job(rest) if asked for."""
+    options, rest = split_profile_args(sys.argv[1:] if argv is None else argv)
+    if not options.profile:
+        argh.dispatch(parser, argv=rest)
+        return
+    tools = tuple(tool.strip() for tool in options.profile_tools.split(',') if tool.strip())
+    with Profiler(options.profile_dir, job(rest), tools, options.profile_interval):
+        argh.dispatch(parser, argv=rest)
+
+
+def dispatch_command(function: Callable, argv: Optional[List[str]] = None) -> None:
+    """argh.dispatch_command with the --profile options; the profile is named after the function."""
+    parser = argparse.ArgumentParser(formatter_class=PARSER_FORMATTER, parents=[_profile_options()])
+    set_default_command(parser, function, **NAME_MAPPING)
+    _dispatch(parser, lambda rest: function.__name__, argv)
+
+
+def dispatch_commands(functions: List[Callable], argv: Optional[List[str]] = None) -> None:
+    """argh.dispatch_commands with the --profile options; the profile is named script.command."""
+    parser = argparse.ArgumentParser(formatter_class=PARSER_FORMATTER, parents=[_profile_options()])
+    add_commands(parser, functions, **NAME_MAPPING)
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+    def job(rest: List[str]) -> str:
+        # Without the profiling options, the only options before the command are argparse's own (--help)
+        command = next((arg for arg in rest if not arg.startswith('-')), 'main')
+        return f"{script}.{command}"
+
+    _dispatch(parser, job, argv)
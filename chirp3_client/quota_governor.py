@@ -0,0 +1,197 @@
+import contextlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Iterator, Optional
+import profiling
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Requests per minute per API for the whole host. None by default: requests are only throttled
+# for the APIs given in quota.json, e.g. "tts" (Chirp 3 HD synthesize_speech) and "speech"
+# (recognize / long_running_recognize), set to your project's quota
+DEFAULT_QUOTAS: Dict[str, float] = {}
+
+# quota.json next to the scripts (or $CHIRP3_QUOTA_CONFIG), e.g. {"tts": 500, "speech": 900}
+CONFIG_PATH = os.environ.get('CHIRP3_QUOTA_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quota.json'))
+# Shared bucket state of all processes on the host
+STATE_DIR = os.environ.get('CHIRP3_QUOTA_DIR', os.path.join(tempfile.gettempdir(), 'chirp3-quota'))
+
+# Providers enforce per-minute quotas over shorter windows, so bursts are capped at this much budget
+BURST_SECONDS = 6.0
+# Longest single sleep while waiting, so a raised limit or a freed bucket is noticed quickly
+MAX_SLEEP_SECONDS = 1.0
+
+
+def load_quotas(config_path: str = CONFIG_PATH) -> Dict[str, float]:
+    """Per-API requests per minute from the JSON config file, if any (no file: no limits)."""
+    quotas = dict(DEFAULT_QUOTAS)
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            quotas.update(json.load(f))
+    return quotas
+
+
+@contextlib.contextmanager
+def _locked(path: str) -> Iterator[object]:
+    """Open path read/write under an exclusive lock shared by all processes on the host."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    f = os.fdopen(fd, 'r+')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        yield f
+    finally:
+        if fcntl is None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        f.close()  # closing releases the flock
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # exists, owned by someone else (or not checkable on this platform)
+    return True
+
+
+class QuotaGovernor:
+    """
+    Host-wide token buckets, one per API, shared by every process through a locked state file.
+
+    Each acquire() takes the file lock, refills the bucket for the time elapsed since the
+    last update, takes one token if available and writes the state back; otherwise it
+    sleeps until a token is due and tries again. So any number of TTS and ASR processes
+    on the host together stay within the configured requests per minute.
+
+    The state file also keeps the request times of the last minute and the processes
+    using the bucket, for `python quota_governor.py status`.
+    """
+
+    def __init__(self, quotas: Optional[Dict[str, float]] = None, state_dir: str = STATE_DIR):
+        self.quotas = quotas if quotas is not None else load_quotas()
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def state_path(self, api: str) -> str:
+        return os.path.join(self.state_dir, f"{api}.json")
+
+    def _update(self, f, api: str, now: float, take: bool) -> float:
+        """Refill and optionally take a token under the lock; returns seconds until a token is due."""
+        rpm = self.quotas.get(api, 0)
+        capacity = max(1.0, rpm * BURST_SECONDS / 60.0)
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except json.JSONDecodeError:
+            state = {}
+        tokens = min(capacity, state.get('tokens', capacity) + (now - state.get('updated', now)) * rpm / 60.0)
+        recent = [t for t in state.get('recent', []) if t > now - 60]
+        clients = state.get('clients', {})
+        clients[str(os.getpid())] = now
+        wait = 0.0
+        if take:
+            if tokens >= 1:
+                tokens -= 1
+                recent.append(now)
+            else:
+                wait = (1 - tokens) * 60.0 / rpm
+        state = {'rpm': rpm, 'tokens': tokens, 'updated': now, 'recent': recent,
+                 'clients': {pid: seen for pid, seen in clients.items() if seen > now - 60}}
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state))
+        f.flush()
+        return wait
+
+    def acquire(self, api: str) -> float:
+        """Block until one request to api is allowed; returns the seconds spent waiting."""
+        if not self.quotas.get(api):
+            return 0.0  # no limit configured
+        start = time.monotonic()
+        while True:
+            with _locked(self.state_path(api)) as f:
+                wait = self._update(f, api, time.time(), take=True)
+            if wait <= 0:
+                return time.monotonic() - start
+            time.sleep(min(wait, MAX_SLEEP_SECONDS))
+
+    def status(self, api: str) -> Dict[str, float]:
+        """Limit, requests in the last minute, utilization and live processes of one API."""
+        with _locked(self.state_path(api)) as f:
+            self._update(f, api, time.time(), take=False)
+            f.seek(0)
+            state = json.loads(f.read())
+        rpm = state['rpm']
+        used = len(state['recent'])
+        clients = [int(pid) for pid in state['clients'] if _pid_alive(int(pid)) and int(pid) != os.getpid()]
+        return {
+            'rpm': rpm,
+            'used_last_minute': used,
+            'utilization': used / rpm if rpm else 0.0,
+            'tokens': state['tokens'],
+            'processes': clients,
+        }
+
+
+_governor = None
+
+
+def acquire(api: str) -> float:
+    """acquire() on the host-wide governor of this process, created on first use."""
+    global _governor
+    if _governor is None:
+        _governor = QuotaGovernor()
+    return _governor.acquire(api)
+
+
+def status(watch: bool = False, interval: float = 2.0, config_path: str = CONFIG_PATH, state_dir: str = STATE_DIR):
+    """
+    Show the host-wide quota utilization of each API.
+
+    Args:
+        watch: Refresh every interval seconds until interrupted
+        interval: Refresh interval in seconds
+        config_path: JSON file with {"api": requests_per_minute}
+        state_dir: Directory of the shared bucket state
+    """
+    governor = QuotaGovernor(load_quotas(config_path), state_dir)
+    if not governor.quotas:
+        print(f"No quotas configured in {config_path}: requests are not throttled")
+        return
+    while True:
+        for api in sorted(governor.quotas):
+            s = governor.status(api)
+            print(f"{api:<8} {s['used_last_minute']:>6}/{s['rpm']:<6} per minute  {s['utilization']:>6.1%}  "
+                  f"tokens {s['tokens']:>6.1f}  processes {','.join(map(str, s['processes'])) or '-'}")
+        if not watch:
+            break
+        time.sleep(interval)
+        print()
+
+
+def reset(config_path: str = CONFIG_PATH, state_dir: str = STATE_DIR):
+    """Delete the shared bucket state (e.g. after changing the config while nothing is running)."""
+    for api in load_quotas(config_path):
+        path = os.path.join(state_dir, f"{api}.json")
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"Removed {path}")
+
+
+if __name__ == "__main__":
+    profiling.dispatch_commands([status, reset])
+
+# python quota_governor.py status --watch
+# echo '{"tts": 500, "speech": 900}' > quota.json
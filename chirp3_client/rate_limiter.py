@@ -0,0 +1,219 @@
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+# Default (requests per minute, tokens per minute) by model-name prefix, used with --rate-limit-defaults;
+# --rpm / --tpm override them
+MODEL_LIMITS = {
+    'gpt-4.1-nano': (500, 200000),
+    'gpt-4.1-mini': (500, 200000),
+    'gpt-4.1': (500, 30000),
+    'gpt-4o-mini': (500, 200000),
+    'gpt-4o': (500, 30000),
+    'qwen': (1200, 1000000),  # DashScope compatible mode
+}
+DEFAULT_LIMITS = (60, 60000)
+# Providers enforce per-minute limits over shorter windows, so bursts are capped at this much budget
+BURST_SECONDS = 6.0
+
+
+def model_limits(model: str) -> Tuple[int, int]:
+    """(rpm, tpm) for a model, matching the longest known model-name prefix."""
+    matches = [name for name in MODEL_LIMITS if model.startswith(name)]
+    if not matches:
+        return DEFAULT_LIMITS
+    return MODEL_LIMITS[max(matches, key=len)]
+
+
+def _parse_duration(value: str) -> float:
+    """Parse rate-limit reset durations such as '1s', '6m0s', '250ms' or '12' into seconds."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for number, unit in re.findall(r'([\d.]+)(ms|s|m|h)', value):
+        seconds += float(number) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_min, holding at most burst_seconds of budget (rate 0 = unlimited)."""
+
+    def __init__(self, rate_per_min: float, burst_seconds: float = BURST_SECONDS):
+        self.rate_per_min = rate_per_min
+        self.capacity = max(1.0, rate_per_min * burst_seconds / 60.0)
+        self.tokens = self.capacity
+        self._last = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if not self.rate_per_min:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate_per_min / 60.0)
+        self._last = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount is available (amounts above capacity only need a full bucket)."""
+        if not self.rate_per_min:
+            return 0.0
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing * 60.0 / self.rate_per_min)
+
+
+class RateScheduler:
+    """
+    Client-side scheduler enforcing a model's requests-per-minute and tokens-per-minute budgets.
+
+    Before each send, callers acquire one request and the estimated prompt tokens; the call
+    blocks (or awaits) until both token buckets allow it. After the call, release() charges
+    the completion tokens and, on a 429, applies the provider's rate-limit headers: the
+    buckets are clamped to x-ratelimit-remaining-* and sending pauses until the reset or
+    Retry-After time. Thread-safe; acquire() is for threads, aacquire() for asyncio.
+
+    A budget of 0 takes the model's default from MODEL_LIMITS, or is unlimited without
+    use_model_defaults (429 feedback still pauses sending).
+    """
+
+    def __init__(self, model: str, rpm: int = 0, tpm: int = 0, report_every: float = 30.0, use_model_defaults: bool = True):
+        default_rpm, default_tpm = model_limits(model) if use_model_defaults else (0, 0)
+        self.model = model
+        self.rpm = rpm or default_rpm
+        self.tpm = tpm or default_tpm
+        self.requests = TokenBucket(self.rpm)
+        self.tokens = TokenBucket(self.tpm)
+        self.waiting = 0
+        self.in_flight = 0
+        self.rate_limited = 0
+        self.report_every = report_every
+        self._paused_until = 0.0
+        self._sent = deque()  # (time, requests, tokens) of the last minute, for utilization
+        self._last_report = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """Take one request and `tokens` from the buckets if possible; otherwise return the wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                return wait
+            self.requests.tokens -= 1
+            self.tokens.tokens -= tokens
+            self.in_flight += 1
+            self._sent.append((now, 1, tokens))
+            return 0.0
+
+    def acquire(self, tokens: int) -> None:
+        """Block until a request with `tokens` prompt tokens may be sent."""
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self._reserve(tokens)
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        self._maybe_report()
+
+    async def aacquire(self, tokens: int) -> None:
+        """asyncio version of acquire()."""
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self._reserve(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        self._maybe_report()
+
+    def release(self, completion_tokens: int = 0, headers: Optional[Dict[str, str]] = None, rate_limited: bool = False) -> None:
+        """Finish a request: charge completion tokens and adapt to rate-limit feedback."""
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if completion_tokens:
+                self.tokens.refill(now)
+                self.tokens.tokens -= completion_tokens
+                self._sent.append((now, 0, completion_tokens))
+            if headers:
+                self._apply_headers(now, {k.lower(): v for k, v in headers.items()})
+            if rate_limited:
+                self.rate_limited += 1
+                # Without a usable reset hint, back off for a second
+                self._paused_until = max(self._paused_until, now + 1.0)
+
+    def _apply_headers(self, now: float, headers: Dict[str, str]) -> None:
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        if remaining_requests is not None:
+            self.requests.refill(now)
+            self.requests.tokens = min(self.requests.tokens, float(remaining_requests))
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        if remaining_tokens is not None:
+            self.tokens.refill(now)
+            self.tokens.tokens = min(self.tokens.tokens, float(remaining_tokens))
+        pause = 0.0
+        if 'retry-after' in headers:
+            pause = _parse_duration(headers['retry-after'])
+        # The reset times only matter for a budget that is exhausted
+        for kind in ('requests', 'tokens'):
+            reset = headers.get(f'x-ratelimit-reset-{kind}')
+            if reset is not None and float(headers.get(f'x-ratelimit-remaining-{kind}', 1)) <= 0:
+                pause = max(pause, _parse_duration(reset))
+        self._paused_until = max(self._paused_until, now + pause)
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth, in-flight requests and utilization of the last minute's budgets."""
+        with self._lock:
+            now = time.monotonic()
+            while self._sent and self._sent[0][0] < now - 60:
+                self._sent.popleft()
+            requests = sum(count for _, count, _ in self._sent)
+            tokens = sum(tokens for _, _, tokens in self._sent)
+            return {
+                'queue_depth': self.waiting,
+                'in_flight': self.in_flight,
+                'rpm_utilization': requests / self.rpm if self.rpm else 0.0,
+                'tpm_utilization': tokens / self.tpm if self.tpm else 0.0,
+                'rate_limited': self.rate_limited,
+            }
+
+    def _maybe_report(self) -> None:
+        """Print a status line at most every report_every seconds."""
+        with self._lock:
+            now = time.monotonic()
+            if not self.report_every or now - self._last_report < self.report_every:
+                return
+            self._last_report = now
+        self.print_stats()
+
+    def print_stats(self) -> None:
+        s = self.stats()
+        rpm = f"{s['rpm_utilization']:.0%} of {self.rpm}" if self.rpm else 'unlimited'
+        tpm = f"{s['tpm_utilization']:.0%} of {self.tpm}" if self.tpm else 'unlimited'
+        print(f"[rate] {self.model}: queue={s['queue_depth']} in_flight={s['in_flight']} "
+              f"rpm={rpm} tpm={tpm} 429s={s['rate_limited']}")
+
+
+def scheduler_or_none(model: str, rpm: int = 0, tpm: int = 0, use_model_defaults: bool = False) -> Optional[RateScheduler]:
+    """
+    A RateScheduler if a budget is given or the model defaults are asked for, else None
+    (no client-side limit). Without use_model_defaults, only the given budgets are enforced.
+    """
+    if not (rpm or tpm or use_model_defaults):
+        return None
+    return RateScheduler(model, rpm=rpm, tpm=tpm, use_model_defaults=use_model_defaults)
@@ -0,0 +1,158 @@
+import glob
+import json
+import mmap
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+import profiling
+
+INDEX_SUFFIX = '.idx.json'
+
+
+def ref_id_from_wav(wav_name: str, neglect_reffile_prefix: str = 'vc_') -> str:
+    """Map a WAV filename to the id of its reference text (the .txt stem)."""
+    txt_name = wav_name.replace('.wav', '.txt')
+    if neglect_reffile_prefix:
+        txt_name = txt_name.replace(neglect_reffile_prefix, '')
+    return os.path.splitext(txt_name)[0]
+
+
+def tts_item_id(filename_prefix: str, idx: int, num_digits: int) -> str:
+    """Id of the idx-th line of a TTS input file, matching run_chirp3_tts_batch file naming."""
+    return f"{filename_prefix}{str(idx).zfill(num_digits)}"
+
+
+class RefStoreWriter:
+    """Append texts to a packed store: one UTF-8 blob plus a JSON {id: [offset, length]} index."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index: Dict[str, List[int]] = {}
+        self._offset = 0
+        self._fout = open(path, 'wb')
+
+    def add(self, item_id: str, text: str) -> None:
+        data = text.encode('utf-8')
+        self._fout.write(data)
+        self.index[item_id] = [self._offset, len(data)]
+        self._offset += len(data)
+
+    def close(self) -> None:
+        self._fout.close()
+        tmp_path = self.path + INDEX_SUFFIX + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path + INDEX_SUFFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RefStore:
+    """Read-only, memory-mapped view of a packed store with O(1) lookup by id."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + INDEX_SUFFIX, 'r', encoding='utf-8') as f:
+            self.index: Dict[str, List[int]] = json.load(f)
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b''  # mmap refuses empty files
+
+    def get(self, item_id: str) -> Optional[str]:
+        entry = self.index.get(item_id)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self._data[offset:offset + length].decode('utf-8')
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for item_id in self.index:
+            yield item_id, self.get(item_id)
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build(textdir: str, store_path: str) -> None:
+    """
+    Pack all .txt files of a directory into a single store.
+
+    Usage:
+        python ref_store.py build OUTPUT-chirp3-all-txts refs.store
+
+    Args:
+        textdir: Directory with reference .txt files (e.g. --textdir of run_chirp3_tts_batch)
+        store_path: Path of the packed store; the index is written to <store_path>.idx.json
+    """
+    txt_files = sorted(glob.glob(os.path.join(textdir, '*.txt')))
+    with RefStoreWriter(store_path) as writer:
+        for txt_path in txt_files:
+            with open(txt_path, 'r', encoding='utf-8') as f:
+                writer.add(os.path.splitext(os.path.basename(txt_path))[0], f.read())
+    print(f"Packed {len(txt_files)} reference texts into {store_path}")
+
+
+def build_from_manifest(input_file: str, store_path: str, filename_prefix='chrp', num_digits=4) -> None:
+    """
+    Build the store straight from a TTS input file, one text per line.
+
+    Ids follow run_chirp3_tts_batch naming ({filename_prefix}{idx:0num_digits}), so no
+    per-line .txt files are needed.
+
+    Usage:
+        python ref_store.py build-from-manifest all-rewritten-chunk-uniq.txt refs.store
+    """
+    count = 0
+    with open(input_file, 'r', encoding='utf-8') as f, RefStoreWriter(store_path) as writer:
+        for idx, line in enumerate(f):
+            writer.add(tts_item_id(filename_prefix, idx, num_digits), line)
+            count += 1
+    print(f"Packed {count} reference texts into {store_path}")
+
+
+def export(store_path: str, textdir: str) -> None:
+    """
+    Write the store back out as loose .txt files, one per id.
+
+    Usage:
+        python ref_store.py export refs.store OUTPUT-chirp3-all-txts
+    """
+    os.makedirs(textdir, exist_ok=True)
+    with RefStore(store_path) as store:
+        for item_id, text in store.items():
+            with open(os.path.join(textdir, f"{item_id}.txt"), 'w', encoding='utf-8') as f:
+                f.write(text)
+        print(f"Exported {len(store)} reference texts to {textdir}")
+
+
+def get(store_path: str, item_id: str) -> None:
+    """Print the text stored under an id."""
+    with RefStore(store_path) as store:
+        text = store.get(item_id)
+    if text is None:
+        print(f"Warning: id not found: {item_id}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    profiling.dispatch_commands([build, build_from_manifest, export, get])
@@ -1,8 +1,16 @@
+import asyncio
+import json
 import time
 import codecs
 import random
-import argh
+import profiling
 import openai
+from llm_cache import LLMCache
+from run_journal import RunJournal, item_key
+from llm_tokens import estimate_tokens
+from rate_limiter import scheduler_or_none
+from sharding import in_shard, parse_shard, print_shard
+from aimd import limiter_or_none, maybe_aslot
 
 SYSTEM_PROMPT = """Your will be given a paragraph and rewrite it to a more natural, spoken-style paragraph that will be used for TTS without changing its original meaning. The rewritten paragraph should be casual and conversational, as if it were spoken by a human.
 
@@ -25,6 +33,10 @@ FEW_SHOT_PROMPTS = [
 ]
 
 
+PACKED_INSTRUCTIONS = """
+You will be given a JSON array of paragraphs. Rewrite each paragraph independently, following the rules above.
+Answer with only a JSON array of strings: exactly one rewritten paragraph per input paragraph, in the same order. Do not add any other text.
+"""
 
 # Load openai API key from key.txt file
 def load_api_key(file_path):
@@ -41,23 +53,308 @@ def load_api_key(file_path):
         return f.read().strip()
 
 
-def rewrite_paragraphs(input_file, output_file, model="gpt-4.1-mini", temperature=0.7, key_path="key.txt", verbose=False, limit=0, start_idx=0):
+def build_messages(content, verbose=False):
+    """Few-shot chat messages asking the model to rewrite one paragraph."""
+    messages=[{"role": "system", "content": SYSTEM_PROMPT}]
+
+    for qa_pair in FEW_SHOT_PROMPTS:
+        if verbose: print("DEBUG QA:", qa_pair)
+        messages.append({"role": "user", "content": "Rewrite the following paragraph: " + qa_pair[0]})
+        messages.append({"role": "assistant", "content": qa_pair[1]})
+
+    messages.append({"role": "user", "content": "Rewrite the following paragraph: " + content})
+    if verbose:
+        print("DEBUG MSGS:", messages)
+    return messages
+
+
+def build_packed_messages(contents, verbose=False):
+    """Chat messages asking the model to rewrite several paragraphs in one request.
+
+    The paragraphs go in as a JSON array and the answer must be a JSON array of the same
+    length. The few-shot examples are sent once, as one packed example.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT + PACKED_INSTRUCTIONS}]
+    messages.append({"role": "user", "content": "Rewrite the following paragraphs: " +
+                     json.dumps([qa_pair[0] for qa_pair in FEW_SHOT_PROMPTS], ensure_ascii=False)})
+    messages.append({"role": "assistant", "content": json.dumps([qa_pair[1] for qa_pair in FEW_SHOT_PROMPTS], ensure_ascii=False)})
+    messages.append({"role": "user", "content": "Rewrite the following paragraphs: " + json.dumps(contents, ensure_ascii=False)})
+    if verbose:
+        print("DEBUG MSGS:", messages)
+    return messages
+
+
+def parse_packed_response(text, expected):
+    """Parse a packed answer into a list of `expected` rewrites, or None if it does not match the schema."""
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.strip('`')
+        if text.startswith('json'):
+            text = text[len('json'):]
+    try:
+        rewrites = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(rewrites, list) or len(rewrites) != expected:
+        return None
+    if not all(isinstance(r, str) and r.strip() for r in rewrites):
+        return None
+    return rewrites
+
+
+def response_text(response):
+    """Message content of a chat completion response, or None if it has none."""
+    try:
+        return response['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+async def request_completion(messages, model, temperature, max_retries=3, retry_sleep=5, scheduler=None, limiter=None):
+    """
+    Call the chat completion API once, retrying on errors.
+
+    With a scheduler, every attempt first waits for RPM/TPM budget for the estimated
+    prompt tokens; a 429 pauses the scheduler instead of sleeping retry_sleep. With a limiter
+    (aimd.AIMDLimiter), every attempt also holds one of its slots.
+
+    Returns:
+        The API response, or None if all attempts failed.
+    """
+    prompt_tokens = estimate_tokens(messages)
+    for _ in range(max_retries):
+        if scheduler is not None:
+            await scheduler.aacquire(prompt_tokens)
+        try:
+            async with maybe_aslot(limiter):
+                response = await openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                )
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            if scheduler is not None:
+                scheduler.release()
+            raise
+        except openai.error.RateLimitError as e:
+            print(f"Rate limited: {e}. Retrying...")
+            if scheduler is not None:
+                scheduler.release(headers=e.headers, rate_limited=True)
+            else:
+                await asyncio.sleep(retry_sleep)
+            continue
+        except Exception as e:
+            print(f"Error: {e}. Retrying...")
+            if scheduler is not None:
+                scheduler.release()
+            # Sleep before retrying
+            await asyncio.sleep(retry_sleep)
+            continue
+        if scheduler is not None:
+            scheduler.release(completion_tokens=(response.get('usage') or {}).get('completion_tokens', 0))
+        return response
+    return None
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of a list of numbers, nearest-rank."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+async def rewrite_items(items, fout, model, temperature, concurrency=1, verbose=False, cache=None, journal=None,
+                        pack_size=1, scheduler=None, limiter=None):
+    """
+    Rewrite (idx, topic, content, line) items with at most `concurrency` requests in flight.
+
+    Each paragraph gets at most one successful API call, none if it is in the cache
+    (a replay-mode cache miss skips the paragraph). With pack_size > 1, consecutive
+    paragraphs share one request; if the packed answer does not hold exactly one rewrite
+    per paragraph, those paragraphs fall back to one request each.
+
+    Responses may arrive out of order; a reorder buffer writes them to fout in input order.
+    The buffer is bounded, so no new requests are started while it is full.
+
+    A paragraph that fails is reported and skipped; with a journal, written items are
+    marked done and failed ones marked failed (with their input line kept for a retry file).
+    With a scheduler (rate_limiter.RateScheduler), requests are held back to stay within
+    the model's RPM/TPM limits. With a limiter (aimd.AIMDLimiter), the number of requests
+    actually sent at once adapts to the API's latency and rate limit errors, up to `concurrency`.
+
+    Returns:
+        Dict with number of written and failed items, wall time, per-call latencies and, over
+        the paragraphs that needed an API call (sent_paragraphs, cache hits excluded), estimated
+        prompt tokens for single requests and as actually sent.
+    """
+    cache = cache or LLMCache(mode='off')
+    stats = {'written': 0, 'failed': 0, 'latencies': [], 'single_prompt_tokens': 0, 'sent_prompt_tokens': 0}
+    sent_positions = set()
+    max_buffered = concurrency * 4 * pack_size
+
+    async def complete(messages, unit, sample_index=0, validate=None):
+        """Cached or live completion of the (pos, item) pairs of unit; returns (response, status)."""
+        key = cache.key(model, openai.api_base, messages, temperature, sample_index)
+        response = cache.get(key)
+        if response is not None:
+            return response, 'ok'
+        if cache.replay:
+            return None, 'skipped'
+        start = time.monotonic()
+        response = await request_completion(messages, model, temperature, scheduler=scheduler, limiter=limiter)
+        stats['latencies'].append(time.monotonic() - start)
+        stats['sent_prompt_tokens'] += estimate_tokens(messages)
+        # Single-request tokens over the same paragraphs, each counted once (also after a packed fallback)
+        for pos, item in unit:
+            if pos not in sent_positions:
+                sent_positions.add(pos)
+                stats['single_prompt_tokens'] += estimate_tokens(build_messages(item[2]))
+        if response is None:
+            return None, 'failed'
+        if validate is None or validate(response):
+            cache.put(key, model, response)
+        return response, 'ok'
+
+    async def rewrite_single(pos, item):
+        idx, topic, content, _ = item
+        print(f"[{idx}] Generating for topic:", topic)
+        response, status = await complete(build_messages(content, verbose), [(pos, item)])
+        return pos, item, response_text(response) if status == 'ok' else None, status
+
+    async def rewrite_unit(unit):
+        if len(unit) > 1:
+            contents = [item[2] for _, item in unit]
+            print(f"[{unit[0][1][0]}-{unit[-1][1][0]}] Generating {len(unit)} paragraphs in one request")
+            validate = lambda r: parse_packed_response(response_text(r) or '', len(unit)) is not None
+            response, status = await complete(build_packed_messages(contents, verbose), unit, validate=validate)
+            if status == 'skipped':
+                return [(pos, item, None, status) for pos, item in unit]
+            rewrites = parse_packed_response(response_text(response) or '', len(unit)) if status == 'ok' else None
+            if rewrites is not None:
+                return [(pos, item, text, 'ok') for (pos, item), text in zip(unit, rewrites)]
+            print(f"[{unit[0][1][0]}-{unit[-1][1][0]}] Invalid packed response, falling back to single requests")
+        return [await rewrite_single(pos, item) for pos, item in unit]
+
+    started = time.monotonic()
+    pending = iter(enumerate(items))
+    in_flight = set()
+    buffered = {}
+    next_pos = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < concurrency and len(buffered) < max_buffered:
+            unit = []
+            for pos, item in pending:
+                unit.append((pos, item))
+                if len(unit) == pack_size:
+                    break
+            if len(unit) < pack_size:
+                exhausted = True
+            if not unit:
+                break
+            in_flight.add(asyncio.ensure_future(rewrite_unit(unit)))
+        if not in_flight:
+            break
+
+        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            for pos, *result in task.result():
+                buffered[pos] = result
+
+        # Write everything that is now contiguous with what was already written
+        while next_pos in buffered:
+            (idx, topic, _, line), result, status = buffered.pop(next_pos)
+            next_pos += 1
+            if status == 'skipped':
+                print(f"[{idx}] Not in cache, skipped (replay mode)")
+                continue
+            if result is None:
+                print("Failed to get a response after 3 attempts. IDX:", idx)
+                stats['failed'] += 1
+                if journal is not None:
+                    journal.mark_failed(item_key(idx, line), line)
+                continue
+            if verbose:
+                print("DEBUG RESULT:", result)
+            num_lines = 0
+            for para in result.split('\n'):
+                if not para.strip():
+                    continue
+                para = para.strip()
+                print(f"{topic}:\t{para}", file=fout)
+                num_lines += 1
+            fout.flush()
+            stats['written'] += 1
+            if journal is not None:
+                journal.mark_done(item_key(idx, line), lines=num_lines)
+
+    stats['elapsed'] = time.monotonic() - started
+    stats['paragraphs'] = len(items)
+    stats['sent_paragraphs'] = len(sent_positions)
+    return stats
+
+
+def print_summary(stats):
+    """Print throughput and latency of a rewrite run."""
+    latencies = stats['latencies']
+    elapsed = stats['elapsed'] or 1e-9
+    print(f"\nRewrote {stats['written']} paragraphs in {stats['elapsed']:.1f}s "
+          f"({stats['written'] / elapsed:.2f} paragraphs/s, {len(latencies)} API calls, {stats['failed']} failed)")
+    if latencies:
+        print(f"Latency p50={percentile(latencies, 50):.2f}s p95={percentile(latencies, 95):.2f}s "
+              f"max={max(latencies):.2f}s")
+    sent = stats['sent_paragraphs']
+    if sent and stats['sent_prompt_tokens']:
+        print(f"Prompt tokens per paragraph sent to the API ({sent} of {stats['paragraphs']}): "
+              f"~{stats['single_prompt_tokens'] / sent:.0f} as single requests, ~{stats['sent_prompt_tokens'] / sent:.0f} as sent")
+
+
+def rewrite_paragraphs(input_file, output_file, model="gpt-4.1-mini", temperature=0.7, key_path="key.txt", verbose=False, limit=0, start_idx=0,
+                       concurrency=1, base_url=None, cache_path='llm-cache.sqlite', cache_mode='readwrite', cache_max_mb=1024,
+                       fresh=False, pack_size=1, rpm=0, tpm=0, rate_limit_defaults=False, shard='', adaptive=False, aimd_log=None):
     """
     Rewrites paragraphs in a text file using OpenAI's GPT-4.1-mini model.
 
+    Progress is journaled to <output_file>.journal.jsonl. If the run is interrupted, running
+    the same command again skips the paragraphs already written and appends the rest.
+    Paragraphs that fail are skipped and their input lines are written to <output_file>.retry.txt.
+
     Args:
         input_file (str): Path to the input text file containing paragraphs to rewrite.
         output_file (str): Path to the output text file to save rewritten paragraphs.
         model (str): The OpenAI model to use for rewriting.
         temperature (float): Sampling temperature for the model. Default is 0.7.
+        concurrency (int): Number of paragraphs rewritten concurrently. Output order
+            is the input order regardless of this value.
+        base_url (str): OpenAI-compatible API base URL (default: OpenAI, or DashScope for qwen models).
+        cache_path (str): SQLite file caching completions across runs (see llm_cache.py).
+        cache_mode (str): off, readwrite, or replay (only use cached responses, never call the API).
+        cache_max_mb (float): Evict least recently used cache entries above this size (0 = no limit).
+        fresh (bool): Ignore an existing journal and start over.
+        pack_size (int): Rewrite this many paragraphs per request (JSON in, JSON out) so the
+            system prompt and few-shot examples are sent once per pack instead of per paragraph.
+        rpm (int): Requests per minute allowed for the model (0 = no client-side limit).
+        tpm (int): Tokens per minute allowed for the model (0 = no client-side limit).
+        rate_limit_defaults (bool): Pace requests to the model's default RPM/TPM from rate_limiter.py
+            where rpm or tpm is 0.
+        shard (str): Rewrite only shard i of N ("i/N"): paragraphs are partitioned by a hash of
+            their journal key. Merge the shard outputs with `sharding.py merge-text`.
+        adaptive (bool): Adapt the number of requests in flight to the API's latency and rate
+            limit errors (AIMD, see aimd.py); concurrency is then the upper bound.
+        aimd_log (str): With adaptive, append every change of the limit to this JSONL file.
     """
+    shard = parse_shard(shard)
     openai.api_key = load_api_key(key_path)  # Load API key from the specified file
 
-    if 'qwen' in model:
+    if base_url:
+        openai.api_base = base_url
+    elif 'qwen' in model:
         openai_base_url = "https://dashscope.aliyuncs.com/compatible-mode/v1"
         openai.api_base = openai_base_url
 
-    if start_idx > 0:
+    journal = RunJournal(output_file + '.journal.jsonl', fresh=fresh)
+    if start_idx > 0 or journal.resumed:
         fout = codecs.open(output_file, 'a', encoding='utf-8')
     else:  # if start_idx not specified, overwrite the file
         fout = codecs.open(output_file, 'w', encoding='utf-8')
@@ -67,9 +364,19 @@ def rewrite_paragraphs(input_file, output_file, model="gpt-4.1-mini", temperatur
     if limit > 0:
         input_lines = input_lines[:limit]
 
+    items = []
+    resumed = 0
+    in_range = in_this_shard = 0
     for idx, line in enumerate(input_lines):
         if idx < start_idx:
             continue
+        in_range += 1
+        if not in_shard(item_key(idx, line), shard):
+            continue
+        in_this_shard += 1
+        if journal.is_done(item_key(idx, line)):
+            resumed += 1
+            continue
 
         parts = line.split('\t')
         if len(parts) != 2:
@@ -77,66 +384,38 @@ def rewrite_paragraphs(input_file, output_file, model="gpt-4.1-mini", temperatur
             continue
         topic, content = parts
         topic = topic.split(':')[0]
+        items.append((idx, topic, content, line))
 
-        print(f"[{idx}] Generating for topic:", topic)
-
-        messages=[{"role": "system", "content": SYSTEM_PROMPT}]
-
-        for qa_pair in FEW_SHOT_PROMPTS:
-            if verbose: print("DEBUG QA:", qa_pair)
-            messages.append({"role": "user", "content": "Rewrite the following paragraph: " + qa_pair[0]})
-            messages.append({"role": "assistant", "content": qa_pair[1]})
-
-        messages.append({"role": "user", "content": "Rewrite the following paragraph: " + content})
-        if verbose:
-            print("DEBUG MSGS:", messages)
-
-        # Retry for 3 times if the API call fails
-        success = False
-        for _ in range(3):
-            try:
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                )
-                success = True
-                break
-            except KeyboardInterrupt as e:
-                raise e
-            except Exception as e:
-                print(f"Error: {e}. Retrying...")
-                # Sleep before retrying
-                time.sleep(5)
-                continue
-
-        if not success:
-            print("Failed to get a response after 3 attempts. IDX:", idx)
-            break
-
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-        )
-        try:
-            result = response['choices'][0]['message']['content']
-            if verbose:
-                print("DEBUG RESULT:", response)
-        except KeyError:
-            continue
-        for para in result.split('\n'):
-            if not para.strip():
-                continue
-            para = para.strip()
-            print(f"{topic}:\t{para}", file=fout)
-        fout.flush()
+    print_shard(shard, in_this_shard, in_range, 'paragraphs')
+    if resumed:
+        print(f"Resuming: skipping {resumed} paragraphs already done according to {journal.path}")
+    cache = LLMCache(cache_path, mode=cache_mode, max_mb=cache_max_mb)
+    scheduler = scheduler_or_none(model, rpm=rpm, tpm=tpm, use_model_defaults=rate_limit_defaults)
+    limiter = limiter_or_none(adaptive, 'llm', concurrency, aimd_log)
+    stats = asyncio.run(rewrite_items(items, fout, model, temperature, concurrency=concurrency, verbose=verbose, cache=cache,
+                                     journal=journal, pack_size=pack_size, scheduler=scheduler, limiter=limiter))
     fout.close()
+    journal.close()
+    print_summary(stats)
+    if scheduler is not None:
+        scheduler.print_stats()
+    if limiter is not None:
+        limiter.print_summary()
+        limiter.close()
+    if stats['failed']:
+        retry_file = output_file + '.retry.txt'
+        journal.write_retry_file(retry_file)
+        print(f"Wrote {stats['failed']} failed input lines to {retry_file}")
+    cache.print_summary()
+    cache.close()
 
 
 if __name__ == "__main__":
-    argh.dispatch_command(rewrite_paragraphs)
+    profiling.dispatch_command(rewrite_paragraphs)
 
-# start from line 690
+# An interrupted run resumes automatically from its journal; --fresh starts over.
 # python rewrite_chatting_style.py rewritten-v1-nano-300.txt rewritten-chatting-v1-4o-mini.txt -k openai-key.txt -m gpt-4o-mini -l 10 -v
 # python rewrite_chatting_style.py rewritten-v1-nano-300.txt rewritten-chatting-v1-4o-mini.txt -k openai-key.txt -m gpt-4o-mini -l 10 -v --start-idx 690
+# python rewrite_chatting_style.py rewritten-v1-nano-300.txt rewritten-chatting-v1-4o-mini.txt -k openai-key.txt -m gpt-4o-mini --concurrency 16 --pack-size 4
+# python rewrite_chatting_style.py rewritten-v1-nano-300.txt rewritten-chatting-v1-qwen.txt -k dashscope-key.txt -m qwen-plus --concurrency 32 --rpm 600 --tpm 500000
+# python rewrite_chatting_style.py rewritten-v1-nano-300.txt rewritten-chatting-v1-qwen.txt -k dashscope-key.txt -m qwen-plus --concurrency 64 --adaptive --aimd-log aimd.jsonl
@@ -1,7 +1,18 @@
 import codecs
+import collections
+import hashlib
+import itertools
 import random
-import argh
+import time
+from concurrent.futures import ThreadPoolExecutor
+import profiling
 import openai
+from llm_cache import LLMCache
+from llm_tokens import estimate_tokens
+from rate_limiter import scheduler_or_none
+from run_journal import RunJournal, item_key
+from sharding import in_shard, parse_shard, print_shard
+from aimd import limiter_or_none, maybe_slot
 
 # Load openai API key from key.txt file
 def load_api_key(file_path):
@@ -18,20 +29,130 @@ def load_api_key(file_path):
         return f.read().strip()
 
 
+def sample_seed(seed, topic, sample_idx):
+    """Seed for the few-shot draw of one (topic, sample), independent of any other draw."""
+    digest = hashlib.sha256(f"{seed}\t{topic}\t{sample_idx}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def build_topic_messages(paragraphs, this_topic, rng):
+    """Few-shot messages: 3 random reference paragraphs, then the new topic."""
+    samples = rng.sample(paragraphs, 3)
+    messages=[
+        {"role": "system", "content": "You are a helpful assistant. Your will be given a topic and compose a casual chatting-style paragraph."}]
+    for sample in samples:
+        topic, content = sample
+        topic = topic.split('-')[0].split('.wav')[0]
+        if 'ishowspeed' in topic:
+            topic = 'ishowspeed travels in China'
+        # print(idx, f"Topic: {topic}\n", f"Content: {content}")
+        messages.append({"role": "user", "content": f"Topic: {topic}"})
+        messages.append({"role": "assistant", "content": f"{content}"})
+
+    messages.append({"role": "user", "content": f"Topic: '{this_topic}"})
+    return messages
+
+
+def generate_for_topic(this_topic, paragraphs, model, temperature, resample_per_topic, cache, seed=42, max_retries=3,
+                       scheduler=None, limiter=None):
+    """
+    Generate resample_per_topic completions for one topic.
+
+    With a scheduler, each API call first waits for RPM/TPM budget for its estimated prompt tokens.
+    With a limiter (aimd.AIMDLimiter), each API call holds one of its slots.
+
+    Returns:
+        Output lines ("topic:\tparagraph") in sample order.
+    """
+    print("Generating for topic:", this_topic)
+    lines = []
+    for idx in range(resample_per_topic):
+        messages = build_topic_messages(paragraphs, this_topic, random.Random(sample_seed(seed, this_topic, idx)))
+
+        key = cache.key(model, openai.api_base, messages, temperature, sample_index=idx)
+        response = cache.get(key)
+        if response is None:
+            if cache.replay:
+                print(f"Not in cache, skipped (replay mode): {this_topic} #{idx}")
+                continue
+            for attempt in range(max_retries):
+                if scheduler is not None:
+                    scheduler.acquire(estimate_tokens(messages))
+                try:
+                    with maybe_slot(limiter):
+                        response = openai.ChatCompletion.create(
+                            model=model,
+                            messages=messages,
+                            temperature=temperature,
+                        )
+                except Exception as e:
+                    rate_limited = isinstance(e, openai.error.RateLimitError)
+                    if scheduler is not None:
+                        scheduler.release(headers=getattr(e, 'headers', None), rate_limited=rate_limited)
+                    if attempt == max_retries - 1:
+                        raise
+                    print(f"Error: {e}. Retrying...")
+                    if scheduler is None or not rate_limited:
+                        time.sleep(5)
+                    continue
+                if scheduler is not None:
+                    scheduler.release(completion_tokens=(response.get('usage') or {}).get('completion_tokens', 0))
+                break
+            cache.put(key, model, response)
+        try:
+            result = response['choices'][0]['message']['content']
+        except KeyError:
+            continue
+        for para in result.split('\n'):
+            if not para.strip():
+                continue
+            para = para.strip()
+            lines.append(f"{this_topic}:\t{para}")
+    return lines
+
+
 def rewrite_paragraphs(input_file, output_file, model="gpt-4o-mini", candidate_topics='\topics-example.txt', temperature=1.1, key_path="key.txt", verbose=False,
-                       limit=0, resample_per_topic=3):
+                       limit=0, resample_per_topic=3, base_url=None, cache_path='llm-cache.sqlite', cache_mode='readwrite', cache_max_mb=1024,
+                       concurrency=1, seed=42, fresh=False, rpm=0, tpm=0, rate_limit_defaults=False, shard='', adaptive=False, aimd_log=None):
     """
     Rewrites paragraphs in a text file using OpenAI's GPT-4.1-mini model.
 
+    The few-shot samples of each (topic, sample) pair come from their own seed derived
+    from (seed, topic, sample index), so the prompts do not depend on concurrency,
+    on which topics ran before, or on partial reruns. Topics are generated concurrently
+    and written in topic order as soon as all earlier topics are done.
+
+    Finished topics are journaled to <output_file>.journal.jsonl; running the same command
+    again skips them and appends the rest. Topics that fail are written to <output_file>.retry.txt.
+
     Args:
         input_file (str): Path to the input text file containing paragraphs to rewrite.
         output_file (str): Path to the output text file to save rewritten paragraphs.
         model (str): The OpenAI model to use for rewriting.
         temperature (float): Sampling temperature for the model. Default is 0.7.
+        base_url (str): OpenAI-compatible API base URL (default: OpenAI, or DashScope for qwen models).
+        cache_path (str): SQLite file caching completions across runs (see llm_cache.py).
+        cache_mode (str): off, readwrite, or replay (only use cached responses, never call the API).
+        cache_max_mb (float): Evict least recently used cache entries above this size (0 = no limit).
+        concurrency (int): Number of topics generated concurrently.
+        seed (int): Base seed for the few-shot sample draws.
+        fresh (bool): Ignore an existing journal and start over.
+        rpm (int): Requests per minute allowed for the model (0 = no client-side limit).
+        tpm (int): Tokens per minute allowed for the model (0 = no client-side limit).
+        rate_limit_defaults (bool): Pace requests to the model's default RPM/TPM from rate_limiter.py
+            where rpm or tpm is 0.
+        shard (str): Generate only shard i of N ("i/N"): topics are partitioned by a hash of
+            their journal key. Merge the shard outputs with `sharding.py merge-text`.
+        adaptive (bool): Adapt the number of requests in flight to the API's latency and rate
+            limit errors (AIMD, see aimd.py); concurrency is then the upper bound.
+        aimd_log (str): With adaptive, append every change of the limit to this JSONL file.
     """
+    shard = parse_shard(shard)
     openai.api_key = load_api_key(key_path)  # Load API key from the specified file
 
-    if 'qwen' in model:
+    if base_url:
+        openai.api_base = base_url
+    elif 'qwen' in model:
         openai_base_url = "https://dashscope.aliyuncs.com/compatible-mode/v1"
         openai.api_base = openai_base_url
 
@@ -53,47 +174,69 @@ def rewrite_paragraphs(input_file, output_file, model="gpt-4o-mini", candidate_t
     #     print(filename)
 
     # Use few-shot prompting to rewrite paragraphs with 10 different topics, keeping a similar and casual tone with the reference.
-    fout = codecs.open(output_file, 'w', encoding='utf-8')
-    random.seed(42)
+    journal = RunJournal(output_file + '.journal.jsonl', fresh=fresh)
+    fout = codecs.open(output_file, 'a' if journal.resumed else 'w', encoding='utf-8')
+    cache = LLMCache(cache_path, mode=cache_mode, max_mb=cache_max_mb)
+    scheduler = scheduler_or_none(model, rpm=rpm, tpm=tpm, use_model_defaults=rate_limit_defaults)
+    limiter = limiter_or_none(adaptive, 'llm', concurrency, aimd_log)
 
     if limit > 0:
         candidate_topics = candidate_topics[:limit]
-    for this_topic in candidate_topics:
-        print("Generating for topic:", this_topic)
-        for idx in range(resample_per_topic):
-            samples = random.sample(paragraphs, 3)
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant. Your will be given a topic and compose a casual chatting-style paragraph."}]
-            for sample in samples:
-                topic, content = sample
-                topic = topic.split('-')[0].split('.wav')[0]
-                if 'ishowspeed' in topic:
-                    topic = 'ishowspeed travels in China'
-                # print(idx, f"Topic: {topic}\n", f"Content: {content}")
-                messages.append({"role": "user", "content": f"Topic: {topic}"})
-                messages.append({"role": "assistant", "content": f"{content}"})
-
-            messages.append({"role": "user", "content": f"Topic: '{this_topic}"})
-
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-            try:
-                result = response['choices'][0]['message']['content']
-            except KeyError:
-                continue
-            for para in result.split('\n'):
-                if not para.strip():
+    shard_topics = [(i, t) for i, t in enumerate(candidate_topics) if in_shard(item_key(i, t), shard)]
+    print_shard(shard, len(shard_topics), len(candidate_topics), 'topics')
+    topics = [(i, t) for i, t in shard_topics if not journal.is_done(item_key(i, t))]
+    if len(topics) < len(shard_topics):
+        print(f"Resuming: skipping {len(shard_topics) - len(topics)} topics already done according to {journal.path}")
+
+    # At most `concurrency` topics are in flight, so an interrupt or an error in the loop below
+    # does not leave the rest of the backlog queued (and spending API calls) in the executor
+    next_topics = iter(topics)
+    pending = collections.deque()
+
+    def submit_next(executor):
+        for topic_idx, this_topic in itertools.islice(next_topics, 1):
+            pending.append((topic_idx, this_topic, executor.submit(
+                generate_for_topic, this_topic, paragraphs, model, temperature, resample_per_topic, cache, seed,
+                scheduler=scheduler, limiter=limiter)))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for _ in range(concurrency):
+                submit_next(executor)
+            # Waiting on the futures in submission order streams results in topic order
+            while pending:
+                topic_idx, this_topic, future = pending.popleft()
+                submit_next(executor)
+                try:
+                    lines = future.result()
+                except Exception as e:
+                    print(f"Failed to generate for topic {this_topic}: {e}")
+                    journal.mark_failed(item_key(topic_idx, this_topic), this_topic)
                     continue
-                para = para.strip()
-                print(f"{this_topic}:\t{para}", file=fout)
-            fout.flush()
+                for line in lines:
+                    print(line, file=fout)
+                fout.flush()
+                journal.mark_done(item_key(topic_idx, this_topic), lines=len(lines))
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
     fout.close()
+    journal.close()
+    if journal.failed_lines:
+        retry_file = output_file + '.retry.txt'
+        journal.write_retry_file(retry_file)
+        print(f"Wrote {len(journal.failed_lines)} failed topics to {retry_file}")
+    if scheduler is not None:
+        scheduler.print_stats()
+    if limiter is not None:
+        limiter.print_summary()
+        limiter.close()
+    cache.print_summary()
+    cache.close()
 
 
 if __name__ == "__main__":
-    argh.dispatch_command(rewrite_paragraphs)
+    profiling.dispatch_command(rewrite_paragraphs)
 
 # python rewrite_paragraphs.py all-seed-notebook-asrs.txt rewritten-v1-nano-320.txt -k openai-key.txt -m gpt-4.1-nano -c topics-300.txt
+# python rewrite_paragraphs.py all-seed-notebook-asrs.txt rewritten-v1-nano-320.txt -k openai-key.txt -m gpt-4.1-nano -c topics-300.txt --concurrency 8
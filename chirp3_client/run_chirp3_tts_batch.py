@@ -1,11 +1,17 @@
 import json
-import argh
+import profiling
 import os
 import re
 from google.cloud import texttospeech_v1beta1 as texttospeech
 from google.oauth2.credentials import Credentials
 from google.api_core.client_options import ClientOptions
 from typing import Iterator
+import quota_governor
+from stage_metrics import METRICS, ProgressLine, print_summary, start_export
+from ref_store import tts_item_id
+from sharding import in_shard, parse_shard, print_shard
+from run_db import RunDB
+from preflight import Preflight
 
 # 请替换为您的 Google Cloud Project ID
 PROJECT_ID = ""
@@ -53,12 +59,41 @@ def get_voice_from_name(voice_name='Aoede'):
 
 DEFAULT_VOICE = 'en-US-Chirp3-HD-Aoede'  # 默认语音设置
 
+def synthesize_bytes(prompt, voice=None, acquire_quota=True):
+    """合成语音并直接返回音频内容（LINEAR16 WAV 字节），不写文件。出错时抛出异常。
+
+    Args:
+        prompt: 要合成的文本，可以包含 Chirp 3 的特殊标记。
+        voice: VoiceSelectionParams，默认为 DEFAULT_VOICE。
+        acquire_quota: 是否先从 quota_governor 取配额（调用方已取过时为 False）。
+    """
+    input_text = texttospeech.SynthesisInput(text=prompt)
+    audio_config = texttospeech.AudioConfig(
+        audio_encoding=texttospeech.AudioEncoding.LINEAR16
+    )
+    # 与同一台机器上的其他 TTS 进程共享配额
+    if acquire_quota:
+        quota_governor.acquire('tts')
+    with METRICS.track('tts', api='tts', bytes_in=len(prompt.encode('utf-8'))) as call:
+        response = client.synthesize_speech(
+            request={
+                "input": input_text,
+                "voice": voice or DEFAULT_VOICE,
+                "audio_config": audio_config}
+        )
+        call.bytes_out = len(response.audio_content)
+    return response.audio_content
+
+
 def synthesize_speech_with_chirp3(prompt, output_filename="audio.mp3", verbose=False, output_textfile=None, voice=None):
     """使用 Chirp 3 合成带有特殊标记的语音。
 
     Args:
         prompt: 要合成的文本，可以包含 Chirp 3 的特殊标记。
         output_filename: 保存合成语音的文件名。
+
+    Returns:
+        成功写入音频时为 True，出错时为 False。
     """
     try:
         # # 使用静态 token 创建凭据
@@ -69,33 +104,25 @@ def synthesize_speech_with_chirp3(prompt, output_filename="audio.mp3", verbose=F
         # client = texttospeech.TextToSpeechClient(credentials=credentials)
 
         # 设置要合成的文本
-        input_text = texttospeech.SynthesisInput(text=prompt)
         if verbose:
-            print(f'Input text prompt: {input_text}')
+            print(f'Input text prompt: {prompt}')
         if output_textfile:
             with open(output_textfile, 'w', encoding='utf-8') as f:
                 f.write(prompt)
 
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.LINEAR16
-        )
-
         # 调用 Text-to-Speech 服务合成语音
-        response = client.synthesize_speech(
-            request={
-                "input": input_text,
-                "voice": voice or DEFAULT_VOICE,
-                "audio_config": audio_config}
-        )
+        audio_content = synthesize_bytes(prompt, voice=voice)
 
         # 将合成的音频内容写入文件
         with open(output_filename, "wb") as out:
-            out.write(response.audio_content)
+            out.write(audio_content)
             if verbose:
                 print(f'音频内容已保存到: {output_filename}')
+        return True
 
     except Exception as e:
         print(f"发生错误: {e}")
+        return False
 
 
 def single(input_text='Hi hi, I am chirp 3!', output_filename="audio.wav", verbose=False):
@@ -112,18 +139,25 @@ def single(input_text='Hi hi, I am chirp 3!', output_filename="audio.wav", verbo
     synthesize_speech_with_chirp3(input_text, output_filename, verbose=verbose)
 
 
-def batch_texts_to_outfiles(input_texts: Iterator[str], output_filenames: Iterator[str], output_textfiles: Iterator[str], verbose=False, limit=0, voice=None):
-    """批量处理函数，处理命令行参数并调用合成函数。"""
+def batch_texts_to_outfiles(input_texts: Iterator[str], output_filenames: Iterator[str], output_textfiles: Iterator[str], verbose=False, limit=0, voice=None,
+                            progress=None, on_result=None):
+    """批量处理函数，处理命令行参数并调用合成函数。progress 为 ProgressLine 时，每个文件后刷新进度行；
+    on_result(index, ok) 在每个文件后被调用（index 为在本批中的序号）。"""
     lines = zip(input_texts, output_filenames, output_textfiles)
     if limit > 0:
         lines = list(lines)[:limit]
-    for input_text, output_filename, output_textfile in lines:
-        synthesize_speech_with_chirp3(input_text, output_filename, verbose=verbose, output_textfile=output_textfile, voice=voice)
+    for index, (input_text, output_filename, output_textfile) in enumerate(lines):
+        ok = synthesize_speech_with_chirp3(input_text, output_filename, verbose=verbose, output_textfile=output_textfile, voice=voice)
+        if on_result is not None:
+            on_result(index, ok)
+        if progress is not None:
+            progress.update()
 
 
 voice = "Aoede"  # @param ["Aoede", "Puck", "Charon", "Kore", "Fenrir", "Leda", "Orus", "Zephyr"]
 
-def batch(input_file: str, output_dir: str, verbose=False, limit=0, textdir: str = None, filename_prefix='chrp', num_digits=4, voices='Aoede', start_idx=0):
+def batch(input_file: str, output_dir: str, verbose=False, limit=0, textdir: str = None, filename_prefix='chrp', num_digits=4, voices='Aoede', start_idx=0,
+          metrics_dir: str = None, shard: str = '', run_db: str = None, preflight: bool = False, drop_short_lines: bool = False):
     """批量处理函数，处理命令行参数并调用合成函数。
     Usage:
         python run_chirp3_tts_batch.py batch input.txt output_dir
@@ -131,7 +165,20 @@ def batch(input_file: str, output_dir: str, verbose=False, limit=0, textdir: str
     Args:
         input_file: 输入文件，包含要合成的文本，每行一个。
         output_dir: 输出目录，用于保存合成的音频文件。
+        metrics_dir: 定期写入 Prometheus textfile (tts.prom)，退出时写入 JSON 汇总 (tts.summary.json)。
+        shard: 只处理第 i 个分片 ("i/N")，按文件 id（如 chrp0001）的稳定哈希划分；文件名与单机运行相同，
+            各分片的输出目录可用 `sharding.py merge-dirs` 合并。
+        run_db: 运行数据库 (run_db.py)。每个文件的文本、路径和状态按 (id, voice) 记录在库中；
+            库中已成功合成、文本未变且 wav 仍在的行会被跳过，失败的行在下次运行时重试。
+        preflight: 合成前用 preflight.py 检查每行：替换智能引号、省略号和破折号，跳过之后比对时必然被丢弃的行
+            （空行、非法字符、"my name is"），并报告预计节省的 TTS 和 ASR 费用。被跳过的行不改变其他行的文件 id。
+        drop_short_lines: 与 preflight 一起使用，同时跳过短于 SHORT_LINE_CHARS 的行。
     """
+    shard = parse_shard(shard)
+    db = RunDB(run_db) if run_db else None
+    if metrics_dir:
+        start_export(metrics_dir, 'tts')
+
     # 读取输入文件
     with open(input_file, 'r', encoding='utf-8') as f:
         input_texts = f.readlines()
@@ -149,6 +196,25 @@ def batch(input_file: str, output_dir: str, verbose=False, limit=0, textdir: str
     if len(voices_to_synthesize) > 1:
         multivoice = True
 
+    # 本分片负责的行号（start_idx 之后）
+    line_indices = [i for i in range(start_idx, len(input_texts)) if in_shard(tts_item_id(filename_prefix, i, num_digits), shard)]
+    print_shard(shard, len(line_indices), max(0, len(input_texts) - start_idx), 'lines')
+    if preflight:
+        # 跳过必然被丢弃的行（保留其行号，文件 id 不变），修正可修正的行
+        checker = Preflight(drop_short_lines, num_voices=len(voices_to_synthesize))
+        kept_indices = []
+        for i in line_indices:
+            text, _ = checker.check(input_texts[i])
+            if text is not None:
+                input_texts[i] = text + '\n'
+                kept_indices.append(i)
+        line_indices = kept_indices
+        checker.print_summary()
+    per_voice = len(line_indices)
+    if limit > 0:
+        per_voice = min(per_voice, limit)
+    progress = ProgressLine(METRICS, total=per_voice * len(voices_to_synthesize))
+
     root_output_dir = output_dir
     for voice in voices_to_synthesize:
         if multivoice:
@@ -157,23 +223,46 @@ def batch(input_file: str, output_dir: str, verbose=False, limit=0, textdir: str
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
         # 生成输出文件名 change {i} to 4 digits like 0001, 0002, 0003
-        output_filenames = [os.path.join(output_dir, f"{filename_prefix}{str(i).zfill(num_digits)}.wav") for i in range(len(input_texts))]
+        output_filenames = [os.path.join(output_dir, f"{tts_item_id(filename_prefix, i, num_digits)}.wav") for i in line_indices]
         # .txt files as well inside textdir
         textdir = textdir or output_dir
         if not os.path.exists(textdir):
             os.makedirs(textdir)
-        output_textfiles = [os.path.join(textdir, f"{filename_prefix}{str(i).zfill(num_digits)}.txt") for i in range(len(input_texts))]
-
-        if start_idx > 0:
-            input_texts = input_texts[start_idx:]
-            output_filenames = output_filenames[start_idx:]
-            output_textfiles = output_textfiles[start_idx:]
-
-        # 执行批量处理
-        batch_texts_to_outfiles(input_texts, output_filenames, output_textfiles, verbose=verbose, limit=limit, voice=voice)
+        output_textfiles = [os.path.join(textdir, f"{tts_item_id(filename_prefix, i, num_digits)}.txt") for i in line_indices]
+        todo = list(range(len(line_indices)))
+        if limit > 0:
+            todo = todo[:limit]
+
+        on_result = None
+        if db is not None:
+            # 只合成库中没有成功记录（或文本已变、wav 已删除）的行
+            voice_key = voice.name.split('-')[-1]
+            item_ids = [tts_item_id(filename_prefix, i, num_digits) for i in line_indices]
+            done = db.tts_done(voice_key)
+            todo = [j for j in todo if done.get(item_ids[j]) != input_texts[line_indices[j]] or not os.path.exists(output_filenames[j])]
+            skipped = per_voice - len(todo)
+            if skipped:
+                print(f"Run database: skipping {skipped} items already synthesized for {voice_key}")
+                progress.total -= skipped
+
+            def record_result(index, ok, todo=todo, voice_key=voice_key, item_ids=item_ids, output_filenames=output_filenames):
+                j = todo[index]
+                db.record_tts(item_ids[j], voice_key, input_texts[line_indices[j]], output_filenames[j], ok=ok)
+            on_result = record_result
+
+        # 执行批量处理（每个 voice 使用同一组行，不修改 input_texts）
+        batch_texts_to_outfiles([input_texts[line_indices[j]] for j in todo], [output_filenames[j] for j in todo],
+                                [output_textfiles[j] for j in todo], verbose=verbose, voice=voice, progress=progress,
+                                on_result=on_result)
+
+    progress.close()
+    print_summary()
+    if db is not None:
+        db.print_summary()
+        db.close()
 
 if __name__ == "__main__":
-    argh.dispatch_commands([single, batch])
+    profiling.dispatch_commands([single, batch])
 
 
 # python batch\run_chirp3_tts_batch.py batch test-input-2.txt test-input-2-chirp3 --voices=Aoede,Kore,Leda,Zephyr
@@ -1,9 +1,11 @@
 import json
-import argh
+import profiling
 import os
 from google.oauth2 import service_account
 from google.cloud import speech_v1p1beta1 as speech
 from google.cloud import storage
+import quota_governor
+from stage_metrics import METRICS, ProgressLine, print_summary, start_export, tracked
 
 # 请替换为您的 Google Cloud Project ID
 PROJECT_ID = ""
@@ -38,6 +40,10 @@ storage_client = storage.Client(
 )
 client = speech.SpeechClient(credentials=credentials)
 
+# Limits of synchronous recognize() with inline audio content
+INLINE_MAX_SECONDS = 55
+INLINE_MAX_BYTES = 10 * 1024 * 1024
+
 def upload_to_gcs(file_path: str, bucket_name: str) -> str:
     """Upload file to Google Cloud Storage and return the GCS URI."""
     try:
@@ -50,8 +56,27 @@ def upload_to_gcs(file_path: str, bucket_name: str) -> str:
         print(f"Error uploading to GCS: {e}")
         return None
 
-def run_asr_long(speech_file, verbose=False, timeout=180, sample_rate=24000):
-    """Execute speech recognition for long audio files."""
+def recognition_config(sample_rate=24000):
+    """Simplified recognition config without diarization."""
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        sample_rate_hertz=sample_rate,
+        language_code="en-US",
+        enable_automatic_punctuation=True,
+        enable_word_confidence=True,
+        profanity_filter=False,
+        use_enhanced=True,
+        model='phone_call',
+        metadata=speech.RecognitionMetadata(
+            interaction_type=speech.RecognitionMetadata.InteractionType.DISCUSSION,
+            recording_device_type=speech.RecognitionMetadata.RecordingDeviceType.SMARTPHONE,
+        )
+    )
+
+
+@tracked('asr', api='speech', none_is_error=True)
+def run_asr_long(speech_file, verbose=False, timeout=180, sample_rate=24000, acquire_quota=True):
+    """Execute speech recognition for long audio files (acquire_quota=False if the caller took the quota)."""
     try:
         if verbose:
             print(f"Processing file: {speech_file}")
@@ -67,22 +92,11 @@ def run_asr_long(speech_file, verbose=False, timeout=180, sample_rate=24000):
         # Create the audio object with GCS URI
         audio = speech.RecognitionAudio(uri=gcs_uri)
 
-        # Simplified recognition config without diarization
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=sample_rate,
-            language_code="en-US",
-            enable_automatic_punctuation=True,
-            enable_word_confidence=True,
-            profanity_filter=False,
-            use_enhanced=True,
-            model='phone_call',
-            metadata=speech.RecognitionMetadata(
-                interaction_type=speech.RecognitionMetadata.InteractionType.DISCUSSION,
-                recording_device_type=speech.RecognitionMetadata.RecordingDeviceType.SMARTPHONE,
-            )
-        )
+        config = recognition_config(sample_rate)
 
+        # Share the project quota with the other ASR processes on this host
+        if acquire_quota:
+            quota_governor.acquire('speech')
         operation = client.long_running_recognize(config=config, audio=audio)
 
         if verbose:
@@ -109,7 +123,55 @@ def run_asr_long(speech_file, verbose=False, timeout=180, sample_rate=24000):
         return None
 
 
-def batch(input_dir: str, output_file: str = "batch-asr-output.txt", verbose=False):
+def recognize_bytes(audio_content: bytes, name: str = 'audio.wav', verbose=False, timeout=180, sample_rate=24000, raise_errors=False,
+                    acquire_quota=True):
+    """
+    Execute speech recognition on in-memory WAV bytes, e.g. straight from TTS.
+
+    Clips within the synchronous API limits (about 1 minute, 10 MB) are sent inline,
+    so nothing is written to disk or GCS. Longer clips are uploaded to GCS as `name`
+    and recognized like run_asr_long.
+
+    Returns:
+        The transcript (one line per result), or None on error (with raise_errors, the error is raised,
+        e.g. for callers that react to ResourceExhausted).
+        With acquire_quota=False the caller has already taken the quota_governor token,
+        e.g. before a concurrency slot.
+    """
+    if acquire_quota:
+        quota_governor.acquire('speech')
+    with METRICS.track('asr', api='speech', bytes_in=len(audio_content)) as call:
+        try:
+            duration = len(audio_content) / (sample_rate * 2)  # LINEAR16 mono
+            if duration <= INLINE_MAX_SECONDS and len(audio_content) <= INLINE_MAX_BYTES:
+                audio = speech.RecognitionAudio(content=audio_content)
+                response = client.recognize(config=recognition_config(sample_rate), audio=audio, timeout=timeout)
+            else:
+                bucket = storage_client.bucket(STORAGE_BUCKET)
+                blob = bucket.blob(name)
+                blob.upload_from_string(audio_content, content_type='audio/wav')
+                try:
+                    audio = speech.RecognitionAudio(uri=f"gs://{STORAGE_BUCKET}/{name}")
+                    operation = client.long_running_recognize(config=recognition_config(sample_rate), audio=audio)
+                    response = operation.result(timeout=timeout)
+                finally:
+                    blob.delete()  # also when recognition fails, so retries do not leave uploads behind
+
+            results_str = "\n".join(result.alternatives[0].transcript for result in response.results)
+            call.bytes_out = len(results_str.encode('utf-8'))
+            if verbose:
+                print(f"Results for {name}:", results_str)
+            return results_str
+
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"Error processing {name}: {e}")
+            call.fail()
+            return None
+
+
+def batch(input_dir: str, output_file: str = "batch-asr-output.txt", verbose=False, metrics_dir: str = None):
     """批量处理音频文件。
     Usage:
         python run_cloud_asr_batch.py batch input_dir output_file
@@ -118,17 +180,26 @@ def batch(input_dir: str, output_file: str = "batch-asr-output.txt", verbose=Fal
         input_dir: 包含音频文件的输入目录。
         output_file: 输出文本文件路径。
         verbose: 是否打印详细信息。
+        metrics_dir: 定期写入 Prometheus textfile (asr.prom)，退出时写入 JSON 汇总 (asr.summary.json)。
     """
+    if metrics_dir:
+        start_export(metrics_dir, 'asr')
     audio_files = [f for f in os.listdir(input_dir) if f.endswith('.wav')]
+    progress = ProgressLine(METRICS, total=len(audio_files))
 
     with open(output_file, 'w', encoding='utf-8') as f:
         for audio_file in sorted(audio_files):
             file_path = os.path.join(input_dir, audio_file)
             result = run_asr_long(file_path, verbose)
+            progress.update()
+            if result is None:
+                continue
             for line in result.splitlines():
                 if line.strip():
                     f.write(f"{audio_file}\t{line.strip()}\n")
                     f.flush()
+    progress.close()
+    print_summary()
 
 
 def single(input_file: str, output_file: str, verbose=False):
@@ -151,4 +222,4 @@ def single(input_file: str, output_file: str, verbose=False):
 
 
 if __name__ == "__main__":
-    argh.dispatch_commands([single, batch])
+    profiling.dispatch_commands([single, batch])
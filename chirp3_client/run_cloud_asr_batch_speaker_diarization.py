@@ -1,11 +1,14 @@
 import json
-import argh
+import profiling
 import os
 from google.oauth2 import service_account
 from google.cloud import speech_v1p1beta1 as speech
 from google.auth.credentials import Credentials
 from google.cloud import storage
 from google.api_core.client_options import ClientOptions
+from text_normalize import attach_punctuation
+import quota_governor
+from stage_metrics import tracked
 
 
 GOOGLE_APPLICATION_CREDENTIALS="gcs-keys.json"
@@ -81,13 +84,7 @@ def merge_consecutive_speakers(words_info, add_speaker_tag=False):
 
 def format_sentence(words):
     """处理标点符号格式"""
-    sentence = " ".join(words)
-    replacements = [
-        (" ,", ","), (" .", "."), (" ?", "?"), (" !", "!"),
-        (" '", "'"), (" ;", ";"), (" :", ":")]
-    for old, new in replacements:
-        sentence = sentence.replace(old, new)
-    return sentence
+    return attach_punctuation(" ".join(words))
 
 def run_asr(speech_file, verbose=False, add_speaker_tag=False):
     """执行语音识别并进行说话人分离。
@@ -128,6 +125,7 @@ def run_asr(speech_file, verbose=False, add_speaker_tag=False):
         if verbose:
             print(f"Processing file: {speech_file}")
 
+        quota_governor.acquire('speech')
         response = client.recognize(config=config, audio=audio)
         result = response.results[-1]
         words_info = result.alternatives[0].words
@@ -162,6 +160,7 @@ def upload_to_gcs(file_path: str, bucket_name: str) -> str:
         print(f"Error uploading to GCS: {e}")
         return None
 
+@tracked('asr', api='speech', none_is_error=True)
 def run_asr_long(speech_file, verbose=False, add_speaker_tag=False, timeout=180):
     """执行语音识别并进行说话人分离。支持长音频文件。"""
     try:
@@ -194,6 +193,7 @@ def run_asr_long(speech_file, verbose=False, add_speaker_tag=False, timeout=180)
         )
 
         # Use long_running_recognize with GCS URI
+        quota_governor.acquire('speech')
         operation = client.long_running_recognize(config=config, audio=audio)
 
         if verbose:
@@ -265,4 +265,4 @@ def single(input_file: str, output_file: str, verbose=False, add_speaker_tag=Fal
 
 
 if __name__ == "__main__":
-    argh.dispatch_commands([single, batch])
+    profiling.dispatch_commands([single, batch])
@@ -0,0 +1,312 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import profiling
+from ref_store import ref_id_from_wav
+
+RUN_DB_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Columns set by record(); scores are kept whole as JSON next to the indexed columns
+COLUMNS = ('text', 'wav_path', 'tts_status', 'asr_status', 'asr_text', 'reference_text', 'ref_len',
+           'sim_char', 'sim_word', 'wer', 'cer', 'scores', 'kept')
+
+
+def is_run_db(path: str) -> bool:
+    """True if path names a run database (by extension) rather than a JSONL file."""
+    return os.path.splitext(path)[1].lower() in RUN_DB_EXTENSIONS
+
+
+class RunDB:
+    """
+    One row per (item, voice) of a TTS -> ASR -> compare run in SQLite.
+
+    Every stage writes its result to the row of the item it processed: TTS the text,
+    WAV path and tts_status, ASR the transcript and asr_status, the comparison the scores
+    and the kept flag. Stages find their work with an indexed query instead of listing
+    directories and mapping .wav names to .txt names, and re-selecting with other
+    thresholds is a single UPDATE instead of rescoring or re-reading JSONL files.
+
+    Statuses are 'pending', 'done' or 'failed'. A new TTS result resets the item's ASR
+    and scores, and a new transcript resets its scores, so nothing stale is selected.
+    The database is in WAL mode, so status queries can run while a stage is writing.
+    """
+
+    def __init__(self, path: str = 'run.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            "item_id TEXT NOT NULL, voice TEXT NOT NULL DEFAULT '', text TEXT, wav_path TEXT, "
+            "tts_status TEXT NOT NULL DEFAULT 'pending', asr_status TEXT NOT NULL DEFAULT 'pending', asr_text TEXT, "
+            'reference_text TEXT, ref_len INTEGER, sim_char REAL, sim_word REAL, wer REAL, cer REAL, scores TEXT, '
+            'kept INTEGER, updated REAL, PRIMARY KEY (item_id, voice))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS items_wav_path ON items(wav_path)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS items_status ON items(tts_status, asr_status)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS items_sim_char ON items(sim_char)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS items_kept ON items(kept)')
+        self._conn.commit()
+
+    def record(self, item_id: str, voice: str, **fields) -> None:
+        """Insert or update the row of (item_id, voice) with the given columns."""
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown run database columns: {sorted(unknown)}")
+        names = list(fields)
+        assignments = ', '.join(f'{name} = excluded.{name}' for name in names + ['updated'])
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO items (item_id, voice, {', '.join(names + ['updated'])}) "
+                f"VALUES (?, ?, {', '.join('?' * (len(names) + 1))}) "
+                f'ON CONFLICT (item_id, voice) DO UPDATE SET {assignments}',
+                [item_id, voice, *fields.values(), time.time()])
+            self._conn.commit()
+
+    def record_tts(self, item_id: str, voice: str, text: str, wav_path: Optional[str], ok: bool = True) -> None:
+        """New audio (or a failed attempt) for an item; its ASR result and scores no longer apply."""
+        self.record(item_id, voice, text=text, wav_path=os.path.abspath(wav_path) if wav_path else None,
+                    tts_status='done' if ok else 'failed', asr_status='pending', asr_text=None, **_NO_SCORES)
+
+    def record_asr(self, item_id: str, voice: str, asr_text: Optional[str], ok: bool = True) -> None:
+        """Transcript of an item's audio (None / ok=False for a failure); its scores no longer apply."""
+        self.record(item_id, voice, asr_text=asr_text, asr_status='done' if ok else 'failed', **_NO_SCORES)
+
+    def record_scores(self, item_id: str, voice: str, scores: Dict[str, Any], kept: Optional[bool] = None) -> None:
+        """Scores of batch_compare_asr_ref.score_pair, and whether the item was kept."""
+        self.record(item_id, voice, reference_text=scores['reference_text'], ref_len=len(scores['reference_text']),
+                    sim_char=scores['sim_char'], sim_word=scores['sim_word'], wer=scores.get('wer'),
+                    cer=scores.get('cer'), scores=json.dumps(scores, ensure_ascii=False),
+                    kept=None if kept is None else int(kept))
+
+    def item_for_wav(self, wav_path: str) -> Optional[Tuple[str, str]]:
+        """(item_id, voice) of the row whose audio is wav_path, or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT item_id, voice FROM items WHERE wav_path = ?',
+                                     (os.path.abspath(wav_path),)).fetchone()
+        return (row['item_id'], row['voice']) if row else None
+
+    def _query(self, sql: str, params=()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def tts_done(self, voice: str) -> Dict[str, str]:
+        """{item_id: text} of the items of a voice whose audio exists."""
+        rows = self._query("SELECT item_id, text FROM items WHERE voice = ? AND tts_status = 'done'", (voice,))
+        return {row['item_id']: row['text'] for row in rows}
+
+    def pending_asr(self, wav_dir: str = '') -> List[sqlite3.Row]:
+        """Rows with audio but no transcript yet (or a failed one), optionally only those in wav_dir."""
+        rows = self._query("SELECT * FROM items WHERE tts_status = 'done' AND asr_status IN ('pending', 'failed') "
+                           'AND wav_path IS NOT NULL ORDER BY wav_path')
+        if wav_dir:
+            wav_dir = os.path.abspath(wav_dir)
+            rows = [row for row in rows if os.path.dirname(row['wav_path']) == wav_dir]
+        return rows
+
+    def pending_scores(self) -> List[sqlite3.Row]:
+        """Rows with a transcript and reference text that have not been scored."""
+        return self._query("SELECT * FROM items WHERE tts_status = 'done' AND asr_status = 'done' "
+                           'AND sim_char IS NULL AND text IS NOT NULL ORDER BY item_id, voice')
+
+    def select(self, min_char_sim: float = 0.5, min_char_sim_for_short_lines: float = 0.7) -> int:
+        """
+        Set the kept flag of every scored row, as batch_compare_asr_ref.is_kept would; returns the kept count.
+
+        Rows without audio (clips the pipeline rejected and did not write) are never kept.
+        """
+        from batch_compare_asr_ref import SHORT_LINE_CHARS
+        with self._lock:
+            self._conn.execute(
+                'UPDATE items SET kept = (wav_path IS NOT NULL AND sim_char >= ? AND (sim_char >= ? OR ref_len >= ?)) '
+                'WHERE sim_char IS NOT NULL',
+                (min_char_sim, min_char_sim_for_short_lines, SHORT_LINE_CHARS))
+            self._conn.commit()
+            return self._conn.execute('SELECT COUNT(*) FROM items WHERE kept = 1').fetchone()[0]
+
+    def selected(self, min_similarity: Optional[float] = None, wav_dir: str = '') -> Iterator[Tuple[Dict[str, Any], str]]:
+        """
+        (comparison record, WAV path) of the selected rows, ordered by WAV path.
+
+        Rows are selected by their kept flag, or by sim_char >= min_similarity if given.
+        Records have the fields of a batch_compare_asr_ref.py output line (filename, text,
+        voice and the scores). With wav_dir, only rows whose audio is in that directory.
+        """
+        if min_similarity is None:
+            rows = self._query('SELECT * FROM items WHERE kept = 1 ORDER BY wav_path')
+        else:
+            rows = self._query('SELECT * FROM items WHERE sim_char >= ? ORDER BY wav_path', (min_similarity,))
+        wav_dir = os.path.abspath(wav_dir) if wav_dir else ''
+        for row in rows:
+            if not row['wav_path'] or (wav_dir and os.path.dirname(row['wav_path']) != wav_dir):
+                continue
+            record = {'filename': os.path.basename(row['wav_path']), 'text': row['asr_text'], 'voice': row['voice'],
+                      **json.loads(row['scores'])}
+            yield record, row['wav_path']
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*), '
+                "SUM(tts_status = 'done'), SUM(tts_status = 'failed'), "
+                "SUM(asr_status = 'done'), SUM(asr_status = 'failed'), "
+                'SUM(sim_char IS NOT NULL), SUM(kept = 1) FROM items').fetchone()
+        names = ('items', 'tts_done', 'tts_failed', 'asr_done', 'asr_failed', 'scored', 'kept')
+        return {name: value or 0 for name, value in zip(names, row)}
+
+    def print_summary(self) -> None:
+        c = self.counts()
+        print(f"Run database {self.path}: {c['items']} items, TTS {c['tts_done']} done / {c['tts_failed']} failed, "
+              f"ASR {c['asr_done']} done / {c['asr_failed']} failed, {c['scored']} scored, {c['kept']} kept")
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_NO_SCORES = dict(reference_text=None, ref_len=None, sim_char=None, sim_word=None, wer=None, cer=None, scores=None, kept=None)
+
+
+def _voice_of_dir(wav_dir: str, voice: str) -> str:
+    if voice:
+        return voice
+    from export_manifest import voice_from_dir
+    return voice_from_dir(wav_dir)
+
+
+def import_tts(db_path: str, wav_dir: str, txt_dir: str = None, voice: str = '', neglect_reffile_prefix: str = 'vc_') -> None:
+    """
+    Register the WAVs of an existing TTS output directory and their texts.
+
+    Args:
+        db_path: Run database
+        wav_dir: Directory of WAV files
+        txt_dir: Directory of the .txt files written with them (default: wav_dir)
+        voice: Voice of the WAVs (default: wav_dir's name if it is a per-voice directory)
+        neglect_reffile_prefix: Prefix of WAV names that is not part of the .txt name
+    """
+    db = RunDB(db_path)
+    voice = _voice_of_dir(wav_dir, voice)
+    txt_dir = txt_dir or wav_dir
+    count = 0
+    for wav_path in sorted(glob.glob(os.path.join(wav_dir, '*.wav'))):
+        item_id = ref_id_from_wav(os.path.basename(wav_path), neglect_reffile_prefix)
+        txt_path = os.path.join(txt_dir, item_id + '.txt')
+        text = None
+        if os.path.exists(txt_path):
+            with open(txt_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        db.record_tts(item_id, voice, text, wav_path)
+        count += 1
+    print(f"Registered {count} WAVs of {wav_dir} (voice {voice or '-'})")
+    db.print_summary()
+    db.close()
+
+
+def import_asr(db_path: str, asr_jsonl: str, wav_dir: str) -> None:
+    """
+    Record the transcripts of a batch_asr_parallel.py output for WAVs already registered.
+
+    Args:
+        db_path: Run database
+        asr_jsonl: ASR results ({"filename", "text"} per line)
+        wav_dir: Directory the transcribed WAVs are in
+    """
+    db = RunDB(db_path)
+    count = missing = 0
+    with open(asr_jsonl, 'r', encoding='utf-8') as f:
+        for line in f:
+            result = json.loads(line)
+            key = db.item_for_wav(os.path.join(wav_dir, result['filename']))
+            if key is None:
+                missing += 1
+                continue
+            failed = result['text'].startswith('ERROR:')
+            db.record_asr(*key, None if failed else result['text'], ok=not failed)
+            count += 1
+    print(f"Recorded {count} transcripts from {asr_jsonl}" + (f", {missing} WAVs not registered" if missing else ''))
+    db.print_summary()
+    db.close()
+
+
+def score(db_path: str, min_char_sim: float = 0.5, min_char_sim_for_short_lines: float = 0.7,
+          detect_ending_noise: bool = False, verbose: bool = False) -> None:
+    """
+    Score the transcribed rows that have no scores yet, then select with the given thresholds.
+
+    Args:
+        db_path: Run database
+        min_char_sim: Minimum character similarity of a kept item
+        min_char_sim_for_short_lines: Minimum character similarity of kept short references
+        detect_ending_noise: Score 0 when the ASR text continues past the end of the reference
+    """
+    from batch_compare_asr_ref import score_pair
+    db = RunDB(db_path)
+    rows = db.pending_scores()
+    for row in rows:
+        scores, _ = score_pair(row['asr_text'], row['text'].strip(), detect_ending_noise=detect_ending_noise,
+                               verbose=verbose, name=row['item_id'])
+        db.record_scores(row['item_id'], row['voice'], scores)
+    print(f"Scored {len(rows)} items")
+    db.select(min_char_sim, min_char_sim_for_short_lines)
+    db.print_summary()
+    db.close()
+
+
+def select(db_path: str, min_char_sim: float = 0.5, min_char_sim_for_short_lines: float = 0.7) -> None:
+    """
+    Re-select the scored rows with other thresholds; nothing is rescored.
+
+    Args:
+        db_path: Run database
+        min_char_sim: Minimum character similarity of a kept item
+        min_char_sim_for_short_lines: Minimum character similarity of kept short references
+    """
+    db = RunDB(db_path)
+    kept = db.select(min_char_sim, min_char_sim_for_short_lines)
+    print(f"Selected {kept} items")
+    db.print_summary()
+    db.close()
+
+
+def export_jsonl(db_path: str, output_jsonl: str, wav_dir: str = '') -> None:
+    """
+    Write the selected rows as a batch_compare_asr_ref.py style JSONL file.
+
+    Args:
+        db_path: Run database
+        output_jsonl: Output JSONL file
+        wav_dir: Only rows whose WAV is in this directory (e.g. one voice of a multi-voice run)
+    """
+    db = RunDB(db_path)
+    count = 0
+    with open(output_jsonl, 'w', encoding='utf-8') as f:
+        for record, _ in db.selected(wav_dir=wav_dir):
+            json.dump(record, f, ensure_ascii=False)
+            f.write('\n')
+            count += 1
+    print(f"Wrote {count} selected records to {output_jsonl}")
+    db.close()
+
+
+def status(db_path: str) -> None:
+    """Print the item counts of a run database."""
+    db = RunDB(db_path)
+    db.print_summary()
+    db.close()
+
+
+if __name__ == "__main__":
+    profiling.dispatch_commands([import_tts, import_asr, score, select, export_jsonl, status])
+
+# python run_chirp3_tts_batch.py batch sentences.txt wavs --run-db run.db
+# python batch_asr_parallel.py wavs --output-json asr.jsonl --run-db run.db
+# python run_db.py score run.db
+# python run_db.py select run.db --min-char-sim 0.8
+# python organize_filtered_wavs_txts.py run.db "" selected-wavs selected-txts
+# Existing outputs: python run_db.py import-tts run.db wavs; python run_db.py import-asr run.db asr.jsonl wavs
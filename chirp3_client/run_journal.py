@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+
+def item_key(idx: int, line: str) -> str:
+    """Journal key of an input line: its index plus a hash of its content.
+
+    Editing or reordering the input changes the key, so stale entries are not reused.
+    """
+    return f"{idx}-{hashlib.sha1(line.encode('utf-8')).hexdigest()[:12]}"
+
+
+class RunJournal:
+    """
+    Append-only JSONL journal of the items a resumable job has finished.
+
+    Each record is {"key": ..., "status": "done" | "failed"}, plus the number of output
+    "lines" written for a done item (used by sharding.py merge-text); the last record for a
+    key wins. An item is journaled as done only after its output has been written
+    and flushed, so after a crash it is either finished or redone, never lost.
+    Failed items are retried on the next run and collected in a retry file.
+    """
+
+    def __init__(self, path: str, fresh: bool = False):
+        self.path = path
+        self.status: Dict[str, str] = {}
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line after a crash
+                    self.status[record['key']] = record['status']
+        self.resumed = bool(self.status)
+        self.failed_lines: List[str] = []
+        self._fout = open(path, 'a', encoding='utf-8')
+        if self._fout.tell() and not self._ends_with_newline():
+            self._fout.write('\n')  # end a torn line, so the next record is not appended to it
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def is_done(self, key: str) -> bool:
+        return self.status.get(key) == 'done'
+
+    def _record(self, key: str, status: str, **fields) -> None:
+        self.status[key] = status
+        self._fout.write(json.dumps({'key': key, 'status': status, **fields}) + '\n')
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+
+    def mark_done(self, key: str, lines: Optional[int] = None) -> None:
+        self._record(key, 'done', **({} if lines is None else {'lines': lines}))
+
+    def mark_failed(self, key: str, line: str) -> None:
+        self._record(key, 'failed')
+        self.failed_lines.append(line)
+
+    def write_retry_file(self, retry_path: str) -> None:
+        """Write the input lines that failed in this run, ready to be fed back as input."""
+        with open(retry_path, 'w', encoding='utf-8') as f:
+            for line in self.failed_lines:
+                f.write(line + '\n')
+
+    def close(self) -> None:
+        self._fout.close()
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import profiling
+from stream_sort import ExternalSorter
+
+
+def parse_shard(shard: str) -> Optional[Tuple[int, int]]:
+    """'i/N' -> (i, N); '' -> None (no sharding)."""
+    if not shard:
+        return None
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard {shard!r}, expected i/N such as 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard!r}: need 0 <= i < N")
+    return index, count
+
+
+def shard_of(item_id: str, num_shards: int) -> int:
+    """Shard of an item: a hash of its id that is the same on every machine and Python version."""
+    return int(hashlib.sha1(item_id.encode('utf-8')).hexdigest()[:8], 16) % num_shards
+
+
+def in_shard(item_id: str, shard: Optional[Tuple[int, int]]) -> bool:
+    """True if item_id belongs to shard (always True without sharding)."""
+    return shard is None or shard_of(item_id, shard[1]) == shard[0]
+
+
+def print_shard(shard: Optional[Tuple[int, int]], selected: int, total: int, what: str = 'items') -> None:
+    if shard is not None:
+        print(f"Shard {shard[0]}/{shard[1]}: {selected} of {total} {what}")
+
+
+def _read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _write_jsonl(path: str, records) -> int:
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            json.dump(record, f, ensure_ascii=False)
+            f.write('\n')
+            count += 1
+    return count
+
+
+def _sorted_records(inputs: List[str], sort_key: str, spill_size: int, tmp_dir: str) -> Iterator[Dict[str, Any]]:
+    """Records of all inputs ordered by sort_key (ties by filename, then input order)."""
+    sorter = ExternalSorter(lambda r: (r.get(sort_key), r.get('filename', '')), spill_size=spill_size, tmp_dir=tmp_dir)
+    for path in inputs:
+        for record in _read_jsonl(path):
+            sorter.add(record)
+    return iter(sorter)
+
+
+def merge_jsonl(output: str, *inputs: str, sort_key: str = 'filename', spill_size: int = 0) -> None:
+    """
+    Merge per-shard JSONL outputs (batch_asr_parallel.py, batch_compare_asr_ref.py) into one file.
+
+    Records are ordered by sort_key: filename (the order of a single-node run over the
+    same files), sim_char for outputs of batch_compare_asr_ref.py --sort-by-similarity,
+    or '' to concatenate the shards as given. Sidecars of batch_compare_asr_ref.py next
+    to every input are merged too: .deleted.jsonl the same way, .worst.jsonl as the
+    lowest sim_char records overall, and .hist.json by adding up the bins.
+
+    Args:
+        output: Merged JSONL file
+        inputs: Per-shard JSONL files
+        sort_key: Record field to order by ('' = keep shard order)
+        spill_size: Sort with bounded memory, spilling runs of this many records to disk (0 = in memory)
+    """
+    from batch_compare_asr_ref import sidecar_path
+    tmp_dir = os.path.dirname(os.path.abspath(output))
+
+    def merged(paths: List[str]) -> Iterator[Dict[str, Any]]:
+        if not sort_key:
+            return (record for path in paths for record in _read_jsonl(path))
+        return _sorted_records(paths, sort_key, spill_size, tmp_dir)
+
+    count = _write_jsonl(output, merged(list(inputs)))
+    print(f"Merged {count} records from {len(inputs)} shards into {output}")
+
+    deleted = [sidecar_path(path, 'deleted') for path in inputs]
+    if all(os.path.exists(path) for path in deleted):
+        count = _write_jsonl(sidecar_path(output, 'deleted'), merged(deleted))
+        print(f"Merged {count} deleted records into {sidecar_path(output, 'deleted')}")
+
+    worst = [sidecar_path(path, 'worst') for path in inputs]
+    if all(os.path.exists(path) for path in worst):
+        shard_worst = [list(_read_jsonl(path)) for path in worst]
+        k = max(len(records) for records in shard_worst)
+        records = sorted((r for records in shard_worst for r in records), key=lambda r: (r['sim_char'], r.get('filename', '')))
+        _write_jsonl(sidecar_path(output, 'worst'), records[:k])
+        print(f"Merged the lowest sim_char records into {sidecar_path(output, 'worst')}")
+
+    hists = [sidecar_path(path, 'hist', '.json') for path in inputs]
+    if all(os.path.exists(path) for path in hists):
+        total: Dict[str, Dict[str, int]] = {}
+        for path in hists:
+            with open(path, 'r', encoding='utf-8') as f:
+                for field, bins in json.load(f).items():
+                    for label, n in bins.items():
+                        total.setdefault(field, {}).setdefault(label, 0)
+                        total[field][label] += n
+        hist_file = sidecar_path(output, 'hist', '.json')
+        with open(hist_file, 'w', encoding='utf-8') as f:
+            json.dump(total, f, indent=2)
+        print(f"Merged histograms into {hist_file}")
+
+
+def _journaled_chunks(output_file: str) -> Iterator[Tuple[int, List[str]]]:
+    """(input index, output lines) of every item of a rewrite output, from its run journal."""
+    journal_path = output_file + '.journal.jsonl'
+    with open(output_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    pos = 0
+    for record in _read_jsonl(journal_path):
+        if record['status'] != 'done':
+            continue
+        if 'lines' not in record:
+            raise ValueError(f"{journal_path} has no line counts (written before sharding support); rerun with --fresh")
+        idx = int(record['key'].split('-')[0])
+        yield idx, lines[pos:pos + record['lines']]
+        pos += record['lines']
+    if pos != len(lines):
+        raise ValueError(f"{output_file} has {len(lines)} lines but its journal accounts for {pos}")
+
+
+def merge_text(output: str, *inputs: str) -> None:
+    """
+    Merge per-shard outputs of rewrite_chatting_style.py / rewrite_paragraphs.py in input order.
+
+    Each shard's run journal (<input>.journal.jsonl) records which input item every block
+    of output lines came from, so the merged file has the lines in the order a single-node
+    run would have written them.
+
+    Args:
+        output: Merged text file
+        inputs: Per-shard output files (each with its .journal.jsonl next to it)
+    """
+    chunks = sorted((chunk for path in inputs for chunk in _journaled_chunks(path)), key=lambda c: c[0])
+    with open(output, 'w', encoding='utf-8') as f:
+        for _, lines in chunks:
+            f.writelines(lines)
+    print(f"Merged {len(chunks)} items from {len(inputs)} shards into {output}")
+
+
+def merge_dirs(output_dir: str, *input_dirs: str, link_mode: str = 'auto', num_workers: int = 8) -> None:
+    """
+    Combine per-shard output directories (e.g. TTS wavs/txts) into one, recursively.
+
+    Shards write disjoint file names, so files are linked (or copied, see organize_filtered_wavs_txts.py)
+    into output_dir as they are; a name present in two shards is an error.
+
+    Args:
+        output_dir: Combined directory
+        input_dirs: Per-shard directories
+        link_mode: auto (reflink, else copy), hardlink, reflink, symlink or copy
+        num_workers: Parallel copies
+    """
+    from organize_filtered_wavs_txts import FilePlacer
+    placer = FilePlacer(link_mode, num_workers=num_workers)
+    sources: Dict[str, str] = {}
+    for input_dir in input_dirs:
+        for root, _, files in os.walk(input_dir):
+            rel_dir = os.path.relpath(root, input_dir)
+            os.makedirs(os.path.join(output_dir, rel_dir), exist_ok=True)
+            for name in files:
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                if rel_path in sources:
+                    raise ValueError(f"{rel_path} is in both {sources[rel_path]} and {input_dir}")
+                sources[rel_path] = input_dir
+                placer.place(os.path.join(root, name), os.path.join(output_dir, rel_path))
+    placer.close()
+    print(f"Merged {len(sources)} files from {len(input_dirs)} shards into {output_dir}")
+    placer.print_summary()
+
+
+def merge_manifest(output: str, *inputs: str, sort_key: str = 'id') -> None:
+    """
+    Merge per-shard manifests of export_manifest.py (Parquet, Arrow or JSONL).
+
+    Rows are ordered by sort_key ('' = shard order). Relative audio paths are rebased to
+    the merged manifest's directory. Packed audio is rewritten into one blob in the
+    merged row order, so its layout is the one a single export would produce.
+
+    Args:
+        output: Merged manifest (the format follows the extension, as in export_manifest.py)
+        inputs: Per-shard manifests
+        sort_key: Column to order the rows by
+    """
+    from export_manifest import AUDIO_BLOB_SUFFIX, ManifestWriter, PackedAudio, manifest_format, pa, pq
+    output_dir = os.path.dirname(os.path.abspath(output))
+    packed = [os.path.exists(path + AUDIO_BLOB_SUFFIX) for path in inputs]
+    if any(packed) and not all(packed):
+        raise ValueError("Either all or none of the manifests must have packed audio")
+
+    rows = []  # (row, index of its shard)
+    for shard_idx, path in enumerate(inputs):
+        fmt = manifest_format(path)
+        if fmt == 'jsonl':
+            shard_rows = list(_read_jsonl(path))
+        elif fmt == 'parquet':
+            shard_rows = pq.read_table(path).to_pylist()
+        else:
+            with pa.memory_map(path) as source:
+                shard_rows = pa.ipc.open_file(source).read_all().to_pylist()
+        shard_dir = os.path.dirname(os.path.abspath(path))
+        for row in shard_rows:
+            if row['path']:
+                row['path'] = os.path.relpath(os.path.join(shard_dir, row['path']), output_dir)
+            rows.append((row, shard_idx))
+    if sort_key:
+        rows.sort(key=lambda item: item[0][sort_key])
+
+    blobs = [PackedAudio(path + AUDIO_BLOB_SUFFIX) for path in inputs] if all(packed) and inputs else None
+    fblob = open(output + AUDIO_BLOB_SUFFIX, 'wb') if blobs else None
+    offset = 0
+    writer = ManifestWriter(output, manifest_format(output))
+    for row, shard_idx in rows:
+        if fblob is not None:
+            fblob.write(blobs[shard_idx].get(row['audio_offset'], row['audio_bytes']))
+            row['audio_offset'] = offset
+            offset += row['audio_bytes']
+        writer.add(row)
+    writer.close()
+    if fblob is not None:
+        fblob.close()
+        for blob in blobs:
+            blob.close()
+    print(f"Merged {len(rows)} rows from {len(inputs)} manifests into {output}")
+
+
+if __name__ == "__main__":
+    profiling.dispatch_commands([merge_jsonl, merge_text, merge_dirs, merge_manifest])
+
+# On node i of N:
+#   python run_chirp3_tts_batch.py batch sentences.txt wavs-$i --textdir txts-$i --shard $i/4
+#   python batch_asr_parallel.py wavs-$i --output-json asr-$i.jsonl --shard $i/4
+# Then on one machine:
+#   python sharding.py merge-dirs wavs wavs-0 wavs-1 wavs-2 wavs-3
+#   python sharding.py merge-jsonl asr.jsonl asr-0.jsonl asr-1.jsonl asr-2.jsonl asr-3.jsonl
+#   python sharding.py merge-jsonl compare.jsonl compare-0.jsonl compare-1.jsonl --sort-key sim_char
+#   python sharding.py merge-text rewritten.txt rewritten-0.txt rewritten-1.txt
+#   python sharding.py merge-manifest manifest.parquet manifest-0.parquet manifest-1.parquet
@@ -0,0 +1,296 @@
+import atexit
+import bisect
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus style; the last bucket is +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+METRIC_PREFIX = 'chirp3'
+
+
+class StageStats:
+    """Counters, latency histogram, bytes and in-flight gauge of one (stage, api)."""
+
+    def __init__(self, stage: str, api: str = ''):
+        self.stage = stage
+        self.api = api
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float, ok: bool, bytes_in: int, bytes_out: int) -> None:
+        self.count += 1
+        self.errors += not ok
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.latency_sum += seconds
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, q: float) -> float:
+        """q-th latency percentile (0-100), interpolated within its histogram bucket."""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                low = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                high = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else low * 2
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return LATENCY_BUCKETS[-1]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'stage': self.stage,
+            'api': self.api,
+            'count': self.count,
+            'errors': self.errors,
+            'error_rate': self.errors / self.count if self.count else 0.0,
+            'in_flight': self.in_flight,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'latency_mean': self.latency_sum / self.count if self.count else 0.0,
+            'latency_p50': self.percentile(50),
+            'latency_p90': self.percentile(90),
+            'latency_p99': self.percentile(99),
+        }
+
+
+class Call:
+    """Handle of one tracked call: set bytes_out, or fail() when an error is returned instead of raised."""
+
+    def __init__(self, bytes_in: int = 0):
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.ok = True
+
+    def fail(self) -> None:
+        self.ok = False
+
+
+class Metrics:
+    """
+    Thread-safe registry of per-stage, per-API metrics for one job.
+
+    Use track() around each unit of work (an API call, a file):
+
+        with METRICS.track('tts', api='tts', bytes_in=len(text)) as call:
+            audio = synthesize(text)
+            call.bytes_out = len(audio)
+
+    or record() for work timed elsewhere (e.g. in a worker process). The registry renders
+    as a one-line progress display, a Prometheus textfile and a JSON summary.
+    """
+
+    def __init__(self, job: str = 'chirp3'):
+        self.job = job
+        self.started = time.time()
+        self._stages: Dict[Tuple[str, str], StageStats] = {}
+        self._lock = threading.Lock()
+        # Stages each thread is inside (innermost last), and objects told when a thread enters or
+        # leaves one (stage_enter(stage) / stage_exit(stage), called in that thread); see profiling.py
+        self.thread_stages: Dict[int, List[str]] = {}
+        self.listeners: List[Any] = []
+
+    def stage(self, stage: str, api: str = '') -> StageStats:
+        key = (stage, api)
+        if key not in self._stages:
+            with self._lock:
+                self._stages.setdefault(key, StageStats(stage, api))
+        return self._stages[key]
+
+    @contextlib.contextmanager
+    def track(self, stage: str, api: str = '', bytes_in: int = 0) -> Iterator[Call]:
+        """Time the enclosed work and count it as an error if it raises or calls fail()."""
+        stats = self.stage(stage, api)
+        call = Call(bytes_in)
+        tid = threading.get_ident()
+        thread_stages = self.thread_stages.setdefault(tid, [])
+        thread_stages.append(stage)
+        for listener in self.listeners:
+            listener.stage_enter(stage)
+        with self._lock:
+            stats.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield call
+        except BaseException:
+            call.ok = False
+            raise
+        finally:
+            with self._lock:
+                stats.in_flight -= 1
+                stats.observe(time.monotonic() - start, call.ok, call.bytes_in, call.bytes_out)
+            for listener in self.listeners:
+                listener.stage_exit(stage)
+            thread_stages.pop()
+            if not thread_stages:
+                del self.thread_stages[tid]  # so finished worker threads are not kept forever
+
+    def record(self, stage: str, seconds: float, ok: bool = True, api: str = '', bytes_in: int = 0, bytes_out: int = 0) -> None:
+        """Record one unit of work that was timed elsewhere."""
+        stats = self.stage(stage, api)
+        with self._lock:
+            stats.observe(seconds, ok, bytes_in, bytes_out)
+
+    def reset(self) -> None:
+        """Forget all stages and restart the clock (e.g. between benchmark runs)."""
+        with self._lock:
+            self._stages.clear()
+            self.started = time.time()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = [s.summary() for s in self._stages.values()]
+        elapsed = time.time() - self.started
+        for s in stages:
+            s['per_second'] = s['count'] / elapsed if elapsed else 0.0
+        return {'job': self.job, 'started': self.started, 'elapsed': elapsed, 'stages': stages}
+
+    def progress_line(self, total: int = 0) -> str:
+        """Compact status of all stages: done/total, errors, rate, p50 latency and in-flight."""
+        elapsed = time.time() - self.started
+        parts = []
+        for s in self.summary()['stages']:
+            name = f"{s['stage']}/{s['api']}" if s['api'] else s['stage']
+            done = f"{s['count']}/{total}" if total else str(s['count'])
+            parts.append(f"{name} {done} err={s['errors']} {s['per_second']:.1f}/s p50={s['latency_p50']:.2f}s "
+                         f"inflight={s['in_flight']}")
+        return f"[{elapsed:.0f}s] " + ' | '.join(parts)
+
+    def to_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format (for node_exporter's textfile collector)."""
+        p = METRIC_PREFIX
+        with self._lock:
+            stages = [(f'job="{self.job}",stage="{s.stage}",api="{s.api}"', s) for s in self._stages.values()]
+            lines = [f"# TYPE {p}_requests_total counter"]
+            lines += [f"{p}_requests_total{{{labels}}} {s.count}" for labels, s in stages]
+            lines.append(f"# TYPE {p}_errors_total counter")
+            lines += [f"{p}_errors_total{{{labels}}} {s.errors}" for labels, s in stages]
+            lines.append(f"# TYPE {p}_bytes_total counter")
+            for labels, s in stages:
+                lines.append(f'{p}_bytes_total{{{labels},direction="in"}} {s.bytes_in}')
+                lines.append(f'{p}_bytes_total{{{labels},direction="out"}} {s.bytes_out}')
+            lines.append(f"# TYPE {p}_in_flight gauge")
+            lines += [f"{p}_in_flight{{{labels}}} {s.in_flight}" for labels, s in stages]
+            lines.append(f"# TYPE {p}_request_seconds histogram")
+            for labels, s in stages:
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + (float('inf'),), s.buckets):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{p}_request_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{p}_request_seconds_sum{{{labels}}} {s.latency_sum}")
+                lines.append(f"{p}_request_seconds_count{{{labels}}} {s.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str) -> None:
+        """Atomically replace path with the current metrics (the collector never sees a partial file)."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_summary(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class ProgressLine:
+    """A single, self-overwriting progress line, redrawn at most every interval seconds."""
+
+    def __init__(self, metrics: 'Metrics', total: int = 0, interval: float = 1.0, stream=None):
+        self.metrics = metrics
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._last = time.monotonic()  # first drawn after one interval, once there is something to show
+        self._width = 0
+
+    def update(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        line = self.metrics.progress_line(self.total)
+        self.stream.write('\r' + line.ljust(self._width))
+        self.stream.flush()
+        self._width = len(line)
+
+    def close(self) -> None:
+        """Draw the final state and end the line."""
+        self.update(force=True)
+        self.stream.write('\n')
+        self.stream.flush()
+
+
+METRICS = Metrics()
+
+
+def tracked(stage: str, api: str = '', none_is_error: bool = False):
+    """Decorator tracking every call of a function in METRICS under (stage, api).
+
+    With none_is_error, a None result counts as an error, for functions that report
+    failures by returning None instead of raising.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.track(stage, api) as call:
+                result = fn(*args, **kwargs)
+                if none_is_error and result is None:
+                    call.fail()
+                return result
+        return wrapper
+    return decorator
+
+
+_exporter: Optional[threading.Thread] = None
+
+
+def start_export(metrics_dir: str, job: str, interval: float = 15.0, metrics: Metrics = METRICS) -> None:
+    """
+    Export metrics of this process to metrics_dir/<job>.prom every interval seconds, and write
+    the final textfile plus metrics_dir/<job>.summary.json at exit.
+    """
+    global _exporter
+    metrics.job = job
+    os.makedirs(metrics_dir, exist_ok=True)
+    textfile = os.path.join(metrics_dir, f"{job}.prom")
+    summary_file = os.path.join(metrics_dir, f"{job}.summary.json")
+
+    def export_loop():
+        while True:
+            time.sleep(interval)
+            metrics.write_textfile(textfile)
+
+    def export_final():
+        metrics.write_textfile(textfile)
+        metrics.write_summary(summary_file)
+        print(f"Metrics written to {textfile} and {summary_file}")
+
+    if _exporter is None:
+        _exporter = threading.Thread(target=export_loop, name='metrics-export', daemon=True)
+        _exporter.start()
+        atexit.register(export_final)
+
+
+def print_summary(metrics: Metrics = METRICS) -> None:
+    """Print one line per (stage, api) with counts, error rate, throughput and latency percentiles."""
+    for s in metrics.summary()['stages']:
+        name = f"{s['stage']}/{s['api']}" if s['api'] else s['stage']
+        print(f"{name}: {s['count']} done, {s['errors']} errors ({s['error_rate']:.1%}), {s['per_second']:.2f}/s, "
+              f"latency p50={s['latency_p50']:.2f}s p90={s['latency_p90']:.2f}s p99={s['latency_p99']:.2f}s, "
+              f"{s['bytes_in'] / 1e6:.1f} MB in, {s['bytes_out'] / 1e6:.1f} MB out")
@@ -0,0 +1,106 @@
+import heapq
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class ExternalSorter:
+    """
+    Stable sort of JSON records with bounded memory.
+
+    Records are buffered until spill_size is reached, then the sorted buffer is
+    written to a temporary run file. Iterating merges all runs lazily with
+    heapq.merge. With spill_size=0 nothing is spilled (plain in-memory sort).
+    """
+
+    def __init__(self, key: Callable[[Dict[str, Any]], Any], spill_size: int = 0, tmp_dir: Optional[str] = None):
+        self.key = key
+        self.spill_size = spill_size
+        self.tmp_dir = tmp_dir
+        self.count = 0
+        self._buffer: List[Tuple[Any, int, Dict[str, Any]]] = []
+        self._runs: List[str] = []
+
+    def add(self, record: Dict[str, Any]) -> None:
+        self._buffer.append((self.key(record), self.count, record))
+        self.count += 1
+        if self.spill_size > 0 and len(self._buffer) >= self.spill_size:
+            self._spill()
+
+    def _spill(self) -> None:
+        self._buffer.sort(key=lambda x: (x[0], x[1]))
+        fd, path = tempfile.mkstemp(prefix='sortrun-', suffix='.jsonl', dir=self.tmp_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for item in self._buffer:
+                json.dump(item, f, ensure_ascii=False)
+                f.write('\n')
+        self._runs.append(path)
+        self._buffer = []
+
+    @staticmethod
+    def _read_run(path: str) -> Iterator[Tuple[Any, int, Dict[str, Any]]]:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                key, seq, record = json.loads(line)
+                # JSON turns tuple keys into lists, which do not compare with the in-memory tuples
+                yield (tuple(key) if isinstance(key, list) else key), seq, record
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        self._buffer.sort(key=lambda x: (x[0], x[1]))
+        runs = [self._read_run(path) for path in self._runs] + [iter(self._buffer)]
+        try:
+            for _, _, record in heapq.merge(*runs, key=lambda x: (x[0], x[1])):
+                yield record
+        finally:
+            self.cleanup()
+
+    def cleanup(self) -> None:
+        for path in self._runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self._runs = []
+
+
+class TopK:
+    """Keep the k records with the smallest key using a bounded heap (ties keep input order)."""
+
+    def __init__(self, k: int, key: Callable[[Dict[str, Any]], Any]):
+        self.k = k
+        self.key = key
+        self.count = 0
+        self._heap: List[Tuple[Any, int, Dict[str, Any]]] = []  # max-heap via negated key
+
+    def add(self, record: Dict[str, Any]) -> None:
+        item = (-self.key(record), -self.count, record)
+        self.count += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, item)
+
+    def sorted(self) -> List[Dict[str, Any]]:
+        return [record for _, _, record in sorted(self._heap, key=lambda x: (-x[0], -x[1]))]
+
+
+class Histogram:
+    """Fixed-width histogram of values in [0, 1]."""
+
+    def __init__(self, bins: int = 10):
+        self.bins = bins
+        self.counts = [0] * bins
+
+    def add(self, value: float) -> None:
+        idx = min(int(value * self.bins), self.bins - 1)
+        self.counts[max(idx, 0)] += 1
+
+    def as_dict(self) -> Dict[str, int]:
+        return {f"{i / self.bins:.2f}-{(i + 1) / self.bins:.2f}": c for i, c in enumerate(self.counts)}
+
+    def print(self, title: str = '') -> None:
+        total = sum(self.counts) or 1
+        if title:
+            print(title)
+        for label, count in self.as_dict().items():
+            bar = '#' * int(50 * count / total)
+            print(f"  {label}  {count:8d}  {bar}")
@@ -0,0 +1,69 @@
+import re
+from functools import lru_cache
+from typing import FrozenSet, NamedTuple, Tuple
+
+# Punctuation removed by clean_text (mapped to a space, like the old re.sub).
+_CLEAN_TABLE = str.maketrans({c: ' ' for c in '.,!?;:"\'’-'})
+
+# Typographic characters replaced by purify_reference.
+_PURIFY_TABLE = str.maketrans({
+    '“': '"', '”': '"',
+    '’': "'", '‘': "'",
+    '…': '...',
+    '–': '-', '—': '-',
+})
+
+# Characters allowed in a TTS/ASR reference text.
+INVALID_REFERENCE_RE = re.compile(r'[^?&\'\\–—.!;:a-zA-Z0-9"{},: _-]+')
+
+# Sentence endings followed by space or end of string.
+SENTENCE_END_RE = re.compile(r'([.!?](?:\s|$))')
+
+# Clause boundaries inside a sentence: after , ; : or an ellipsis, or before a dash.
+CLAUSE_BREAK_RE = re.compile(r'(?<=[,;:])\s+|(?<=\.\.\.)\s+|\s+(?=[-–—]\s)')
+
+# Space before punctuation left over from joining ASR word lists.
+_SPACE_BEFORE_PUNCT_RE = re.compile(r" ([,.?!';:])")
+
+
+class NormalizedText(NamedTuple):
+    """All derived text features, computed once per distinct string."""
+    clean: str  # lowercased, punctuation removed, single spaces
+    words: Tuple[str, ...]  # clean.split()
+    chars: str  # clean without spaces
+    word_set: FrozenSet[str]
+    bigrams: FrozenSet[str]  # character bigrams of chars
+
+
+def clean_text(text: str) -> str:
+    """Remove punctuation and extra spaces from text."""
+    return ' '.join(text.translate(_CLEAN_TABLE).split()).lower()
+
+
+@lru_cache(maxsize=65536)
+def normalize(text: str) -> NormalizedText:
+    """Normalize text and derive words, characters and bigrams in a single pass.
+
+    Results are memoized, so the ASR and reference sides of a comparison (and
+    repeated sentences) are only normalized once.
+    """
+    clean = clean_text(text)
+    words = tuple(clean.split())
+    chars = ''.join(words)
+    return NormalizedText(
+        clean=clean,
+        words=words,
+        chars=chars,
+        word_set=frozenset(words),
+        bigrams=frozenset(chars[i:i+2] for i in range(len(chars)-1)),
+    )
+
+
+def purify_text(text: str) -> str:
+    """Replace smart quotes, ellipsis characters, dashes and literal '\\n' with plain ASCII."""
+    return text.translate(_PURIFY_TABLE).replace('\\n', ' ')
+
+
+def attach_punctuation(sentence: str) -> str:
+    """Remove the space before punctuation, e.g. "hi , there ." -> "hi, there."."""
+    return _SPACE_BEFORE_PUNCT_RE.sub(r'\1', sentence)
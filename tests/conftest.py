@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The scripts in chirp3_client import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chirp3_client'))
+
+
+@pytest.fixture(scope='session')
+def fake_google(tmp_path_factory):
+    """The fake Google TTS/Speech/GCS services of fake_google.py, without latency, installed for the session."""
+    import fake_google
+    from llm_stub_server import StubConfig
+    import quota_governor
+    fast = StubConfig('fixed', 0.0, 0.0)
+    fake = fake_google.install(tts=fast, speech=fast, gcs=fast)
+    quota_governor._governor = quota_governor.QuotaGovernor({}, str(tmp_path_factory.mktemp('quota')))
+    return fake
@@ -0,0 +1,200 @@
+import asyncio
+import json
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+import aimd
+from aimd import AIMDLimiter, imap_limited, is_overload, is_overload_message, limiter_or_none, maybe_slot
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(aimd.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def round_trip(limiter, clock, latency=1.0, ok=True, overload=False, in_flight=None):
+    """
+    One round trip of a client with a backlog: every request in flight (all slots, if not
+    given) finishes after latency seconds, and each freed slot is taken again at once.
+    Returns the requests now in flight.
+    """
+    if in_flight is None:
+        in_flight = [limiter.acquire() for _ in range(limiter.limit)]
+    clock.now += latency
+    sent = []
+    for started in in_flight:
+        limiter.release(started, ok=ok, overload=overload)
+        while limiter.in_flight < limiter.limit:
+            sent.append(limiter.acquire())
+    return sent
+
+
+def test_is_overload():
+    assert is_overload(ResourceExhausted())
+    assert is_overload(HTTPError(429)) and is_overload(HTTPError(503))
+    assert not is_overload(HTTPError(404))
+    assert not is_overload(ValueError('bad input'))
+
+
+@pytest.mark.parametrize('text', [
+    'ERROR: Failed after 3 attempts: 429 Quota exceeded for speech recognize',
+    'ERROR: Failed after 3 attempts: 503 speech recognize is currently unavailable',
+    'Error code: 429 - Too Many Requests',
+    'HTTP 503 Service Unavailable.',
+    'openai.RateLimitError: slow down',
+    'ResourceExhausted: try later',
+])
+def test_overload_messages(text):
+    assert is_overload_message(text)
+
+
+@pytest.mark.parametrize('text', [
+    'ERROR: Failed after 3 attempts: No such file: vc_01429.wav',
+    'ERROR: Failed after 3 attempts: 400 Sync input too long (3429 s)',
+    'ERROR: Failed after 3 attempts: 404 No such object: bucket/chrp0503.wav',
+    'ERROR: Failed after 3 attempts: Read only 429 bytes of the WAV header',
+    'ERROR: Failed after 3 attempts: quota.json is not valid JSON',
+    'ERROR: rate limit file 429.txt',
+])
+def test_other_messages_are_not_overload(text):
+    assert not is_overload_message(text)
+
+
+def test_slow_start_doubles_per_round_trip(clock):
+    limiter = AIMDLimiter('tts', max_limit=64, latency_tolerance=0, verbose=False)
+    limits = []
+    in_flight = None
+    for _ in range(7):
+        in_flight = round_trip(limiter, clock, in_flight=in_flight)
+        limits.append(limiter.limit)
+    assert limits == [2, 4, 8, 16, 32, 64, 64]  # capped at max_limit
+
+
+def test_overload_cuts_once_per_round_trip_then_grows_additively(clock):
+    limiter = AIMDLimiter('asr', max_limit=64, initial=16, latency_tolerance=0, verbose=False)
+    started = [limiter.acquire() for _ in range(16)]
+    clock.now += 1
+    for s in started[:4]:
+        limiter.release(s, ok=False, overload=True)
+    assert limiter.limit == 8  # the other failures were sent before the cut
+    assert limiter.overloads == 4
+    for s in started[4:]:
+        limiter.release(s)
+    assert limiter.limit == 8 and not limiter.slow_start
+    in_flight = round_trip(limiter, clock)
+    assert limiter.limit == 9  # about one per round trip after the first cut
+    in_flight = round_trip(limiter, clock, in_flight=in_flight)
+    assert limiter.limit == 10
+    round_trip(limiter, clock, ok=False, overload=True, in_flight=in_flight)
+    assert limiter.limit == 5
+
+
+def test_other_errors_do_not_change_the_limit(clock):
+    limiter = AIMDLimiter('asr', max_limit=8, initial=4, verbose=False)
+    round_trip(limiter, clock, ok=False)
+    assert limiter.limit == 4
+
+
+def test_limit_only_grows_while_used(clock):
+    limiter = AIMDLimiter('asr', max_limit=8, initial=4, latency_tolerance=0, verbose=False)
+    for _ in range(10):
+        started = limiter.acquire()
+        clock.now += 1
+        limiter.release(started)
+    assert limiter.limit == 4
+
+
+def test_latency_rise_cuts_the_limit(clock):
+    limiter = AIMDLimiter('asr', max_limit=64, initial=2, latency_tolerance=2.0, latency_alpha=1.0, verbose=False)
+    in_flight = round_trip(limiter, clock, latency=1.0)
+    in_flight = round_trip(limiter, clock, latency=1.0, in_flight=in_flight)
+    assert limiter.limit == 8
+    in_flight = round_trip(limiter, clock, latency=3.0, in_flight=in_flight)
+    assert limiter.latency_cuts == 1  # once, although every request of the round trip was slow
+    assert limiter.limit < 8 and not limiter.slow_start
+    limit = limiter.limit
+    round_trip(limiter, clock, latency=3.0, in_flight=in_flight)  # the new reference: no further cut
+    assert limiter.latency_cuts == 1 and limiter.limit >= limit
+
+
+def test_slot_releases_on_error_and_logs_changes(tmp_path, clock):
+    log = tmp_path / 'aimd.jsonl'
+    limiter = AIMDLimiter('tts', max_limit=4, initial=2, log_path=str(log), verbose=False)
+    with pytest.raises(ResourceExhausted):
+        with limiter.slot():
+            clock.now += 1
+            raise ResourceExhausted()
+    assert limiter.in_flight == 0 and limiter.limit == 1
+    limiter.close()
+    entries = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [(e['limit'], e['reason']) for e in entries] == [(2, 'start'), (1, 'ResourceExhausted')]
+    assert limiter.summary()['min_seen'] == 1 and limiter.summary()['max_seen'] == 2
+
+
+def test_aslot_limits_concurrency():
+    limiter = AIMDLimiter('llm', max_limit=3, initial=3, latency_tolerance=0, verbose=False)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.aslot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(20)))
+
+    asyncio.run(main())
+    assert peak == 3 and limiter.in_flight == 0 and limiter.successes == 20
+
+
+def test_fixed_concurrency_without_limiter():
+    assert limiter_or_none(False, 'tts', 8) is None
+    with maybe_slot(None):
+        pass
+    assert limiter_or_none(True, 'tts', 8).max_limit == 8
+
+
+def test_imap_limited_returns_every_result():
+    limiter = AIMDLimiter('asr', max_limit=4, verbose=False)
+    with ThreadPool(4) as pool:
+        results = list(imap_limited(pool, lambda x: x * x, list(range(30)), limiter, lambda r: (True, False)))
+    assert sorted(results) == [x * x for x in range(30)]
+    assert limiter.in_flight == 0 and limiter.successes == 30 and limiter.limit == 4
+
+
+def test_imap_limited_reports_overload_results_and_raises_errors():
+    limiter = AIMDLimiter('asr', max_limit=4, initial=4, verbose=False)
+
+    def work(x):
+        if x == 3:
+            raise ValueError('broken input')
+        return 'ERROR: 429 Quota exceeded' if x == 0 else 'ok'
+
+    with ThreadPool(2) as pool:
+        results = imap_limited(pool, work, [0, 1, 2, 3, 4], limiter,
+                               lambda r: (not r.startswith('ERROR:'), is_overload_message(r)))
+        with pytest.raises(ValueError):
+            list(results)
+    assert limiter.overloads == 1
@@ -0,0 +1,56 @@
+"""End-to-end throughput and tail latency of the cloud batch scripts against the fake Google services.
+
+bench_cloud.py runs in a subprocess, so its fakes (installed at import of the scripts) and
+worker pools do not mix with the fakes of the other tests.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chirp3_client', 'bench_cloud.py')
+NUM_FILES = 16
+LATENCY = 0.1  # seconds per fake TTS / Speech call
+
+
+@pytest.fixture(scope='module')
+def results(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp('bench')
+    json_out = work_dir / 'results.json'
+    ms = str(LATENCY * 1000)
+    subprocess.run([sys.executable, BENCH, '--scripts', 'tts,asr,diarization,asr_parallel,pipeline',
+                    '--num-files', str(NUM_FILES), '--rounds', '1', '--workers', '4', '--latency', 'fixed',
+                    '--tts-latency-ms', ms, '--speech-latency-ms', ms, '--gcs-latency-ms', '5',
+                    '--history', '', '--json-out', str(json_out)],
+                   check=True, cwd=str(work_dir), stdout=subprocess.DEVNULL, timeout=300)
+    with open(json_out) as f:
+        return {r['script']: r for r in json.load(f)}
+
+
+def test_every_script_ran(results):
+    assert set(results) == {'tts', 'asr', 'diarization', 'asr_parallel', 'pipeline'}
+
+
+@pytest.mark.parametrize('script', ['tts', 'asr', 'diarization', 'asr_parallel'])
+def test_all_files_processed(results, script):
+    assert results[script]['files'] == NUM_FILES
+
+
+def test_pipeline_checks_every_sentence(results):
+    assert results['pipeline']['files'] == NUM_FILES
+
+
+@pytest.mark.parametrize('script', ['tts', 'asr', 'diarization'])
+def test_sequential_scripts_keep_up_with_the_api(results, script):
+    # One call (plus GCS upload / delete for ASR) per file, one file at a time
+    assert results[script]['files_per_sec'] > 0.3 / LATENCY
+    assert results[script]['p99'] < 5 * LATENCY
+
+
+def test_parallel_scripts_scale_with_workers(results):
+    assert results['asr_parallel']['files_per_sec'] > 2 * results['asr']['files_per_sec']
+    assert results['pipeline']['files_per_sec'] > 1.5 * results['tts']['files_per_sec']
+    assert results['asr_parallel']['p99'] < 5 * LATENCY
+    assert results['pipeline']['p99'] < 5 * LATENCY
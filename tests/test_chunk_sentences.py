@@ -0,0 +1,77 @@
+import pytest
+
+import chunk_sentences
+from chunk_sentences import byte_ranges, chunk_sentences as run_chunk_sentences
+
+PARAGRAPHS = [
+    "Food:\tI went to the market. It was fun! Did you see the apples? I went to the market.",
+    "invalid line without a tab",
+    "",
+    "Travel:\tTrains are late again. Trains are late again. The station was crowded and loud.",
+]
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    path = tmp_path / 'in.txt'
+    path.write_text('\n'.join(PARAGRAPHS * 20) + '\n', encoding='utf-8')
+    return path
+
+
+def test_byte_ranges_cover_file_at_line_boundaries(input_file):
+    data = input_file.read_bytes()
+    ranges = byte_ranges(str(input_file), 100)
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start and data[end - 1:end] == b'\n'
+
+
+def test_parallel_output_matches_serial(input_file, tmp_path, monkeypatch):
+    serial, parallel = tmp_path / 'serial.txt', tmp_path / 'parallel.txt'
+    run_chunk_sentences(str(input_file), str(serial), keep_topic=True)
+    # Several shards, so order across workers matters
+    monkeypatch.setattr(chunk_sentences, 'byte_ranges', lambda path, _: byte_ranges(path, 200))
+    run_chunk_sentences(str(input_file), str(parallel), keep_topic=True, num_workers=2)
+    assert parallel.read_text(encoding='utf-8') == serial.read_text(encoding='utf-8')
+    assert serial.read_text(encoding='utf-8').splitlines() == [
+        "Food\tI went to the market.", "Food\tIt was fun!", "Food\tDid you see the apples?",
+        "Travel\tTrains are late again.", "Travel\tThe station was crowded and loud."]
+
+
+def test_parallel_workers_report_invalid_lines(input_file, tmp_path, capfd):
+    run_chunk_sentences(str(input_file), str(tmp_path / 'out.txt'), verbose=True, num_workers=2)
+    assert capfd.readouterr().out.count("Skipping invalid line: invalid line without a tab") == 20
+
+
+def test_parallel_error_stops_workers(input_file, tmp_path, monkeypatch):
+    pools = []
+    real_pool = chunk_sentences.Pool
+
+    def tracked_pool(*args, **kwargs):
+        pools.append(real_pool(*args, **kwargs))
+        return pools[-1]
+
+    monkeypatch.setattr(chunk_sentences, 'Pool', tracked_pool)
+    monkeypatch.setattr(chunk_sentences.SeenSentences, 'add', lambda self, sent: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        run_chunk_sentences(str(input_file), str(tmp_path / 'out.txt'), num_workers=2)
+    assert all(not process.is_alive() for process in pools[0]._pool)
+
+
+def test_duration_histogram_keeps_counts_only(capsys):
+    histogram = chunk_sentences.DurationHistogram()
+    for duration in [0.5, 1.2, 1.9, 3.0]:
+        histogram.add(duration, 10)
+    assert histogram.buckets == {0: 1, 1: 2, 3: 1}
+    assert (histogram.count, histogram.total_chars) == (4, 40)
+    assert histogram.total == pytest.approx(6.6)
+    histogram.print()
+    out = capsys.readouterr().out
+    assert "2-3          0" in out
+    assert "4 sentences, 40 characters" in out and "mean 1.6s" in out
+
+
+def test_histogram_printed_when_packing(input_file, tmp_path, capsys):
+    run_chunk_sentences(str(input_file), str(tmp_path / 'out.txt'), min_duration=2, max_duration=8)
+    written = len((tmp_path / 'out.txt').read_text(encoding='utf-8').splitlines())
+    assert f"{written} sentences" in capsys.readouterr().out
@@ -0,0 +1,46 @@
+import io
+import wave
+
+import pytest
+
+
+def wav_bytes(seconds, rate=24000):
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b'\x00\x00' * int(seconds * rate))
+    return buf.getvalue()
+
+
+@pytest.fixture
+def asr(fake_google):
+    import run_cloud_asr_batch_1speaker
+    return run_cloud_asr_batch_1speaker
+
+
+def test_short_clip_is_sent_inline(asr, fake_google):
+    text = asr.recognize_bytes(wav_bytes(2), name='short.wav')
+    assert text
+    assert not any(fake_google.buckets.values())
+
+
+def test_long_clip_blob_is_deleted_after_recognition(asr, fake_google):
+    text = asr.recognize_bytes(wav_bytes(70), name='long.wav')
+    assert text
+    assert not any(fake_google.buckets.values())
+
+
+def test_long_clip_blob_is_deleted_when_recognition_fails(asr, fake_google, monkeypatch):
+    import fake_google as fakes
+
+    def fail(config=None, audio=None, **kwargs):
+        raise fakes.ServiceUnavailable('speech is currently unavailable')
+
+    monkeypatch.setattr(fake_google, 'long_running_recognize', fail)
+    assert asr.recognize_bytes(wav_bytes(70), name='failed.wav') is None
+    assert not any(fake_google.buckets.values())
+    with pytest.raises(fakes.ServiceUnavailable):
+        asr.recognize_bytes(wav_bytes(70), name='raised.wav', raise_errors=True)
+    assert not any(fake_google.buckets.values())
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from batch_compare_asr_ref import _align_ops, edit_distance_stats, error_rate
+
+
+def full_table_ops(ref, hyp):
+    """Reference alignment: full O(n * m) Levenshtein table, backtracked with the same preferences as _align_ops."""
+    n, m = len(ref), len(hyp)
+    table = [[0] * (m + 1) for _ in range(n + 1)]
+    for i in range(n + 1):
+        for j in range(m + 1):
+            if i == 0 or j == 0:
+                table[i][j] = i + j
+            else:
+                table[i][j] = min(table[i - 1][j - 1] + (ref[i - 1] != hyp[j - 1]),
+                                  table[i - 1][j] + 1, table[i][j - 1] + 1)
+    ops = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        cur = table[i][j]
+        if j > 0 and table[i][j - 1] + 1 == cur:
+            ops.append('I')
+            j -= 1
+        elif i > 0 and j > 0 and table[i - 1][j - 1] + (ref[i - 1] != hyp[j - 1]) == cur:
+            ops.append('=' if ref[i - 1] == hyp[j - 1] else 'S')
+            i -= 1
+            j -= 1
+        else:
+            ops.append('D')
+            i -= 1
+    ops.reverse()
+    return ops, table[n][m]
+
+
+def random_pairs(seed, count=300, max_len=40, alphabet='abcd'):
+    rng = random.Random(seed)
+    for _ in range(count):
+        ref = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+        if rng.random() < 0.5:
+            # A noisy copy, the common ASR case
+            hyp = list(ref)
+            for _ in range(rng.randint(0, 6)):
+                pos = rng.randint(0, len(hyp))
+                action = rng.choice('sdi')
+                if action == 'i':
+                    hyp.insert(pos, rng.choice(alphabet))
+                elif hyp and pos < len(hyp):
+                    if action == 's':
+                        hyp[pos] = rng.choice(alphabet)
+                    else:
+                        del hyp[pos]
+            hyp = ''.join(hyp)
+        else:
+            hyp = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+        yield ref, hyp
+
+
+EDGE_CASES = [
+    ('', ''),
+    ('', 'abc'),
+    ('abc', ''),
+    ('abc', 'abc'),
+    ('abcdef', 'abcxyz'),        # only a prefix in common
+    ('xyzdef', 'abcdef'),        # only a suffix in common
+    ('abcdef', 'abcdefghij'),    # trailing insertions
+    ('a' * 30, 'b' * 30),        # distance above the initial band
+    ('ab' * 20, 'ba' * 25),      # band must grow and lengths differ
+    ('abcdefghijklmnopqrstuvwxyz', 'zyxwvutsrqponmlkjihgfedcba'),
+]
+
+
+@pytest.mark.parametrize('ref,hyp', EDGE_CASES)
+def test_align_ops_matches_full_table_edge_cases(ref, hyp):
+    assert _align_ops(ref, hyp) == full_table_ops(ref, hyp)[0]
+
+
+def test_align_ops_matches_full_table_random():
+    for ref, hyp in random_pairs(seed=1):
+        assert _align_ops(ref, hyp) == full_table_ops(ref, hyp)[0], (ref, hyp)
+
+
+@pytest.mark.parametrize('ref,hyp', EDGE_CASES + list(random_pairs(seed=2, count=200)))
+def test_edit_distance_stats_matches_full_table(ref, hyp):
+    stats = edit_distance_stats(ref, hyp)
+    _, distance = full_table_ops(ref, hyp)
+    assert stats['sub'] + stats['del'] + stats['ins'] == distance
+    assert stats['ref_len'] - stats['del'] + stats['ins'] == len(hyp)
+    assert stats['ref_len'] == len(ref)
+
+
+def test_edit_distance_stats_on_words():
+    ref = 'the cat sat on the mat'.split()
+    hyp = 'the cat sat on a mat thank you'.split()
+    stats = edit_distance_stats(ref, hyp)
+    assert stats == {'sub': 1, 'del': 0, 'ins': 2, 'trailing_ins': 2, 'ref_len': 6}
+    assert error_rate(stats) == pytest.approx(3 / 6)
+
+
+def test_error_rate_of_empty_reference():
+    assert error_rate(edit_distance_stats([], [])) == 0.0
+    assert error_rate(edit_distance_stats([], ['uh'])) == 1.0
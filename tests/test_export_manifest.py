@@ -0,0 +1,75 @@
+import json
+import wave
+
+import pytest
+
+from export_manifest import AUDIO_BLOB_SUFFIX, PackedAudio, export, manifest_format
+
+
+def write_wav(path, num_frames, rate=24000):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(bytes(range(256)) * (num_frames * 2 // 256) + b'\0' * (num_frames * 2 % 256))
+
+
+@pytest.fixture
+def clips(tmp_path):
+    wav_dir = tmp_path / 'wavs'
+    wav_dir.mkdir()
+    records = []
+    for i, frames in enumerate([24000, 12000, 0, 6000]):
+        name = f'chrp{i:04d}.wav'
+        write_wav(wav_dir / name, frames)
+        records.append({'filename': name, 'reference_text': f'text {i}', 'sim_char': 0.9, 'sim_word': 0.8})
+    (wav_dir / 'chrp0004.wav').write_bytes(b'')  # empty
+    (wav_dir / 'chrp0005.wav').write_bytes((wav_dir / 'chrp0000.wav').read_bytes()[:30])  # truncated header
+    for i in (4, 5):
+        records.append({'filename': f'chrp{i:04d}.wav', 'reference_text': 'bad', 'sim_char': 0.9, 'sim_word': 0.8})
+    records.append({'filename': 'chrp0006.wav', 'reference_text': 'low', 'sim_char': 0.1, 'sim_word': 0.1})
+    jsonl = tmp_path / 'compare.jsonl'
+    jsonl.write_text(''.join(json.dumps(r) + '\n' for r in records), encoding='utf-8')
+    return jsonl, wav_dir
+
+
+def read_rows(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_unreadable_clips_are_skipped(tmp_path, clips, capsys):
+    jsonl, wav_dir = clips
+    output = tmp_path / 'manifest.jsonl'
+    export(str(jsonl), str(wav_dir), str(output), num_workers=2)
+    rows = read_rows(output)
+    assert [row['id'] for row in rows] == ['chrp0000', 'chrp0001', 'chrp0002', 'chrp0003']
+    assert [row['duration'] for row in rows] == [1.0, 0.5, 0.0, 0.25]
+    assert rows[0]['path'] == 'wavs/chrp0000.wav' and rows[0]['text'] == 'text 0'
+    assert "Skipped 2 unreadable WAV files" in capsys.readouterr().out
+
+
+def test_packed_audio_round_trip(tmp_path, clips):
+    jsonl, wav_dir = clips
+    output = tmp_path / 'manifest.jsonl'
+    export(str(jsonl), str(wav_dir), str(output), pack_audio=True, num_workers=1)
+    blob = PackedAudio(str(output) + AUDIO_BLOB_SUFFIX)
+    for row in read_rows(output):
+        assert row['path'] == ''
+        with wave.open(str(wav_dir / f"{row['id']}.wav"), 'rb') as w:
+            assert bytes(blob.get(row['audio_offset'], row['audio_bytes'])) == w.readframes(w.getnframes())
+    blob.close()
+
+
+def test_manifest_format():
+    assert manifest_format('m.parquet') == 'parquet'
+    assert manifest_format('m.feather') == 'arrow'
+    assert manifest_format('m.json') == 'jsonl'
+
+
+def test_parquet_manifest(tmp_path, clips):
+    pq = pytest.importorskip('pyarrow.parquet')
+    jsonl, wav_dir = clips
+    output = tmp_path / 'manifest.parquet'
+    export(str(jsonl), str(wav_dir), str(output))
+    assert pq.read_table(str(output)).column('id').to_pylist() == ['chrp0000', 'chrp0001', 'chrp0002', 'chrp0003']
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import organize_filtered_wavs_txts
+from organize_filtered_wavs_txts import FilePlacer
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'src.wav'
+    path.write_bytes(b'RIFF original audio')
+    return path
+
+
+def test_auto_gives_an_independent_file(tmp_path, source):
+    placer = FilePlacer('auto')
+    placer.place(str(source), str(tmp_path / 'dst.wav'))
+    placer.close()
+    assert not os.path.samefile(source, tmp_path / 'dst.wav')
+    assert set(placer.counts) <= {'reflink', 'copy'}
+    with open(source, 'wb') as f:  # as run_chirp3_tts_batch rewrites its outputs
+        f.write(b'RIFF new audio')
+    assert (tmp_path / 'dst.wav').read_bytes() == b'RIFF original audio'
+
+
+def test_hardlink_only_when_asked(tmp_path, source):
+    placer = FilePlacer('hardlink')
+    placer.place(str(source), str(tmp_path / 'dst.wav'))
+    placer.close()
+    assert os.path.samefile(source, tmp_path / 'dst.wav')
+    assert placer.counts['hardlink'] == 1
+
+
+def test_rerun_skips_files_already_placed(tmp_path, source):
+    for expected_skips in (0, 1):
+        placer = FilePlacer('copy')
+        placer.place(str(source), str(tmp_path / 'dst.wav'))
+        placer.close()
+        assert placer.counts['skipped'] == expected_skips
+
+
+def test_dry_run_writes_nothing(tmp_path, source):
+    placer = FilePlacer('auto', dry_run=True)
+    placer.place(str(source), str(tmp_path / 'dst.wav'))
+    placer.close()
+    assert not (tmp_path / 'dst.wav').exists()
+    assert sum(placer.counts.values()) == 1
+
+
+@pytest.mark.parametrize('mode, method', [('auto', 'reflink or copy'), ('reflink', 'reflink or copy'),
+                                          ('hardlink', 'hardlink'), ('symlink', 'symlink'), ('copy', 'copy')])
+def test_dry_run_reports_the_method_tried(tmp_path, source, mode, method, monkeypatch, capsys):
+    placer = FilePlacer(mode, dry_run=True)
+    placer.place(str(source), str(tmp_path / 'out' / 'dst.wav'))
+    assert dict(placer.counts) == {method: 1}
+    placer.print_summary()
+    assert f"by {method} (" in capsys.readouterr().out
+    # Across devices only a symlink is not a copy
+    monkeypatch.setattr(organize_filtered_wavs_txts, '_device', lambda path: hash(os.path.dirname(path)))
+    placer.place(str(source), str(tmp_path / 'other' / 'dst.wav'))
+    across = 'symlink' if mode == 'symlink' else 'copy'
+    assert placer.counts[across] == (2 if across == method else 1)
+    placer.close()
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        FilePlacer('move')
@@ -0,0 +1,73 @@
+import pytest
+
+from llm_cache import LLMCache, completion_cost, model_price
+
+MESSAGES = [{'role': 'user', 'content': 'Rewrite this.'}]
+RESPONSE = {'choices': [{'message': {'content': 'Rewritten.'}}],
+            'usage': {'prompt_tokens': 1000, 'completion_tokens': 500, 'total_tokens': 1500}}
+
+
+def key(sample_index=0, model='gpt-4o-mini'):
+    return LLMCache.key(model, 'https://api.openai.com/v1', MESSAGES, 0.7, sample_index)
+
+
+def test_round_trip_survives_reopen(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = LLMCache(path)
+    assert cache.get(key()) is None
+    cache.put(key(), 'gpt-4o-mini', RESPONSE)
+    cache.close()
+
+    cache = LLMCache(path)
+    assert cache.get(key()) == RESPONSE
+    assert cache.get(key(sample_index=1)) is None  # a resample is a different entry
+    assert (cache.hits, cache.misses, cache.saved_tokens) == (1, 1, 1500)
+    assert cache.saved_usd == pytest.approx(completion_cost('gpt-4o-mini', RESPONSE['usage']))
+    cache.close()
+
+
+def test_replay_mode_reads_but_never_writes(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    with_entry = LLMCache(path)
+    with_entry.put(key(), 'gpt-4o-mini', RESPONSE)
+    with_entry.close()
+
+    replay = LLMCache(path, mode='replay')
+    assert replay.replay
+    assert replay.get(key()) == RESPONSE
+    replay.put(key(1), 'gpt-4o-mini', RESPONSE)
+    assert replay.get(key(1)) is None
+    replay.close()
+
+
+def test_off_mode_is_a_no_op(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.sqlite'), mode='off')
+    cache.put(key(), 'gpt-4o-mini', RESPONSE)
+    assert cache.get(key()) is None
+    assert not (tmp_path / 'cache.sqlite').exists()
+
+
+def test_unknown_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        LLMCache(str(tmp_path / 'cache.sqlite'), mode='write')
+
+
+def test_eviction_drops_least_recently_used(tmp_path, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr('llm_cache.time.time', lambda: next(clock))
+    cache = LLMCache(str(tmp_path / 'cache.sqlite'), max_mb=0)
+    payload = {'choices': [{'message': {'content': 'x' * 1000}}]}
+    for i in range(5):
+        cache.put(key(i), 'gpt-4o-mini', payload)
+    cache.get(key(0))  # now the most recently used
+    entry_size = cache._conn.execute('SELECT size FROM responses LIMIT 1').fetchone()[0]
+    cache.max_bytes = entry_size * 5
+    cache.put(key(5), 'gpt-4o-mini', payload)
+    assert [i for i in range(6) if cache.get(key(i)) is not None] == [0, 3, 4, 5]
+    cache.close()
+
+
+def test_model_price_uses_longest_prefix():
+    assert model_price('gpt-4.1-mini-2025-04-14') == model_price('gpt-4.1-mini')
+    assert model_price('gpt-4.1-2025') == model_price('gpt-4.1')
+    assert completion_cost('unknown-model', RESPONSE['usage']) == 0.0
@@ -0,0 +1,50 @@
+import pytest
+
+from near_dedup import NearDuplicateFilter, choose_bands, filter_file
+
+SENTENCE = "So I went to the farmers market on Saturday morning and bought a whole basket of apples."
+
+
+def test_choose_bands_threshold_not_above_target():
+    for threshold in (0.5, 0.7, 0.8, 0.9):
+        bands, rows = choose_bands(threshold, 64)
+        assert bands * rows == 64
+        assert (1 / bands) ** (1 / rows) <= threshold
+
+
+def test_exact_and_near_duplicates_are_dropped():
+    dedup = NearDuplicateFilter(threshold=0.8)
+    assert not dedup.is_duplicate(SENTENCE)
+    assert dedup.is_duplicate(SENTENCE)
+    assert dedup.is_duplicate(SENTENCE.upper().replace(',', ''))  # same bigrams after cleaning
+    assert dedup.is_duplicate(SENTENCE.replace('Saturday', 'Sunday'))
+    assert not dedup.is_duplicate("The weather forecast says it will rain all week in the mountains.")
+    assert (dedup.kept, dedup.dropped) == (2, 3)
+
+
+def test_signatures_are_deterministic_per_seed():
+    a, b = NearDuplicateFilter(seed=7), NearDuplicateFilter(seed=7)
+    assert a.signature(SENTENCE) == b.signature(SENTENCE)
+    assert NearDuplicateFilter(seed=8).signature(SENTENCE) != a.signature(SENTENCE)
+
+
+def test_texts_without_bigrams_are_kept():
+    dedup = NearDuplicateFilter()
+    assert dedup.signature('a') is None
+    assert not dedup.is_duplicate('a')
+    assert not dedup.is_duplicate('a')
+
+
+def test_bands_must_divide_num_perm():
+    with pytest.raises(ValueError):
+        NearDuplicateFilter(num_perm=64, bands=5)
+
+
+def test_filter_file_keeps_first_occurrence(tmp_path):
+    src = tmp_path / 'in.txt'
+    src.write_text(f"Food\t{SENTENCE}\n\nTravel\tA completely different sentence about trains and stations.\n"
+                   f"Food\t{SENTENCE.replace('apples', 'pears')}\n", encoding='utf-8')
+    out = tmp_path / 'out.txt'
+    filter_file(str(src), str(out))
+    assert out.read_text(encoding='utf-8').splitlines() == [
+        f"Food\t{SENTENCE}", "Travel\tA completely different sentence about trains and stations."]
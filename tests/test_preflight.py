@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from batch_compare_asr_ref import SHORT_LINE_CHARS, is_kept, is_persona_reference, purify_reference, score_pair
+from preflight import TTS_USD_PER_MILLION_CHARS, Preflight, check_line, preflight
+
+LINES = [
+    "Honestly, I think the weather has been great this week.",
+    "It’s not what I “expected” — but it works… mostly.",
+    "We paid 50% more than last year for the same thing.",
+    "Hi there, my name is Alex and I host this show.",
+    "My name is Alex, and this line is capitalized.",
+    "Café au lait is what I ordered this morning.",
+    "Sure thing.",
+    "OK – fine.",
+    "a-b-c: {x}, \"y\"; z? & done!",
+]
+
+
+def compare_keeps(line, sim_char_of_short_lines=1.0):
+    """Whether batch_compare_asr_ref keeps the line's clip, given a transcript that matches the text sent to TTS."""
+    reference, is_valid = purify_reference(line.strip())
+    scores, _ = score_pair(reference, line.strip())
+    if is_valid and not is_persona_reference(reference) and len(reference.strip()) < SHORT_LINE_CHARS:
+        scores['sim_char'] = sim_char_of_short_lines  # short lines are judged on their (uncertain) ASR similarity
+    return is_kept(scores), scores['reference_text'].strip()
+
+
+@pytest.mark.parametrize('line', LINES)
+def test_preflight_agrees_with_the_comparison(line):
+    text, reason = check_line(line)
+    kept, reference = compare_keeps(line)
+    assert (text is not None) == kept, reason
+    if kept:
+        assert text == reference  # the text spoken is the reference it is compared against
+    # drop_short_lines drops what the comparison drops at a low similarity
+    text, reason = check_line(line, drop_short_lines=True)
+    kept, _ = compare_keeps(line, sim_char_of_short_lines=0.6)
+    assert (text is not None) == kept, reason
+
+
+def test_reasons():
+    reasons = [check_line(line)[1] for line in LINES]
+    assert reasons == ['ok', 'fixed', 'invalid_charset', 'my_name_is', 'ok', 'invalid_charset', 'short', 'short', 'ok']
+    assert check_line('   \n') == (None, 'empty')
+    assert check_line('Sure thing.', drop_short_lines=True) == (None, 'short_dropped')
+    text, reason = check_line("It’s “fine” — really… I promise.\n")
+    assert reason == 'fixed' and text == "It's \"fine\" - really... I promise."
+
+
+def test_saved_usd_scales_with_voices():
+    line = "Hi there, my name is Alex and I host this show."
+    one, three = Preflight(num_voices=1), Preflight(num_voices=3)
+    for checker in (one, three):
+        checker.check(line)
+        checker.check(LINES[0])  # kept: saves nothing
+    assert one.saved_chars == len(line)
+    assert three.saved_chars == 3 * len(line)
+    assert three.saved_seconds == pytest.approx(3 * one.saved_seconds)
+    assert one.saved_usd[0] == pytest.approx(len(line) * TTS_USD_PER_MILLION_CHARS / 1e6)
+    assert three.saved_usd == pytest.approx(tuple(3 * usd for usd in one.saved_usd))
+    assert one.reasons == {'my_name_is': 1, 'ok': 1}
+
+
+def test_preflight_file(tmp_path, capsys):
+    (tmp_path / 'in.txt').write_text(''.join(line + '\n' for line in LINES), encoding='utf-8')
+    preflight(str(tmp_path / 'in.txt'), str(tmp_path / 'out.txt'), rejected_file=str(tmp_path / 'rejected.jsonl'),
+              voices='Aoede,Kore')
+    kept = (tmp_path / 'out.txt').read_text(encoding='utf-8').splitlines()
+    assert kept == [check_line(line)[0] for line in LINES if check_line(line)[0] is not None]
+    rejected = [json.loads(line) for line in (tmp_path / 'rejected.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [(r['line'], r['reason']) for r in rejected] == [(2, 'invalid_charset'), (3, 'my_name_is'), (5, 'invalid_charset')]
+    assert 'over 2 voice(s)' in capsys.readouterr().out
@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+
+import profiling
+from stage_metrics import METRICS, Metrics
+
+calls = []
+
+
+def batch(input_file, output_dir, voices='Aoede'):
+    calls.append(('batch', input_file, output_dir, voices))
+
+
+def single(text):
+    calls.append(('single', text))
+
+
+@pytest.fixture(autouse=True)
+def script(monkeypatch, tmp_path):
+    calls.clear()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(profiling.sys, 'argv', ['run_chirp3_tts_batch.py'])
+
+
+@pytest.mark.parametrize('argv', [
+    ['--profile', 'batch', 'in.txt', 'out'],
+    ['batch', '--profile', 'in.txt', 'out'],
+    ['batch', 'in.txt', 'out', '--profile'],
+    ['--profile-dir', 'profile', 'batch', 'in.txt', '--voices', 'Kore', 'out'],
+    ['batch', '--profile-dir=profile', 'in.txt', 'out', '--profile-interval', '0.001'],
+])
+def test_profile_options_anywhere(argv, tmp_path):
+    profiling.dispatch_commands([batch, single], argv=argv)
+    assert calls[0][:3] == ('batch', 'in.txt', 'out')
+    assert os.path.exists(tmp_path / 'profile' / 'run_chirp3_tts_batch.batch.profile.txt')
+
+
+def test_split_profile_args():
+    options, rest = profiling.split_profile_args(['--profile', 'in.txt', 'out.txt'])
+    assert options.profile and options.profile_dir == 'profile' and rest == ['in.txt', 'out.txt']
+    options, rest = profiling.split_profile_args(['in.txt', '--profile-dir', 'p', 'out.txt'])
+    assert options.profile and options.profile_dir == 'p' and rest == ['in.txt', 'out.txt']
+    options, rest = profiling.split_profile_args(['single', 'hello'])
+    assert not options.profile and rest == ['single', 'hello']
+
+
+def test_without_profile_nothing_is_written(tmp_path):
+    profiling.dispatch_commands([batch, single], argv=['single', 'hello'])
+    assert calls == [('single', 'hello')]
+    assert not os.path.exists(tmp_path / 'profile')
+
+
+def test_dispatch_command_profile_named_after_function(tmp_path):
+    profiling.dispatch_command(single, argv=['--profile', 'hello'])
+    assert calls == [('single', 'hello')]
+    assert os.path.exists(tmp_path / 'profile' / 'single.profile.txt')
+
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+def test_sampled_run_writes_stacks_per_stage(tmp_path):
+    metrics = Metrics()
+    with profiling.Profiler(str(tmp_path), 'job', ('sample', 'cprofile'), interval=0.002, metrics=metrics) as profiler:
+        with metrics.track('work'):
+            busy(0.2)
+        busy(0.05)
+    assert profiler.sampler.samples > 10
+    lines = (tmp_path / 'job.collapsed').read_text(encoding='utf-8').splitlines()
+    assert lines
+    roots = {line.split(';')[0] for line in lines}
+    assert 'work' in roots and 'MainThread' in roots
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    assert any('test_profiling.busy' in line for line in lines if line.startswith('work;'))
+    # cProfile switched to the stage's profile inside track() and back to main outside it
+    assert (tmp_path / 'job.work.pstats').exists() and (tmp_path / 'job.main.pstats').exists()
+    assert 'work:' in (tmp_path / 'job.profile.txt').read_text(encoding='utf-8')
+    assert metrics.listeners == []
+
+
+def test_unknown_tool():
+    with pytest.raises(ValueError):
+        profiling.Profiler('p', 'job', ('perf',), metrics=METRICS)
@@ -0,0 +1,66 @@
+import json
+import time
+from multiprocessing.pool import ThreadPool
+
+import aimd
+import quota_governor
+from quota_governor import QuotaGovernor, load_quotas
+
+
+def test_no_limits_without_config(tmp_path):
+    assert load_quotas(str(tmp_path / 'quota.json')) == {}
+    governor = QuotaGovernor({}, str(tmp_path / 'state'))
+    assert governor.acquire('tts') == 0.0
+    assert not (tmp_path / 'state' / 'tts.json').exists()
+
+
+def test_config_file_sets_limits(tmp_path):
+    config = tmp_path / 'quota.json'
+    config.write_text(json.dumps({'tts': 500}))
+    assert load_quotas(str(config)) == {'tts': 500}
+
+
+def test_burst_then_wait(tmp_path):
+    governor = QuotaGovernor({'tts': 600}, str(tmp_path))  # 10/s, burst of 60
+    start = time.monotonic()
+    for _ in range(60):
+        assert governor.acquire('tts') < 0.05
+    assert time.monotonic() - start < 1.0
+    assert governor.acquire('tts') > 0.05
+    status = governor.status('tts')
+    assert status['rpm'] == 600
+    assert status['used_last_minute'] == 61
+    assert governor.acquire('speech') == 0.0  # not configured
+
+
+def test_state_is_shared_between_governors(tmp_path):
+    first = QuotaGovernor({'speech': 60}, str(tmp_path))  # burst of 6
+    second = QuotaGovernor({'speech': 60}, str(tmp_path))
+    for _ in range(3):
+        first.acquire('speech')
+        second.acquire('speech')
+    assert second.status('speech')['used_last_minute'] == 6
+    assert first.status('speech')['tokens'] < 1
+
+
+def test_status_without_quotas(tmp_path, capsys):
+    quota_governor.status(config_path=str(tmp_path / 'quota.json'), state_dir=str(tmp_path))
+    assert 'No quotas configured' in capsys.readouterr().out
+
+
+def test_quota_is_taken_before_the_slot():
+    limiter = aimd.AIMDLimiter('asr', max_limit=4, initial=2, verbose=False)
+    in_flight_at_quota = []
+
+    def take_quota():
+        in_flight_at_quota.append((limiter.in_flight, limiter.limit))
+        time.sleep(0.01)  # a quota wait
+
+    with ThreadPool(4) as pool:
+        results = list(aimd.imap_limited(pool, lambda x: x * 2, list(range(20)), limiter,
+                                         lambda r: (True, False), before_start=take_quota))
+    assert sorted(results) == [x * 2 for x in range(20)]
+    assert len(in_flight_at_quota) == 20
+    # The task waiting for its quota holds no slot yet, and one is free for it
+    assert all(in_flight < limit for in_flight, limit in in_flight_at_quota)
+    assert limiter.in_flight == 0
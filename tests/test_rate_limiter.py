@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+import rate_limiter
+from rate_limiter import RateScheduler, TokenBucket, _parse_duration, model_limits, scheduler_or_none
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_scheduler_is_opt_in():
+    assert scheduler_or_none('gpt-4.1-mini') is None
+    only_rpm = scheduler_or_none('gpt-4.1-mini', rpm=100)
+    assert (only_rpm.rpm, only_rpm.tpm) == (100, 0)  # the budget not given is unlimited
+    defaults = scheduler_or_none('gpt-4.1-mini', tpm=1000, use_model_defaults=True)
+    assert (defaults.rpm, defaults.tpm) == (model_limits('gpt-4.1-mini')[0], 1000)
+
+
+def test_model_limits_longest_prefix():
+    assert model_limits('gpt-4.1-mini-2025') == rate_limiter.MODEL_LIMITS['gpt-4.1-mini']
+    assert model_limits('qwen-plus') == rate_limiter.MODEL_LIMITS['qwen']
+    assert model_limits('unknown') == rate_limiter.DEFAULT_LIMITS
+
+
+def test_unlimited_bucket_never_waits(clock):
+    bucket = TokenBucket(0)
+    bucket.refill(clock.now + 5)
+    assert bucket.wait_time(10 ** 9) == 0.0
+
+
+def test_rpm_is_paced_after_the_burst(clock):
+    scheduler = RateScheduler('m', rpm=60, use_model_defaults=False, report_every=0)
+    start = clock.now
+    for _ in range(16):
+        scheduler.acquire(700)
+        scheduler.release()
+    # 6 seconds of burst, then one request per second
+    assert clock.now - start == pytest.approx(10.0)
+    assert scheduler.stats()['rpm_utilization'] == pytest.approx(16 / 60)
+    assert scheduler.stats()['tpm_utilization'] == 0.0
+
+
+def test_tpm_counts_prompt_and_completion_tokens(clock):
+    scheduler = RateScheduler('m', tpm=6000, use_model_defaults=False, report_every=0)
+    scheduler.acquire(300)
+    scheduler.release(completion_tokens=300)  # the 600-token burst is used up
+    start = clock.now
+    scheduler.acquire(100)
+    assert clock.now - start == pytest.approx(1.0)
+
+
+def test_rate_limit_headers_pause_sending(clock):
+    scheduler = RateScheduler('m', rpm=6000, use_model_defaults=False, report_every=0)
+    scheduler.acquire(10)
+    scheduler.release(headers={'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '2s'},
+                      rate_limited=True)
+    start = clock.now
+    scheduler.acquire(10)
+    assert clock.now - start >= 2.0
+    assert scheduler.stats()['rate_limited'] == 1
+
+
+def test_aacquire(clock, monkeypatch):
+    async def fake_sleep(seconds):
+        clock.sleep(seconds)
+
+    monkeypatch.setattr(rate_limiter.asyncio, 'sleep', fake_sleep)
+    scheduler = RateScheduler('m', rpm=60, use_model_defaults=False, report_every=0)
+
+    async def run():
+        for _ in range(8):
+            await scheduler.aacquire(1)
+            scheduler.release()
+
+    start = clock.now
+    asyncio.run(run())
+    assert clock.now - start == pytest.approx(2.0)
+
+
+def test_parse_duration():
+    assert _parse_duration('12') == 12.0
+    assert _parse_duration('6m0s') == 360.0
+    assert _parse_duration('250ms') == pytest.approx(0.25)
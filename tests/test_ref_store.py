@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+import batch_compare_asr_ref
+import ref_store
+from ref_store import RefStore, RefStoreWriter, build, build_from_manifest, export, ref_id_from_wav
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'refs.store')
+    texts = {'chrp0000': 'Hello world.\n', 'chrp0001': 'Ünïcödé – dashes…', 'chrp0002': ''}
+    with RefStoreWriter(path) as writer:
+        for item_id, text in texts.items():
+            writer.add(item_id, text)
+    with RefStore(path) as store:
+        assert len(store) == 3
+        assert dict(store.items()) == texts
+        assert 'chrp0001' in store
+        assert store.get('missing') is None
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / 'empty.store')
+    RefStoreWriter(path).close()
+    with RefStore(path) as store:
+        assert len(store) == 0
+        assert store.get('chrp0000') is None
+
+
+def test_build_export_round_trip(tmp_path):
+    textdir = tmp_path / 'txts'
+    textdir.mkdir()
+    for i in range(5):
+        (textdir / f'chrp{i:04d}.txt').write_text(f'line {i}\n', encoding='utf-8')
+    path = str(tmp_path / 'refs.store')
+    build(str(textdir), path)
+    export(path, str(tmp_path / 'out'))
+    for i in range(5):
+        assert (tmp_path / 'out' / f'chrp{i:04d}.txt').read_text(encoding='utf-8') == f'line {i}\n'
+
+
+def test_build_from_manifest_uses_tts_ids(tmp_path):
+    manifest = tmp_path / 'sentences.txt'
+    manifest.write_text('first\nsecond\n', encoding='utf-8')
+    path = str(tmp_path / 'refs.store')
+    build_from_manifest(str(manifest), path)
+    with RefStore(path) as store:
+        assert store.get(ref_id_from_wav('vc_chrp0001.wav')) == 'second\n'
+
+
+def test_process_comparison_closes_store(tmp_path, monkeypatch):
+    path = str(tmp_path / 'refs.store')
+    with RefStoreWriter(path) as writer:
+        writer.add('chrp0000', 'Hello world.')
+    asr_jsonl = tmp_path / 'asr.jsonl'
+    asr_jsonl.write_text(json.dumps({'filename': 'chrp0000.wav', 'text': 'Hello world.'}) + '\n'
+                         + '{not json\n', encoding='utf-8')
+    opened = []
+
+    class TrackedStore(RefStore):
+        def __init__(self, *args):
+            super().__init__(*args)
+            opened.append(self)
+
+    monkeypatch.setattr(batch_compare_asr_ref, 'RefStore', TrackedStore)
+    with pytest.raises(json.JSONDecodeError):
+        batch_compare_asr_ref.process_comparison(str(asr_jsonl), path, str(tmp_path / 'out.jsonl'))
+    assert len(opened) == 1 and opened[0]._file.closed
+
+
+def test_ids_follow_tts_naming():
+    assert ref_store.tts_item_id('chrp', 7, 4) == 'chrp0007'
+    assert ref_id_from_wav('vc_chrp0007.wav') == 'chrp0007'
@@ -0,0 +1,59 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+import rewrite_chatting_style
+from llm_cache import LLMCache
+from llm_tokens import estimate_tokens
+from rewrite_chatting_style import build_messages, print_summary, rewrite_items
+
+
+@pytest.fixture
+def api(monkeypatch):
+    sent = []
+
+    async def fake_completion(messages, model, temperature, **kwargs):
+        sent.append(messages)
+        content = messages[-1]['content']
+        if content.startswith('Rewrite the following paragraphs: ['):
+            contents = json.loads(content[len('Rewrite the following paragraphs: '):])
+            text = json.dumps([f'rewritten {c}' for c in contents])
+        else:
+            text = f'rewritten {content}'
+        return {'choices': [{'message': {'content': text}}]}
+
+    monkeypatch.setattr(rewrite_chatting_style, 'request_completion', fake_completion)
+    return sent
+
+
+def items(n):
+    return [(i, f'topic {i}', f'paragraph number {i} about something', f'line {i}') for i in range(n)]
+
+
+def run(cache, n=4, **kwargs):
+    fout = io.StringIO()
+    stats = asyncio.run(rewrite_items(items(n), fout, 'gpt-4.1-mini', 0.7, concurrency=2, cache=cache, **kwargs))
+    return stats, fout.getvalue().splitlines()
+
+
+@pytest.mark.parametrize('pack_size', [1, 2])
+def test_token_stats_count_only_paragraphs_sent(tmp_path, api, pack_size, capsys):
+    cache = LLMCache(str(tmp_path / 'cache.sqlite'))
+    stats, lines = run(cache, pack_size=pack_size)
+    assert len(lines) == 4 and lines[0].startswith('topic 0:\trewritten')
+    assert stats['sent_paragraphs'] == 4 and len(api) == 4 // pack_size
+    assert stats['single_prompt_tokens'] == sum(estimate_tokens(build_messages(item[2])) for item in items(4))
+    assert stats['sent_prompt_tokens'] == sum(estimate_tokens(messages) for messages in api)
+
+    # A warm cache for the first 4 paragraphs: only the 2 new ones are sent and counted
+    stats, lines = run(cache, n=6, pack_size=pack_size)
+    assert len(lines) == 6
+    assert stats['paragraphs'] == 6 and stats['sent_paragraphs'] == 2
+    assert stats['single_prompt_tokens'] == sum(estimate_tokens(build_messages(item[2])) for item in items(6)[4:])
+    stats['elapsed'] = 1.0
+    capsys.readouterr()
+    print_summary(stats)
+    assert 'sent to the API (2 of 6)' in capsys.readouterr().out
+    cache.close()
@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+import rewrite_paragraphs
+
+
+@pytest.fixture
+def job(tmp_path, monkeypatch):
+    (tmp_path / 'key.txt').write_text('sk-test')
+    (tmp_path / 'paragraphs.txt').write_text('a.txt\tSome seed paragraph.\n', encoding='utf-8')
+    (tmp_path / 'topics.txt').write_text(''.join(f'topic {i}\n' for i in range(20)), encoding='utf-8')
+    calls = []
+    lock = threading.Lock()
+
+    def fake_generate(this_topic, *args, **kwargs):
+        with lock:
+            calls.append(this_topic)
+        if this_topic == 'topic 3':
+            raise KeyboardInterrupt
+        return [f'{this_topic}:\tline']
+
+    monkeypatch.setattr(rewrite_paragraphs, 'generate_for_topic', fake_generate)
+
+    def run(**kwargs):
+        rewrite_paragraphs.rewrite_paragraphs(
+            str(tmp_path / 'paragraphs.txt'), str(tmp_path / 'out.txt'), candidate_topics=str(tmp_path / 'topics.txt'),
+            key_path=str(tmp_path / 'key.txt'), cache_mode='off', cache_path=str(tmp_path / 'cache.sqlite'), **kwargs)
+    return run, calls, tmp_path
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_interrupt_does_not_run_the_backlog(job, concurrency):
+    run, calls, tmp_path = job
+    with pytest.raises(KeyboardInterrupt):
+        run(concurrency=concurrency)
+    # topics 0-3, plus at most the window submitted while waiting for them
+    assert len(calls) <= 4 + concurrency
+    assert (tmp_path / 'out.txt').read_text(encoding='utf-8').splitlines() == [f'topic {i}:\tline' for i in range(3)]
+
+
+def test_all_topics_in_order(job):
+    run, calls, tmp_path = job
+    run(concurrency=4, limit=3)
+    assert (tmp_path / 'out.txt').read_text(encoding='utf-8').splitlines() == [f'topic {i}:\tline' for i in range(3)]
+    # resumed: nothing left to generate
+    run(concurrency=4, limit=3)
+    assert len(calls) == 3
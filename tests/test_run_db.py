@@ -0,0 +1,100 @@
+import json
+
+from batch_compare_asr_ref import is_kept
+from run_db import RunDB, export_jsonl, import_asr, import_tts, is_run_db, score
+
+
+def scores(reference_text, sim_char):
+    return {'reference_text': reference_text, 'sim_char': sim_char, 'sim_word': sim_char, 'wer': 1 - sim_char,
+            'cer': 1 - sim_char}
+
+
+def test_is_run_db():
+    assert is_run_db('run.db') and is_run_db('x/run.SQLITE3')
+    assert not is_run_db('compare.jsonl')
+
+
+def test_stages_round_trip_and_reopen(tmp_path):
+    path = str(tmp_path / 'run.db')
+    wav = str(tmp_path / 'wavs' / 'chrp0001.wav')
+    db = RunDB(path)
+    db.record_tts('chrp0001', 'Leda', 'hello there', wav)
+    db.record_tts('chrp0002', 'Leda', 'not synthesized', None, ok=False)
+    assert db.item_for_wav(wav) == ('chrp0001', 'Leda')
+    assert db.tts_done('Leda') == {'chrp0001': 'hello there'}
+    assert [row['item_id'] for row in db.pending_asr()] == ['chrp0001']
+    db.record_asr('chrp0001', 'Leda', 'hello there')
+    assert db.pending_asr() == []
+    assert [row['item_id'] for row in db.pending_scores()] == ['chrp0001']
+    db.record_scores('chrp0001', 'Leda', scores('hello there', 1.0), kept=True)
+    db.close()
+
+    # A later stage (or a resumed run) sees everything recorded so far
+    db = RunDB(path)
+    assert db.pending_scores() == []
+    assert db.counts() == {'items': 2, 'tts_done': 1, 'tts_failed': 1, 'asr_done': 1, 'asr_failed': 0,
+                           'scored': 1, 'kept': 1}
+    [(record, wav_path)] = list(db.selected())
+    assert wav_path == wav
+    assert record['filename'] == 'chrp0001.wav' and record['text'] == 'hello there' and record['voice'] == 'Leda'
+    assert record['sim_char'] == 1.0
+    db.close()
+
+
+def test_new_results_reset_later_stages(tmp_path):
+    db = RunDB(str(tmp_path / 'run.db'))
+    wav = str(tmp_path / 'chrp0001.wav')
+    db.record_tts('chrp0001', '', 'text', wav)
+    db.record_asr('chrp0001', '', 'text')
+    db.record_scores('chrp0001', '', scores('text', 0.9), kept=True)
+    db.record_asr('chrp0001', '', None, ok=False)
+    row = db.pending_asr()[0]  # failed transcripts are retried
+    assert row['sim_char'] is None and row['kept'] is None
+    db.record_asr('chrp0001', '', 'text')
+    db.record_scores('chrp0001', '', scores('text', 0.9), kept=True)
+    db.record_tts('chrp0001', '', 'text', wav)  # resynthesized
+    row = db.pending_asr()[0]
+    assert row['asr_text'] is None and row['sim_char'] is None
+    db.close()
+
+
+def test_select_matches_is_kept(tmp_path):
+    db = RunDB(str(tmp_path / 'run.db'))
+    cases = [('a long enough reference line', 0.55), ('short line', 0.55), ('short line', 0.75),
+             ('a long enough reference line', 0.45), ('no audio for this one', 0.99)]
+    for i, (reference, sim) in enumerate(cases):
+        db.record_tts(f'chrp{i:04d}', '', reference, None if i == 4 else str(tmp_path / f'chrp{i:04d}.wav'))
+        db.record_asr(f'chrp{i:04d}', '', reference)
+        db.record_scores(f'chrp{i:04d}', '', scores(reference, sim))
+    assert db.select() == 2
+    kept = [record['filename'] for record, _ in db.selected()]
+    expected = [f'chrp{i:04d}.wav' for i, (reference, sim) in enumerate(cases[:4])
+                if is_kept({'reference_text': reference, 'sim_char': sim})]
+    assert kept == expected == ['chrp0000.wav', 'chrp0002.wav']
+    assert db.select(min_char_sim=0.4, min_char_sim_for_short_lines=0.4) == 4
+    assert len(list(db.selected(min_similarity=0.7))) == 1
+    assert list(db.selected(wav_dir=str(tmp_path / 'elsewhere'))) == []
+    db.close()
+
+
+def test_import_score_export(tmp_path):
+    wav_dir = tmp_path / 'Leda'
+    wav_dir.mkdir()
+    for i, text in enumerate(['the first sentence here', 'the second sentence here']):
+        (wav_dir / f'vc_chrp{i:04d}.wav').write_bytes(b'')
+        (wav_dir / f'chrp{i:04d}.txt').write_text(text, encoding='utf-8')
+    (tmp_path / 'asr.jsonl').write_text(
+        json.dumps({'filename': 'vc_chrp0000.wav', 'text': 'the first sentence here'}) + '\n' +
+        json.dumps({'filename': 'vc_chrp0001.wav', 'text': 'ERROR: Failed after 3 attempts'}) + '\n' +
+        json.dumps({'filename': 'unknown.wav', 'text': 'x'}) + '\n', encoding='utf-8')
+    db_path = str(tmp_path / 'run.db')
+    import_tts(db_path, str(wav_dir), voice='Leda')
+    import_asr(db_path, str(tmp_path / 'asr.jsonl'), str(wav_dir))
+    score(db_path)
+    export_jsonl(db_path, str(tmp_path / 'selected.jsonl'))
+    records = [json.loads(line) for line in (tmp_path / 'selected.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [r['filename'] for r in records] == ['vc_chrp0000.wav']
+    assert records[0]['sim_char'] == 1.0
+    db = RunDB(db_path)
+    assert [row['item_id'] for row in db.pending_asr(str(wav_dir))] == ['chrp0001']
+    db.close()
@@ -0,0 +1,52 @@
+import json
+
+from run_journal import RunJournal, item_key
+
+
+def test_item_key_depends_on_index_and_content():
+    assert item_key(3, 'Food\tapples') == item_key(3, 'Food\tapples')
+    assert item_key(3, 'Food\tapples') != item_key(4, 'Food\tapples')
+    assert item_key(3, 'Food\tapples') != item_key(3, 'Food\tpears')
+
+
+def test_resume_skips_done_and_retries_failed(tmp_path):
+    path = str(tmp_path / 'out.txt.journal.jsonl')
+    journal = RunJournal(path)
+    assert not journal.resumed
+    journal.mark_done('0-a', lines=2)
+    journal.mark_failed('1-b', 'Food\tbad line')
+    journal.mark_done('2-c')
+    journal.write_retry_file(str(tmp_path / 'retry.txt'))
+    journal.close()
+    assert (tmp_path / 'retry.txt').read_text(encoding='utf-8') == 'Food\tbad line\n'
+
+    journal = RunJournal(path)
+    assert journal.resumed
+    assert [journal.is_done(k) for k in ('0-a', '1-b', '2-c', '3-d')] == [True, False, True, False]
+    journal.mark_done('1-b', lines=1)  # the retry succeeds: the last record wins
+    journal.close()
+    assert RunJournal(path).is_done('1-b')
+    with open(path, encoding='utf-8') as f:
+        assert json.loads(f.readline()) == {'key': '0-a', 'status': 'done', 'lines': 2}
+
+
+def test_fresh_starts_over(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = RunJournal(path)
+    journal.mark_done('0-a')
+    journal.close()
+    journal = RunJournal(path, fresh=True)
+    assert not journal.resumed and not journal.is_done('0-a')
+    journal.close()
+
+
+def test_torn_last_line_is_ignored_and_not_merged_with_new_records(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    path.write_text('{"key": "0-a", "status": "done"}\n{"key": "1-b", "sta', encoding='utf-8')
+    journal = RunJournal(str(path))
+    assert journal.is_done('0-a') and not journal.is_done('1-b')
+    journal.mark_done('1-b')
+    journal.close()
+    journal = RunJournal(str(path))
+    assert journal.is_done('0-a') and journal.is_done('1-b')
+    journal.close()
@@ -0,0 +1,165 @@
+import json
+import os
+import random
+import wave
+
+import pytest
+
+from export_manifest import AUDIO_BLOB_SUFFIX, PackedAudio, export
+from run_journal import RunJournal, item_key
+from sharding import in_shard, merge_dirs, merge_jsonl, merge_manifest, merge_text, parse_shard, shard_of
+
+
+def write_jsonl(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(r) + '\n' for r in records)
+
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_parse_shard():
+    assert parse_shard('') is None
+    assert parse_shard('1/4') == (1, 4)
+    for bad in ('4/4', '-1/2', '1', 'a/b', '0/0'):
+        with pytest.raises(ValueError):
+            parse_shard(bad)
+
+
+def test_every_item_is_in_exactly_one_shard():
+    ids = [f'chrp{i:04d}' for i in range(500)]
+    counts = [sum(in_shard(item_id, (i, 4)) for item_id in ids) for i in range(4)]
+    assert sum(counts) == len(ids)
+    assert min(counts) > 80  # roughly balanced
+    assert all(in_shard(item_id, None) for item_id in ids)
+    assert shard_of('chrp0001', 4) == shard_of('chrp0001', 4)
+
+
+@pytest.mark.parametrize('spill_size', [0, 3])
+def test_merge_jsonl_matches_single_node_order(tmp_path, spill_size):
+    rng = random.Random(0)
+    records = [{'filename': f'chrp{i:04d}.wav', 'sim_char': round(rng.random(), 3)} for i in range(40)]
+    shards = []
+    for i in range(3):
+        path = str(tmp_path / f'compare-{i}.jsonl')
+        mine = [r for r in records if in_shard(r['filename'], (i, 3))]
+        rng.shuffle(mine)
+        write_jsonl(path, mine)
+        write_jsonl(path.replace('.jsonl', '.deleted.jsonl'), [{'filename': f'del-{i}.wav', 'sim_char': 0.0}])
+        write_jsonl(path.replace('.jsonl', '.worst.jsonl'), sorted(mine, key=lambda r: r['sim_char'])[:5])
+        with open(path.replace('.jsonl', '.hist.json'), 'w') as f:
+            json.dump({'sim_char': {'0.9-1.0': len(mine), '0.0-0.1': i}}, f)
+        shards.append(path)
+
+    output = str(tmp_path / 'compare.jsonl')
+    merge_jsonl(output, *shards, spill_size=spill_size)
+    assert read_jsonl(output) == sorted(records, key=lambda r: r['filename'])
+    assert [r['filename'] for r in read_jsonl(tmp_path / 'compare.deleted.jsonl')] == ['del-0.wav', 'del-1.wav', 'del-2.wav']
+    assert read_jsonl(tmp_path / 'compare.worst.jsonl') == sorted(records, key=lambda r: r['sim_char'])[:5]
+    with open(tmp_path / 'compare.hist.json') as f:
+        assert json.load(f) == {'sim_char': {'0.9-1.0': 40, '0.0-0.1': 3}}
+
+    by_similarity = str(tmp_path / 'by-sim.jsonl')
+    merge_jsonl(by_similarity, *shards, sort_key='sim_char', spill_size=spill_size)
+    assert read_jsonl(by_similarity) == sorted(records, key=lambda r: (r['sim_char'], r['filename']))
+
+
+def test_merge_jsonl_without_sort_keeps_shard_order(tmp_path):
+    first, second = str(tmp_path / 'a.jsonl'), str(tmp_path / 'b.jsonl')
+    write_jsonl(first, [{'filename': 'z.wav'}])
+    write_jsonl(second, [{'filename': 'a.wav'}])
+    merge_jsonl(str(tmp_path / 'out.jsonl'), first, second, sort_key='')
+    assert read_jsonl(tmp_path / 'out.jsonl') == [{'filename': 'z.wav'}, {'filename': 'a.wav'}]
+    assert not os.path.exists(tmp_path / 'out.hist.json')
+
+
+def write_rewrite_shard(path, items):
+    """Output file and journal of a rewrite run over (input index, input line, output lines) items."""
+    journal = RunJournal(path + '.journal.jsonl', fresh=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for idx, line, lines in items:
+            f.writelines(out + '\n' for out in lines)
+            journal.mark_done(item_key(idx, line), lines=len(lines))
+    journal.close()
+
+
+def test_merge_text_restores_input_order(tmp_path):
+    inputs = [f'topic {i}' for i in range(6)]
+    outputs = {i: [f'{i}.{j}' for j in range(i % 3)] for i in range(6)}  # some items have no lines
+    shards = []
+    for shard in range(2):
+        path = str(tmp_path / f'rewritten-{shard}.txt')
+        write_rewrite_shard(path, [(i, inputs[i], outputs[i]) for i in reversed(range(6)) if i % 2 == shard])
+        shards.append(path)
+    merge_text(str(tmp_path / 'rewritten.txt'), *shards)
+    expected = [line for i in range(6) for line in outputs[i]]
+    assert (tmp_path / 'rewritten.txt').read_text(encoding='utf-8').splitlines() == expected
+
+
+def test_merge_text_rejects_inconsistent_journal(tmp_path):
+    path = str(tmp_path / 'rewritten-0.txt')
+    write_rewrite_shard(path, [(0, 'topic', ['a', 'b'])])
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('not journaled\n')
+    with pytest.raises(ValueError, match='accounts for 2'):
+        merge_text(str(tmp_path / 'out.txt'), path)
+
+
+def test_merge_dirs(tmp_path):
+    for shard in range(2):
+        sub = tmp_path / f'wavs-{shard}' / 'voice'
+        sub.mkdir(parents=True)
+        (sub / f'chrp000{shard}.wav').write_bytes(bytes([shard]) * 10)
+        (tmp_path / f'wavs-{shard}' / f'top-{shard}.txt').write_text(str(shard))
+    merge_dirs(str(tmp_path / 'wavs'), str(tmp_path / 'wavs-0'), str(tmp_path / 'wavs-1'), link_mode='copy')
+    assert sorted(os.listdir(tmp_path / 'wavs' / 'voice')) == ['chrp0000.wav', 'chrp0001.wav']
+    assert (tmp_path / 'wavs' / 'voice' / 'chrp0001.wav').read_bytes() == b'\x01' * 10
+    assert (tmp_path / 'wavs' / 'top-0.txt').read_text() == '0'
+    assert not os.path.samefile(tmp_path / 'wavs' / 'top-0.txt', tmp_path / 'wavs-0' / 'top-0.txt')
+
+    (tmp_path / 'wavs-1' / 'voice' / 'chrp0000.wav').write_bytes(b'dup')
+    with pytest.raises(ValueError, match='is in both'):
+        merge_dirs(str(tmp_path / 'again'), str(tmp_path / 'wavs-0'), str(tmp_path / 'wavs-1'), link_mode='copy')
+
+
+def write_wav(path, num_frames, value):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(24000)
+        w.writeframes(bytes([value, 0]) * num_frames)
+
+
+@pytest.mark.parametrize('pack_audio', [False, True])
+def test_merge_manifest_matches_single_export(tmp_path, pack_audio):
+    wav_dir = tmp_path / 'wavs'
+    wav_dir.mkdir()
+    records = []
+    for i in range(12):
+        write_wav(wav_dir / f'chrp{i:04d}.wav', 100 * (i + 1), i)
+        records.append({'filename': f'chrp{i:04d}.wav', 'reference_text': f'text {i}', 'sim_char': 0.9, 'sim_word': 0.9})
+    write_jsonl(tmp_path / 'compare.jsonl', records)
+    single = str(tmp_path / 'single.jsonl')
+    export(str(tmp_path / 'compare.jsonl'), str(wav_dir), single, pack_audio=pack_audio, num_workers=1)
+
+    shards = []
+    for shard in range(3):
+        shard_dir = tmp_path / f'node-{shard}'
+        shard_dir.mkdir()
+        write_jsonl(shard_dir / 'compare.jsonl', [r for r in records if in_shard(r['filename'], (shard, 3))])
+        path = str(shard_dir / 'manifest.jsonl')
+        export(str(shard_dir / 'compare.jsonl'), str(wav_dir), path, pack_audio=pack_audio, num_workers=1)
+        shards.append(path)
+    merged = str(tmp_path / 'merged.jsonl')
+    merge_manifest(merged, *shards)
+
+    assert read_jsonl(merged) == read_jsonl(single)
+    if pack_audio:
+        with open(merged + AUDIO_BLOB_SUFFIX, 'rb') as f1, open(single + AUDIO_BLOB_SUFFIX, 'rb') as f2:
+            assert f1.read() == f2.read()
+        blob = PackedAudio(merged + AUDIO_BLOB_SUFFIX)
+        row = read_jsonl(merged)[5]
+        assert bytes(blob.get(row['audio_offset'], row['audio_bytes'])) == bytes([5, 0]) * 600
+        blob.close()
@@ -0,0 +1,120 @@
+import io
+import threading
+
+import pytest
+
+from stage_metrics import LATENCY_BUCKETS, METRICS, Metrics, ProgressLine, StageStats, tracked
+
+
+def stats_with(*latencies):
+    stats = StageStats('tts', 'tts')
+    for seconds in latencies:
+        stats.observe(seconds, True, 0, 0)
+    return stats
+
+
+def test_percentile_interpolates_within_bucket():
+    stats = stats_with(0.2, 0.2, 0.2, 0.2)  # all in (0.1, 0.25]
+    assert stats.percentile(50) == pytest.approx(0.175)
+    assert stats.percentile(100) == pytest.approx(0.25)
+    assert stats.percentile(0) == pytest.approx(0.1)  # lower bound of the first non-empty bucket
+    assert StageStats('empty').percentile(99) == 0.0
+
+
+def test_percentile_across_buckets_and_inf():
+    stats = stats_with(0.01, 0.01, 0.01, 1000.0)
+    assert stats.percentile(50) == pytest.approx(0.05 * 2 / 3)
+    top = LATENCY_BUCKETS[-1]
+    assert stats.percentile(99) == pytest.approx(top + top * (3.96 - 3))  # +Inf bucket: up to twice the last bound
+    assert stats.percentile(100) == pytest.approx(2 * top)
+
+
+def test_bucket_bounds_are_inclusive():
+    stats = stats_with(0.05, 0.0500001)
+    assert stats.buckets[0] == 1 and stats.buckets[1] == 1
+
+
+def test_track_counts_errors_and_in_flight():
+    metrics = Metrics()
+    with metrics.track('asr', api='speech', bytes_in=10) as call:
+        assert metrics.stage('asr', 'speech').in_flight == 1
+        call.bytes_out = 3
+    with metrics.track('asr', api='speech') as call:
+        call.fail()
+    with pytest.raises(KeyError):
+        with metrics.track('asr', api='speech'):
+            raise KeyError('x')
+    stats = metrics.stage('asr', 'speech')
+    assert (stats.count, stats.errors, stats.in_flight) == (3, 2, 0)
+    assert (stats.bytes_in, stats.bytes_out) == (10, 3)
+    assert metrics.thread_stages == {}
+
+
+def test_nested_stages_and_finished_threads_are_forgotten():
+    metrics = Metrics()
+    seen = []
+
+    def work():
+        with metrics.track('pipeline'):
+            with metrics.track('tts'):
+                seen.append(list(metrics.thread_stages[threading.get_ident()]))
+
+    threads = [threading.Thread(target=work) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == [['pipeline', 'tts']] * 5
+    assert metrics.thread_stages == {}
+
+
+def test_tracked_none_is_error():
+    calls = iter([None, 'text'])
+
+    @tracked('test-tracked', api='x', none_is_error=True)
+    def recognize():
+        return next(calls)
+
+    @tracked('test-tracked-plain')
+    def plain():
+        return None
+
+    assert recognize() is None
+    assert recognize() == 'text'
+    plain()
+    stats = METRICS.stage('test-tracked', 'x')
+    assert (stats.count, stats.errors) == (2, 1)
+    assert METRICS.stage('test-tracked-plain').errors == 0
+
+
+def test_prometheus_histogram_is_cumulative():
+    metrics = Metrics(job='test')
+    for seconds in (0.01, 0.3, 0.3, 7.0, 1000.0):
+        metrics.record('tts', seconds, api='tts', ok=seconds < 100)
+    text = metrics.to_prometheus()
+    labels = 'job="test",stage="tts",api="tts"'
+    buckets = [line for line in text.splitlines() if line.startswith('chirp3_request_seconds_bucket')]
+    assert len(buckets) == len(LATENCY_BUCKETS) + 1
+    counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert buckets[-1] == f'chirp3_request_seconds_bucket{{{labels},le="+Inf"}} 5'
+    assert f'chirp3_request_seconds_bucket{{{labels},le="0.5"}} 3' in buckets
+    assert f'chirp3_request_seconds_count{{{labels}}} 5' in text
+    assert f'chirp3_errors_total{{{labels}}} 1' in text
+    assert text.endswith('\n')
+
+
+def test_textfile_summary_and_progress(tmp_path):
+    metrics = Metrics(job='test')
+    metrics.record('asr', 0.2, api='speech')
+    metrics.write_textfile(str(tmp_path / 'asr.prom'))
+    assert (tmp_path / 'asr.prom').read_text() == metrics.to_prometheus()
+    assert not (tmp_path / 'asr.prom.tmp').exists()
+    [stage] = metrics.summary()['stages']
+    assert stage['count'] == 1 and stage['latency_p50'] == pytest.approx(0.175)
+    out = io.StringIO()
+    progress = ProgressLine(metrics, total=4, stream=out)
+    progress.close()
+    assert out.getvalue().startswith('\r[') and 'asr/speech 1/4 err=0' in out.getvalue()
+    metrics.reset()
+    assert metrics.summary()['stages'] == []
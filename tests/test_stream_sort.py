@@ -0,0 +1,96 @@
+import json
+import os
+import random
+
+import pytest
+
+from batch_compare_asr_ref import process_comparison, sidecar_path
+from stream_sort import ExternalSorter, Histogram, TopK
+
+
+def make_records(n, seed=0):
+    rng = random.Random(seed)
+    return [{'filename': f'chrp{i:04d}.wav', 'sim_char': rng.choice([0.1, 0.5, 0.9, rng.random()])} for i in range(n)]
+
+
+@pytest.mark.parametrize('spill_size', [0, 1, 7, 1000])
+def test_external_sort_is_stable(tmp_path, spill_size):
+    records = make_records(100)
+    sorter = ExternalSorter(lambda r: r['sim_char'], spill_size=spill_size, tmp_dir=str(tmp_path))
+    for record in records:
+        sorter.add(record)
+    assert list(sorter) == sorted(records, key=lambda r: r['sim_char'])
+    assert os.listdir(tmp_path) == []  # spilled runs are removed
+
+
+def test_external_sort_with_tuple_keys_across_spills(tmp_path):
+    records = make_records(50)
+    sorter = ExternalSorter(lambda r: (r['sim_char'], r['filename']), spill_size=8, tmp_dir=str(tmp_path))
+    for record in reversed(records):
+        sorter.add(record)
+    assert list(sorter) == sorted(records, key=lambda r: (r['sim_char'], r['filename']))
+
+
+def test_external_sort_cleans_up_when_abandoned(tmp_path):
+    sorter = ExternalSorter(lambda r: r['sim_char'], spill_size=5, tmp_dir=str(tmp_path))
+    for record in make_records(20):
+        sorter.add(record)
+    assert len(os.listdir(tmp_path)) == 4
+    it = iter(sorter)
+    next(it)
+    it.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_top_k_keeps_smallest_in_input_order():
+    records = make_records(200, seed=3)
+    top = TopK(10, lambda r: r['sim_char'])
+    for record in records:
+        top.add(record)
+    assert top.count == 200
+    assert top.sorted() == sorted(records, key=lambda r: r['sim_char'])[:10]
+
+
+def test_histogram_bins():
+    histogram = Histogram(4)
+    for value in [0.0, 0.1, 0.25, 0.5, 0.99, 1.0, -0.1]:
+        histogram.add(value)
+    assert histogram.as_dict() == {'0.00-0.25': 3, '0.25-0.50': 1, '0.50-0.75': 1, '0.75-1.00': 2}
+
+
+def test_sidecar_path_replaces_only_the_extension():
+    assert sidecar_path('out/compare.jsonl', 'worst') == 'out/compare.worst.jsonl'
+    assert sidecar_path('runs.jsonl.d/compare.jsonl', 'hist', '.json') == 'runs.jsonl.d/compare.hist.json'
+    assert sidecar_path('compare.out', 'deleted') == 'compare.out.deleted.jsonl'
+
+
+def test_sorted_comparison_matches_streamed(tmp_path):
+    refs = tmp_path / 'txts'
+    refs.mkdir()
+    rng = random.Random(5)
+    words = 'the quick brown fox jumps over a lazy dog today'.split()
+    with open(tmp_path / 'asr.jsonl', 'w', encoding='utf-8') as f:
+        for i in range(40):
+            ref = ' '.join(rng.choice(words) for _ in range(12))
+            hyp = ' '.join(w if rng.random() < 0.8 else rng.choice(words) for w in ref.split())
+            (refs / f'chrp{i:04d}.txt').write_text(ref + '\n', encoding='utf-8')
+            f.write(json.dumps({'filename': f'vc_chrp{i:04d}.wav', 'text': hyp}) + '\n')
+    streamed = tmp_path / 'streamed.jsonl'
+    spilled = tmp_path / 'spilled.jsonl'
+    process_comparison(str(tmp_path / 'asr.jsonl'), str(refs), str(streamed), min_char_sim=0.9, histogram_bins=5)
+    process_comparison(str(tmp_path / 'asr.jsonl'), str(refs), str(spilled), min_char_sim=0.9,
+                       sort_by_similarity=True, spill_size=3, top_k_worst=5)
+
+    def read(path):
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    for tag in ('', 'deleted'):
+        a = read(sidecar_path(str(streamed), tag) if tag else streamed)
+        b = read(sidecar_path(str(spilled), tag) if tag else spilled)
+        assert b == sorted(a, key=lambda r: r['sim_char'])
+    everything = read(streamed) + read(sidecar_path(str(streamed), 'deleted'))
+    worst = read(sidecar_path(str(spilled), 'worst'))
+    assert [r['sim_char'] for r in worst] == sorted(r['sim_char'] for r in everything)[:5]
+    with open(tmp_path / 'streamed.hist.json', encoding='utf-8') as f:
+        assert sum(json.load(f)['sim_char'].values()) == 40